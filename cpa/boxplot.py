@@ -82,6 +82,9 @@ class DataSourcePanel(wx.Panel):
         wx.EVT_COMBOBOX(self.table_choice, -1, self.on_table_selected)
         wx.EVT_COMBOBOX(self.x_choice, -1, self.on_column_selected)
         wx.EVT_BUTTON(self.update_chart_btn, -1, self.update_figpanel)   
+        # The statistics are computed in the background so the window stays
+        # responsive
+        self.points_query = ui.BackgroundQuery(self, self.update_chart_btn)
         
         self.SetSizer(sizer)
         self.Show(1)
@@ -129,47 +132,62 @@ class DataSourcePanel(wx.Panel):
         types = db.GetColumnTypes(table)
         return [m for m,t in zip(measurements, types) if t in [float, int, long]]
         
-    def update_figpanel(self, evt=None):
+    def update_figpanel(self, evt=None, then=None):
+        '''
+        Computes the box plot statistics of the points in the background as
+        they are read, and plots them when they are done.
+        then -- a function to call once the points are plotted
+        '''
+        if evt is not None and self.points_query.running():
+            # The update button reads "Cancel" while points are loading
+            self.points_query.cancel()
+            return
         table = self.table_choice.Value
         fltr = self.filter_choice.get_filter_or_none()
         grouping = self.group_choice.Value
         if self.x_choice.Value == SELECT_MULTIPLE:
-            points_dict = {}
-            for col in self.x_columns:
-                pts = self.loadpoints(table, col, fltr, NO_GROUP)
-                for k in pts.keys(): assert k not in points_dict.keys()
-                points_dict.update(pts)
+            # all columns are fetched with one query
+            cols = list(self.x_columns)
+            grouping = NO_GROUP
         else:
-            col = self.x_choice.Value
-            points_dict = self.loadpoints(table, col, fltr, grouping)
-        
+            cols = [self.x_choice.Value]
+        self.points_query.submit(
+            lambda boxes: self._plot_stats(self._stats_dict(boxes, cols, grouping), 
+                                           sum([box.nans for box in boxes]),
+                                           grouping, then),
+            self._points_query(table, cols, fltr, grouping), 'box_stats', 
+            nvalues=len(cols))
+
+    def _plot_stats(self, stats_dict, ignored, grouping, then=None):
         # Check if the user is creating a plethora of plots by accident
-        if 100 >= len(points_dict) > 25:
+        if 100 >= len(stats_dict) > 25:
             res = wx.MessageDialog(self, 'Are you sure you want to show %s box '
-                                   'plots on one axis?'%(len(points_dict)), 
+                                   'plots on one axis?'%(len(stats_dict)), 
                                    'Warning', style=wx.YES_NO|wx.NO_DEFAULT
                                    ).ShowModal()
             if res != wx.ID_YES:
                 return
-        elif len(points_dict) > 100:
+        elif len(stats_dict) > 100:
             wx.MessageBox('Sorry, boxplot can not show more than 100 plots on\n'
                           'a single axis. Your current settings would plot %d.\n'
                           'Try using a filter to narrow your query.'
-                          %(len(points_dict)), 'Too many groups to plot')
+                          %(len(stats_dict)), 'Too many groups to plot')
             return
 
-        self.figpanel.setpoints(points_dict)
-        if self.group_choice.Value != NO_GROUP:
+        self.figpanel.setstats(stats_dict, ignored)
+        if grouping != NO_GROUP:
             self.figpanel.set_x_axis_label(grouping)
             self.figpanel.set_y_axis_label(self.x_choice.Value)
         self.figpanel.draw()
+        if then is not None:
+            then()
         
-    def loadpoints(self, tablename, col, fltr=None, grouping=NO_GROUP):
+    def _points_query(self, tablename, cols, fltr=None, grouping=NO_GROUP):
         '''
-        Returns a dict mapping x label values to lists of values from col
+        Returns a query for the values of cols (and the group key columns)
         '''
         q = sql.QueryBuilder()
-        select = [sql.Column(tablename, col)]
+        select = [sql.Column(tablename, col) for col in cols]
         if grouping != NO_GROUP:
             dm = datamodel.DataModel.getInstance()
             group_cols = dm.GetGroupColumnNames(grouping, include_table_name=True)
@@ -177,22 +195,17 @@ class DataSourcePanel(wx.Panel):
         q.set_select_clause(select)
         if fltr is not None:
             q.add_filter(fltr)
+        return str(q)
 
-        res = db.execute(str(q))
-        res = np.array(res, dtype=object)
-        # replaces Nones with NaNs
-        for row in res:
-            if row[0] is None:
-                row[0] = np.nan
-        
-        points_dict = {}
-        if self.group_choice.Value != NO_GROUP:
-            for row in res:
-                groupkey = tuple(row[1:])
-                points_dict[groupkey] = points_dict.get(groupkey, []) + [row[0]]
-        else:
-            points_dict = {col : [r[0] for r in res]}
-        return points_dict
+    def _stats_dict(self, boxes, cols, grouping=NO_GROUP):
+        '''
+        Returns a dict mapping x label values to box plot statistics, given
+        the BoxStats of the columns of _points_query
+        '''
+        if grouping != NO_GROUP:
+            return boxes[0].stats()
+        return dict([(col, box.stats()[()]) for col, box in zip(cols, boxes)
+                     if () in box.stats()])
 
     def save_settings(self):
         '''
@@ -233,18 +246,20 @@ class DataSourcePanel(wx.Panel):
                 self.x_columns = cols
         if 'filter' in settings:
             self.filter_choice.SetStringSelection(settings['filter'])
-        self.update_figpanel()
-        if 'x-lim' in settings:
-            self.figpanel.subplot.set_xlim(eval(settings['x-lim']))
-        if 'y-lim' in settings:
-            self.figpanel.subplot.set_ylim(eval(settings['y-lim']))
-        self.figpanel.draw()
+        def set_view():
+            if 'x-lim' in settings:
+                self.figpanel.subplot.set_xlim(eval(settings['x-lim']))
+            if 'y-lim' in settings:
+                self.figpanel.subplot.set_ylim(eval(settings['y-lim']))
+            self.figpanel.draw()
+        self.update_figpanel(then=set_view)
 
 
 class BoxPlotPanel(FigureCanvasWxAgg):
-    def __init__(self, parent, points, **kwargs):
+    def __init__(self, parent, stats, **kwargs):
         '''
-        points -- a dictionary mapping x axis values to lists of values to plot
+        stats -- a dictionary mapping x axis values to the box plot 
+                 statistics to plot (see boxstats.BoxStats.stats)
         '''
         self.figure = Figure()
         FigureCanvasWxAgg.__init__(self, parent, -1, self.figure, **kwargs)
@@ -255,42 +270,43 @@ class BoxPlotPanel(FigureCanvasWxAgg):
         self.canvas.SetBackgroundColour('white')
         
         self.navtoolbar = None
-        self.setpoints(points)
+        self.setstats(stats)
         
-    def setpoints(self, points):
+    def setstats(self, stats, ignored=0):
         '''
         Updates the data to be plotted and redraws the plot.
-        points - list of array samples, where each sample will be plotted as a 
-                 separate box plot against the same y axis
+        stats - a dictionary mapping x axis values to box plot statistics,
+                each of which will be plotted as a separate box plot 
+                against the same y axis
+        ignored - the number of NaNs left out of the statistics
         '''
         self.xlabels = []
-        self.points = []
-        ignored = 0
-        for label, values in sorted(points.items()):
+        self.stats = []
+        for label, box in sorted(stats.items()):
             if type(label) in [tuple, list]:
                 self.xlabels += [','.join([str(l) for l in label])]
             else:
                 self.xlabels += [label]
-            self.points += [np.array(values).astype('f')[~ np.isnan(values)]]
-            ignored += len(np.array(values)[np.isnan(values)])
+            self.stats += [box]
         
         if not hasattr(self, 'subplot'):
             self.subplot = self.figure.add_subplot(111)
         self.subplot.clear()
         # nothing to plot?
-        if len(self.points)==0:
+        if len(self.stats)==0:
             logging.warn('No data to plot.')
             return
-        self.subplot.boxplot(self.points)
-        if len(self.points) > 1:
+        self.subplot.bxp(self.stats)
+        if len(self.stats) > 1:
             self.figure.autofmt_xdate()
         self.subplot.set_xticklabels(self.xlabels)
         self.reset_toolbar()
+        npoints = sum([box['n'] for box in self.stats])
         if ignored == 0:
-            logging.info('Boxplot: Plotted %s points.'%(sum(map(len, self.points))))
+            logging.info('Boxplot: Plotted %s points.'%(npoints))
         else:
             logging.warn('Boxplot: Plotted %s points. Ignored %s NaNs.'
-                          %(sum(map(len, self.points)), ignored))
+                          %(npoints, ignored))
         
     def set_x_axis_label(self, label):
         self.subplot.set_xlabel(label)
@@ -298,8 +314,8 @@ class BoxPlotPanel(FigureCanvasWxAgg):
     def set_y_axis_label(self, label):
         self.subplot.set_ylabel(label)
     
-    def get_point_lists(self):
-        return self.points
+    def get_stats(self):
+        return self.stats
     
     def get_xlabels(self):
         return self.xlabels
@@ -327,8 +343,7 @@ class BoxPlot(wx.Frame, CPATool):
         CPATool.__init__(self)
         self.SetName(self.tool_name)
         self.SetBackgroundColour(wx.NullColor)
-        points = {}
-        figpanel = BoxPlotPanel(self, points)
+        figpanel = BoxPlotPanel(self, {})
         configpanel = DataSourcePanel(self, figpanel)
         self.SetToolBar(figpanel.get_toolbar())
         sizer = wx.BoxSizer(wx.VERTICAL)
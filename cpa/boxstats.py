@@ -0,0 +1,203 @@
+'''
+Box plot statistics of grouped values, computed a block of rows at a time.
+
+BoxStats is given the values and group keys of a query's result as it is
+read, and returns only the five-number summary and the outliers of each
+group, so the raw values never have to be held in python lists or passed
+to matplotlib. A group's statistics are exact (its values are kept in NumPy
+arrays and sorted once at the end) until it grows beyond MAX_EXACT values.
+From then on a bounded-memory sketch of the group is kept instead: a
+uniform random sample of its values, from which the quartiles are
+estimated, and its SKETCH_SIZE smallest and largest values, from which the
+whiskers and outliers are found.
+
+Example:
+>>> stats = BoxStats()
+>>> for values, wells in db.iter_execute_to_arrays('SELECT Area, Well FROM ...'):
+...     stats.add(values, [wells])
+>>> stats.stats()[('A01',)]['med']
+'''
+import numpy as np
+
+# Groups with more values than this are summarised with a sketch
+MAX_EXACT = 1000000
+# The number of sampled values, and of values kept at each extreme, in the
+# sketch of a large group. The rank error of the quartiles is on the order
+# of 1/sqrt(SKETCH_SIZE). Outliers are exact unless a group has more than
+# SKETCH_SIZE of them at one end.
+SKETCH_SIZE = 20000
+# Whiskers reach the most extreme values within WHIS times the
+# interquartile range of the quartiles, as in matplotlib's boxplot
+WHIS = 1.5
+
+
+# np.partition is new in numpy 1.8; before that a full sort does the job
+_HAS_PARTITION = hasattr(np, 'partition')
+
+def _smallest(values, n):
+    '''returns the n smallest values, sorted'''
+    if len(values) > n:
+        if not _HAS_PARTITION:
+            return np.sort(values)[:n]
+        values = np.partition(values, n - 1)[:n]
+    return np.sort(values)
+
+def _largest(values, n):
+    '''returns the n largest values, sorted'''
+    if len(values) > n:
+        if not _HAS_PARTITION:
+            return np.sort(values)[-n:]
+        values = np.partition(values, len(values) - n)[-n:]
+    return np.sort(values)
+
+
+class _Sketch(object):
+    '''A bounded-memory summary of a large group of values.'''
+    def __init__(self, size, random):
+        self.size = size
+        self.random = random
+        self.seen = 0
+        self.sample = np.zeros(0)
+        self.low = np.zeros(0)
+        self.high = np.zeros(0)
+
+    def add(self, values):
+        # Value i of the group fills the sample until it has size values,
+        # then replaces a random value with probability size / (i + 1).
+        fill = max(0, min(self.size - self.seen, len(values)))
+        i = np.arange(self.seen + fill, self.seen + len(values))
+        slots = (self.random.random_sample(len(i)) * (i + 1)).astype(np.int64)
+        replace = slots < self.size
+        self.sample = np.concatenate([self.sample, values[:fill]])
+        self.sample[slots[replace]] = values[fill:][replace]
+        self.seen += len(values)
+        self.low = _smallest(np.concatenate([self.low, values]), self.size)
+        self.high = _largest(np.concatenate([self.high, values]), self.size)
+
+    def stats(self, whis):
+        q1, med, q3 = np.percentile(self.sample, [25, 50, 75])
+        lo_fence = q1 - whis * (q3 - q1)
+        hi_fence = q3 + whis * (q3 - q1)
+        # The whiskers are exact if the extremes kept reach inside the
+        # fences; otherwise there are too many outliers to keep them all and
+        # the whiskers are estimated from the sample.
+        inside = self.low[self.low >= lo_fence]
+        if len(inside) == 0:
+            inside = self.sample[self.sample >= lo_fence]
+        whislo = inside.min()
+        inside = self.high[self.high <= hi_fence]
+        if len(inside) == 0:
+            inside = self.sample[self.sample <= hi_fence]
+        whishi = inside.max()
+        fliers = np.concatenate([self.low[self.low < lo_fence],
+                                 self.high[self.high > hi_fence]])
+        return _stats_dict(q1, med, q3, whislo, whishi, fliers, self.seen)
+
+
+def _stats_dict(q1, med, q3, whislo, whishi, fliers, n):
+    '''The statistics of a group in the form matplotlib's Axes.bxp takes.'''
+    return {'q1': float(q1), 'med': float(med), 'q3': float(q3),
+            'whislo': float(whislo), 'whishi': float(whishi),
+            'fliers': fliers, 'n': n}
+
+def _exact_stats(values, whis):
+    '''Box plot statistics of a sorted array of values.'''
+    q1, med, q3 = np.percentile(values, [25, 50, 75])
+    lo = np.searchsorted(values, q1 - whis * (q3 - q1), 'left')
+    hi = np.searchsorted(values, q3 + whis * (q3 - q1), 'right')
+    return _stats_dict(q1, med, q3, values[lo], values[hi - 1],
+                       np.concatenate([values[:lo], values[hi:]]), len(values))
+
+
+class _Group(object):
+    '''The values of one group: exact until there are more than max_exact
+    of them, then a _Sketch.'''
+    def __init__(self, max_exact, sketch_size, random):
+        self.max_exact = max_exact
+        self.sketch_size = sketch_size
+        self.random = random
+        self.blocks = []
+        self.n = 0
+        self.sketch = None
+
+    def add(self, values):
+        self.n += len(values)
+        if self.sketch is not None:
+            self.sketch.add(values)
+            return
+        self.blocks.append(values)
+        if self.n > self.max_exact:
+            self.sketch = _Sketch(self.sketch_size, self.random)
+            self.sketch.add(np.concatenate(self.blocks))
+            self.blocks = None
+
+    def stats(self, whis):
+        if self.sketch is not None:
+            return self.sketch.stats(whis)
+        return _exact_stats(np.sort(np.concatenate(self.blocks)), whis)
+
+
+class BoxStats(object):
+    '''
+    Accumulates values by group and computes their box plot statistics.
+    '''
+    def __init__(self, max_exact=MAX_EXACT, sketch_size=SKETCH_SIZE, whis=WHIS):
+        self.max_exact = max_exact
+        self.sketch_size = sketch_size
+        self.whis = whis
+        self.groups = {}
+        # the number of NULL or NaN values ignored
+        self.nans = 0
+        self.random = np.random.RandomState(0)
+        self._stats = None
+
+    def add(self, values, keys=()):
+        '''
+        Adds a block of values to their groups.
+        values -- an array of values. NaNs and NULLs are ignored.
+        keys -- a list of arrays of the same length, the group key columns
+                of each value. Without keys all values are in one group,
+                with the key ().
+        '''
+        self._stats = None
+        values = np.asarray(values, dtype=float)
+        keep = ~np.isnan(values)
+        self.nans += len(values) - keep.sum()
+        values = values[keep]
+        if len(values) == 0:
+            return
+        if len(keys) == 0:
+            self._group(()).add(values)
+            return
+        # Number the distinct keys of the block with one code per row
+        codes = np.zeros(len(values), dtype=np.int64)
+        uniques = []
+        for col in keys:
+            u, inv = np.unique(np.asarray(col)[keep], return_inverse=True)
+            codes = codes * len(u) + inv
+            uniques.append(u)
+        block_codes, inv = np.unique(codes, return_inverse=True)
+        order = np.argsort(inv, kind='mergesort')
+        bounds = np.searchsorted(inv[order], np.arange(len(block_codes) + 1))
+        key_indices = np.unravel_index(block_codes, [len(u) for u in uniques])
+        block_keys = zip(*[u[i].tolist() for u, i in zip(uniques, key_indices)])
+        for j, key in enumerate(block_keys):
+            self._group(key).add(values[order[bounds[j]:bounds[j+1]]])
+
+    def _group(self, key):
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = _Group(self.max_exact, self.sketch_size, self.random)
+        return group
+
+    def stats(self):
+        '''
+        Returns a dict mapping each group key to its statistics: a dict with
+        the quartiles ("q1", "med", "q3"), the whisker ends ("whislo",
+        "whishi"), an array of the outliers ("fliers") and the number of
+        values ("n"). The result is kept until more values are added.
+        '''
+        if self._stats is None:
+            self._stats = dict([(key, group.stats(self.whis))
+                                for key, group in self.groups.items()])
+        return self._stats
@@ -7,6 +7,7 @@ matplotlib.use('WXAgg')
 from datatable import DataGrid
 import tableviewer
 from datamodel import DataModel
+from objectcoords import ObjectCoordsCache
 from imagecontrolpanel import ImageControlPanel
 from plateviewer import PlateViewer
 from properties import Properties
@@ -963,7 +964,7 @@ class Classifier(wx.Frame):
         # Get object coordinates in image and display
         classCoords = {}
         for className, obKeys in classHits.items():
-            classCoords[className] = [db.GetObjectCoords(key) for key in obKeys]
+            classCoords[className] = ObjectCoordsCache.getInstance().GetObjectsCoords(obKeys)
         # Show the image
         imViewer = imagetools.ShowImage(imKey, list(self.chMap), self,
                                         brightness=self.brightness, scale=self.scale,
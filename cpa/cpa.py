@@ -202,6 +202,8 @@ class MainGUI(wx.Frame):
         normalizeMenuItem = advancedMenu.Append(-1, 'Launch feature normalization tool', help='Launches a tool for generating normalized values for measurement columns in your tables.')
         queryMenuItem = advancedMenu.Append(-1, 'Launch SQL query tool', help='Opens a tool for making SQL queries to the CPA database. Advanced users only.')
         clearTableLinksMenuItem = advancedMenu.Append(-1, 'Clear table linking information', help='Removes the tables from your database that tell CPA how to link your tables.')
+        indexMenuItem = advancedMenu.Append(-1, 'Check database indexes', help='Checks that your tables have the indexes CPA needs, and creates any that are missing.')
+        queryProfileMenuItem = advancedMenu.Append(-1, 'Show database query profile', help='Shows which database queries CPA has spent the most time on.')
         self.GetMenuBar().Append(advancedMenu, 'Advanced')
 
         helpMenu = wx.Menu()
@@ -239,6 +241,8 @@ class MainGUI(wx.Frame):
         self.Bind(wx.EVT_MENU, self.launch_normalization_tool, normalizeMenuItem)
         self.Bind(wx.EVT_MENU, self.clear_link_tables, clearTableLinksMenuItem)
         self.Bind(wx.EVT_MENU, self.launch_query_maker, queryMenuItem)
+        self.Bind(wx.EVT_MENU, self.check_indexes, indexMenuItem)
+        self.Bind(wx.EVT_MENU, self.show_query_profile, queryProfileMenuItem)
         self.Bind(wx.EVT_MENU, self.on_show_about, aboutMenuItem)
         self.Bind(wx.EVT_TOOL, self.launch_classifier, id=ID_CLASSIFIER)
         self.Bind(wx.EVT_TOOL, self.launch_plate_map_browser, id=ID_PLATE_VIEWER)
@@ -356,6 +360,35 @@ class MainGUI(wx.Frame):
         db.execute('DROP TABLE IF EXISTS %s'%(p.link_columns_table))
         db.Commit()
 
+    def check_indexes(self, evt=None):
+        db = dbconnect.DBConnect.getInstance()
+        busy = wx.BusyCursor()
+        missing = db.EnsureIndexes()
+        del busy
+        if not missing:
+            wx.MessageBox('All of the indexes CPA uses were found.', 'Check database indexes')
+            return
+        dlg = wx.MessageDialog(self, 'The following indexes are missing:\n%s\n\n'
+                    'Create them now? This may take a while for large tables.'
+                    %('\n'.join(['%s (%s)'%(t, ', '.join(cols)) for t, cols in missing])),
+                    'Create missing indexes?', wx.YES_NO|wx.ICON_QUESTION)
+        if dlg.ShowModal() != wx.ID_YES:
+            return
+        busy = wx.BusyCursor()
+        missing = db.EnsureIndexes(create=True)
+        del busy
+        if missing:
+            wx.MessageBox('Some indexes could not be created. See the log for details.', 
+                          'Check database indexes', style=wx.OK|wx.ICON_EXCLAMATION)
+
+    def show_query_profile(self, evt=None):
+        from wx.lib.dialogs import ScrolledMessageDialog
+        db = dbconnect.DBConnect.getInstance()
+        dlg = ScrolledMessageDialog(self, db.get_query_profile_report(), 
+                                    'Database query profile', size=(800, 500),
+                                    style=wx.DEFAULT_DIALOG_STYLE|wx.RESIZE_BORDER)
+        dlg.ShowModal()
+
     def on_show_about(self, evt):
         ''' Shows a message box with the version number etc.'''
         message = ('CellProfiler Analyst was developed at The Broad Institute\n'
@@ -1,13 +1,30 @@
+from __future__ import with_statement
+import os
+import time
 import logging
-from random import randint
+import threading
+from collections import OrderedDict
 import numpy as np
 from dbconnect import *
 from singleton import *
 from properties import Properties
+from querycache import encode_column, decode_column
 
 p = Properties.getInstance()
 db = DBConnect.getInstance()
 
+SNAPSHOT_VERSION = 1
+OBJECT_ID_CACHE_SIZE = 2000000   # most object IDs kept by GetObjectIDsFromImages
+
+def get_snapshot_filename():
+    '''Returns the name of the DataModel snapshot file, which is kept beside
+    the SQLite database or else beside the properties file.'''
+    if p.db_type.lower() == 'sqlite' and p.db_sqlite_file:
+        return p.db_sqlite_file + '.datamodel.npz'
+    elif p._filename:
+        return p._filename + '.datamodel.npz'
+    return None
+
 class DataModel(Singleton):
     '''
     DataModel is a dictionary of perImageObjectCounts indexed by (TableNumber,ImageNumber)
@@ -28,6 +45,12 @@ class DataModel(Singleton):
         self.filterkeys = {}     # sets of image keys keyed by filter name
         self.plate_map = {}      # maps well names to (x,y) plate locations
         self.rev_plate_map = {}  # maps (x,y) plate locations to well names
+        self.wells = None        # distinct well names, read for the plate map
+        self.table_dates = None  # modification dates of the tables read
+        self.refresh_thread = None
+        self.object_ids = OrderedDict()  # LRU of {imKey:array of object IDs}
+        self.object_ids_size = 0
+        self.object_ids_lock = threading.Lock()
         
     def __str__(self):
         return str(self.obCount)+" objects in "+ \
@@ -47,36 +70,238 @@ class DataModel(Singleton):
         if p.check_tables == 'yes':
             db.CheckTables()
         
+        if p.datamodel_snapshot == 'yes':
+            t0 = time.time()
+            snapshot = self.load_snapshot()
+            if snapshot is not None:
+                state, stale = snapshot
+                self._set_state(*state)
+                logging.info('Loaded the data model snapshot in %.3fs.'%(time.time() - t0))
+                if stale:
+                    logging.info('The database tables have changed since the data '
+                                 'model snapshot was saved. Refreshing it in the background.')
+                    self.refresh_in_background()
+                return
+        
+        self._set_state(*self._read_from_db())
+        self.save_snapshot()
+    
+    def _get_snapshot_tables(self):
+        '''Returns the tables the data model is read from.'''
+        tables = [p.image_table]
+        if p.object_table:
+            tables += [p.object_table]
+        for query in p._groups.values():
+            tables += [t for t in db.get_tables_in_query(query) if t not in tables]
+        return tables
+        
+    def _read_from_db(self):
+        '''
+        Reads the per-image object counts and the group queries from the 
+        database. Returns the arguments for _set_state.
+        '''
+        table_dates = None
+        if p.datamodel_snapshot == 'yes':
+            # read before the data so later changes make the snapshot stale
+            table_dates = db.get_table_modify_dates(self._get_snapshot_tables())
+        
         # Initialize per-image object counts to zero
+        data = {}
         imKeys = db.GetAllImageKeys()
         for key in imKeys:
             key = tuple([int(k) for k in key])    # convert keys to to int tuples
-            self.data[key] = 0
+            data[key] = 0
                     
         # Compute per-image object counts
         res = db.GetPerImageObjectCounts()
         for r in res:
             key = tuple([int(k) for k in r[:-1]])
-            self.data[key] = r[-1]
-            self.obCount += r[-1]
-            
-        self.keylist = list(self.data.keys())
-
+            data[key] = r[-1]
+        
+        groups = {}
+        for group in p._groups:
+            rows, col_names = db.group_rows(group)
+            groups[group] = (rows, col_names)
+        return data, groups, None, table_dates
+    
+    def _set_state(self, data, groups, wells, table_dates):
+        '''
+        Builds the data model from the per-image object counts, the rows of
+        each group query (image key + group key) and the well names (or None
+        if they haven't been read).
+        '''
+        key_size = p.table_id and 2 or 1
+        keylist = list(data.keys())
         # Build a cumulative sum array to use for generating random objects quickly
-        self.cumSums = np.zeros(len(self.data)+1, dtype='int')
-        for i, imKey in enumerate(self.keylist):
-            self.cumSums[i+1] = self.cumSums[i]+self.data[imKey]
-
-        self.groupMaps, self.groupColNames = db.GetGroupMaps()
-        self.revGroupMaps, _ = db.GetGroupMaps(reverse=True)
-        for group in self.groupMaps:
-            self.groupColTypes[group] = [type(col) for col in self.groupMaps[group].items()[0][1]]
+        cumSums = np.zeros(len(keylist)+1, dtype='int')
+        cumSums[1:] = np.cumsum([data[imKey] for imKey in keylist])
+        
+        groupMaps, revGroupMaps, groupColNames, groupColTypes = {}, {}, {}, {}
+        for group, (rows, col_names) in groups.items():
+            groupMap, revGroupMap = {}, {}
+            for row in rows:
+                groupMap[row[:key_size]] = row[key_size:]
+                revGroupMap.setdefault(row[key_size:], []).append(row[:key_size])
+            groupMaps[group] = groupMap
+            revGroupMaps[group] = revGroupMap
+            groupColNames[group] = col_names
+            if groupMap:
+                groupColTypes[group] = [type(col) for col in groupMap.values()[0]]
+            else:
+                groupColTypes[group] = []
+        
+        # swap everything in at once in case another thread is using the model
+        self.__dict__.update({'data' : data,
+                              'keylist' : keylist,
+                              'cumSums' : cumSums,
+                              'obCount' : int(cumSums[-1]),
+                              'groupMaps' : groupMaps,
+                              'revGroupMaps' : revGroupMaps,
+                              'groupColNames' : groupColNames,
+                              'groupColTypes' : groupColTypes,
+                              'filterkeys' : {},
+                              'object_ids' : OrderedDict(),
+                              'object_ids_size' : 0,
+                              'plate_map' : {},
+                              'rev_plate_map' : {},
+                              'wells' : wells,
+                              'table_dates' : table_dates})
+    
+    def refresh_in_background(self):
+        '''Rereads the data model from the database in a background thread
+        and saves a new snapshot.'''
+        def refresh():
+            try:
+                try:
+                    t0 = time.time()
+                    self._set_state(*self._read_from_db())
+                    self.save_snapshot()
+                    logging.info('Refreshed the data model in %.3fs.'%(time.time() - t0))
+                except Exception, e:
+                    logging.error('Failed to refresh the data model: %s'%(e))
+            finally:
+                db.CloseConnection()
+        self.refresh_thread = threading.Thread(target=refresh, name='DataModelRefresh')
+        self.refresh_thread.setDaemon(True)
+        self.refresh_thread.start()
+    
+    def _get_snapshot_signature(self):
+        '''Identifies the database and the properties the data model is
+        read with, so snapshots of other databases or settings aren't used.'''
+        return repr((SNAPSHOT_VERSION, db._get_database_id(), p.image_table, 
+                     p.object_table, p.table_id, p.image_id, p.object_id, 
+                     sorted(p._groups.items())))
+    
+    def save_snapshot(self):
+        '''
+        Saves the data model to the snapshot file (see get_snapshot_filename)
+        if the datamodel_snapshot property is on. The snapshot is written to
+        a temporary file first so a reader never sees half a snapshot.
+        '''
+        filename = get_snapshot_filename()
+        if p.datamodel_snapshot != 'yes' or filename is None or self.table_dates is None:
+            return
+        key_size = p.table_id and 2 or 1
+        keylist = self.keylist
+        arrays = {'signature' : np.array([self._get_snapshot_signature()]),
+                  'table_dates' : np.array([repr(sorted(self.table_dates.items()))]),
+                  'imkeys' : np.array(keylist, dtype=np.int64).reshape(len(keylist), key_size),
+                  'counts' : np.array([self.data[imKey] for imKey in keylist], dtype=np.int64),
+                  'groups' : np.array(sorted(self.groupMaps.keys()) or [''])}
+        columns = {}
+        for i, group in enumerate(sorted(self.groupMaps.keys())):
+            rows = [imKey + groupKey for groupKey, imKeys in self.revGroupMaps[group].items()
+                    for imKey in imKeys]
+            ncols = key_size + len(self.groupColNames[group])
+            columns['group%d_'%(i)] = zip(*rows) if rows else [[]] * ncols
+            arrays['group%d_colnames'%(i)] = np.array(self.groupColNames[group] or [''])
+            arrays['group%d_ncols'%(i)] = np.array([ncols])
+        if self.wells is not None:
+            columns['wells_'] = [self.wells]
+        for prefix, cols in columns.items():
+            for j, col in enumerate(cols):
+                encoded = encode_column(col)
+                if encoded is None:
+                    logging.debug('Could not save the data model snapshot: column '
+                                  '%d of %s has mixed types.'%(j, prefix[:-1]))
+                    return
+                kind, data, nulls = encoded
+                arrays['%skind%d'%(prefix, j)] = np.array([kind])
+                arrays['%sdata%d'%(prefix, j)] = data
+                arrays['%snulls%d'%(prefix, j)] = nulls
+        tmpname = '%s.%d.tmp'%(filename, os.getpid())
+        try:
+            f = open(tmpname, 'wb')
+            try:
+                # not compressed, for speed
+                np.savez(f, **arrays)
+            finally:
+                f.close()
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmpname, filename)
+        except Exception, e:
+            logging.warn('Could not save the data model snapshot to %s: %s'%(filename, e))
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+    
+    def load_snapshot(self):
+        '''
+        Reads the snapshot file. Returns the arguments for _set_state and
+        True if the tables have been modified since the snapshot was saved
+        (or their modification dates aren't known), or returns None if there
+        is no usable snapshot.
+        '''
+        filename = get_snapshot_filename()
+        if filename is None or not os.path.exists(filename):
+            return None
+        key_size = p.table_id and 2 or 1
+        try:
+            f = np.load(filename)
+            try:
+                if f['signature'][0] != self._get_snapshot_signature():
+                    logging.info('The data model snapshot %s is for a different '
+                                 'database or properties. Ignoring it.'%(filename))
+                    return None
+                imkeys = [tuple(key) for key in f['imkeys'].tolist()]
+                data = dict(zip(imkeys, f['counts'].tolist()))
+                def column(prefix, j):
+                    return decode_column(f['%skind%d'%(prefix, j)][0], 
+                                         f['%sdata%d'%(prefix, j)],
+                                         f['%snulls%d'%(prefix, j)])
+                groups = {}
+                for i, group in enumerate([g for g in f['groups'].tolist() if g]):
+                    ncols = int(f['group%d_ncols'%(i)][0])
+                    col_names = f['group%d_colnames'%(i)].tolist()[:ncols - key_size]
+                    cols = [column('group%d_'%(i), j) for j in range(ncols)]
+                    groups[group] = (zip(*cols), col_names)
+                wells = None
+                if 'wells_kind0' in f.files:
+                    wells = column('wells_', 0)
+                saved_dates = f['table_dates'][0]
+            finally:
+                f.close()
+        except Exception, e:
+            logging.warn('Could not read the data model snapshot %s: %s'%(filename, e))
+            return None
+        if set(groups.keys()) != set(p._groups.keys()):
+            return None
+        table_dates = db.get_table_modify_dates(self._get_snapshot_tables())
+        stale = (None in table_dates.values() or 
+                 saved_dates != repr(sorted(table_dates.items())))
+        if stale:
+            # don't save this state over the snapshot as if it were current
+            table_dates = None
+        return (data, groups, wells, table_dates), stale
 
     def DeleteModel(self):
         self.data = {}
         self.groupMaps = {}
         self.cumSums = []
         self.obCount = 0
+        with self.object_ids_lock:
+            self.object_ids = OrderedDict()
+            self.object_ids_size = 0
         
     def _if_empty_populate(self):
         if self.IsEmpty:
@@ -89,24 +314,8 @@ class DataModel(Singleton):
     def GetRandomObject(self):
         '''
         Returns a random object key
-        We expect self.data.keys() to return the keys in the SAME ORDER
-        every time since we build cumSums from that same ordering.  This
-        need not necessarily be in sorted order.
         '''
-        self._if_empty_populate()
-        obIdx = randint(1, self.obCount)
-        imIdx = np.searchsorted(self.cumSums, obIdx, 'left')
-        # SUBTLETY: images which have zero objects will appear as repeated
-        #    sums in the cumulative array, so we must pick the first index
-        #    of any repeated sum, otherwise we are picking an image with no
-        #    objects
-        while self.cumSums[imIdx] == self.cumSums[imIdx-1]:
-            imIdx -= 1
-        imKey = self.data.keys()[imIdx-1]
-        obIdx = obIdx-self.cumSums[imIdx-1]  # object number relative to this image
-                    
-        obKey = db.GetObjectIDAtIndex(imKey, obIdx)
-        return obKey
+        return self.GetRandomObjects(1)[0]
 
     def GetRandomObjects(self, N, imKeys=None):
         '''
@@ -115,37 +324,65 @@ class DataModel(Singleton):
         objects from only these images.
         '''
         self._if_empty_populate()
-        if imKeys == None:
-            return [self.GetRandomObject() for i in xrange(N)]
+        if imKeys is None:
+            imKeys = self.keylist
+            sums = self.cumSums
         elif imKeys == []:
             return []
         else:
-            sums = np.cumsum([self.data[imKey] for imKey in imKeys])
-            if sums[-1] < 1:
-                return []
-            obs = []
-            for i in xrange(N):
-                obIdx = randint(1, sums[-1])
-                index = np.searchsorted(sums, obIdx, 'left')
-                if index != 0:
-                    while sums[index] == sums[index-1]:
-                        index -= 1
-                    obIdx = obIdx-sums[index-1]
-                obKey = db.GetObjectIDAtIndex(imKeys[index], obIdx)
-                obs.append(obKey)
-            return obs
+            sums = np.zeros(len(imKeys)+1, dtype='int')
+            sums[1:] = np.cumsum([self.data[imKey] for imKey in imKeys])
+        if sums[-1] < 1:
+            return []
+        # Draw all the object numbers at once and find the image each one 
+        # falls in. sums[i] is the number of objects in the images before 
+        # image i, so images with no objects are never picked.
+        obIdxs = np.random.randint(1, sums[-1] + 1, N)
+        imIdxs = np.searchsorted(sums, obIdxs, 'left') - 1
+        obIdxs -= sums[imIdxs]   # object number relative to its image
+        obIDs = self.GetObjectIDsFromImages([imKeys[i] for i in set(imIdxs.tolist())])
+        obs = []
+        for imIdx, obIdx in zip(imIdxs.tolist(), obIdxs.tolist()):
+            imKey = tuple(imKeys[imIdx])
+            if obIdx > len(obIDs[imKey]):
+                logging.warn('Image %s has fewer objects than expected. The '
+                             'data model may be out of date.'%(imKey,))
+                continue
+            obs.append(imKey + (int(obIDs[imKey][obIdx - 1]),))
+        return obs
+    
+    def GetObjectIDsFromImages(self, imKeys):
+        '''
+        Returns a dict mapping each of the given image keys to a sorted array
+        of the IDs of the objects in that image. IDs are kept in an LRU cache
+        so images that were seen before don't have to be read again.
+        '''
+        imKeys = set([tuple(imKey) for imKey in imKeys])
+        obIDs = {}
+        with self.object_ids_lock:
+            for imKey in imKeys:
+                if imKey in self.object_ids:
+                    obIDs[imKey] = self.object_ids.pop(imKey)
+                    self.object_ids[imKey] = obIDs[imKey]
+        missing = imKeys.difference(obIDs.keys())
+        if missing:
+            fetched = db.GetObjectIDsFromImages(list(missing))
+            obIDs.update(fetched)
+            with self.object_ids_lock:
+                for imKey, ids in fetched.items():
+                    if imKey not in self.object_ids:
+                        self.object_ids[imKey] = ids
+                        self.object_ids_size += len(ids)
+                while self.object_ids_size > OBJECT_ID_CACHE_SIZE:
+                    imKey, ids = self.object_ids.popitem(last=False)
+                    self.object_ids_size -= len(ids)
+        return obIDs
             
     def GetObjectsFromImage(self, imKey):
         self._if_empty_populate()
-        obKeys=[]
-        for i in xrange(1,self.GetObjectCountFromImage(imKey)+1):
-            obKeys.append(db.GetObjectIDAtIndex(imKey, i))
-        return obKeys
-        # JK - The above code was previously removed in favor of the code below.
-        # However the new code is sensitive to objects not having consecutive IDs 
-        # in an image, whereas the above code is not making it more robust
-#        return [tuple(list(imKey) + [i]) 
-#                for i in xrange(1, self.GetObjectCountFromImage(imKey) + 1)]
+        imKey = tuple(imKey)
+        return [imKey + (int(obID),) 
+                for obID in self.GetObjectIDsFromImages([imKey])[imKey]]
     
     def GetAllImageKeys(self, filter_name=None):
         ''' Returns all object keys. If a filter is passed in, only the image
@@ -262,19 +499,21 @@ class DataModel(Singleton):
         
         pshape = p.plate_shape
         
-        res = db.execute('SELECT DISTINCT %s FROM %s '%(p.well_id, p.image_table))
-        for r in res:
-            well = r[0]
+        if self.wells is None:
+            res = db.execute('SELECT DISTINCT %s FROM %s '%(p.well_id, p.image_table))
+            self.wells = [r[0] for r in res]
+            self.save_snapshot()
+        for well in self.wells:
             # Make sure all well entries match the naming format
             if type(well) == str:
-                assert re.match(well_re, well), 'Well "%s" did not match well naming format "%s"'%(r[0], p.well_format)
+                assert re.match(well_re, well), 'Well "%s" did not match well naming format "%s"'%(well, p.well_format)
             elif type(well) in [int, long]:
                 if not p.well_format == '123':
                     import wx
                     wx.MessageBox('Well "%s" did not match well naming format "%s".\n'
                                   'If your wells are in numerical format then add\n'
                                   'the line "well_format = 123" to your properties'
-                                  'file. Trying well_format = 123.'%(r[0], p.well_format), 'Error')
+                                  'file. Trying well_format = 123.'%(well, p.well_format), 'Error')
                     p.well_format = '123'
                     self.populate_plate_maps()
                     return
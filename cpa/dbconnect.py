@@ -1,8 +1,12 @@
+from __future__ import with_statement
 import decimal
 import types
 import random
 from properties import Properties
 from singleton import Singleton
+import sqliteudfs
+import boxstats
+import queryprofiler
 from sys import stderr
 import exceptions
 import numpy as np
@@ -10,11 +14,15 @@ import logging
 import string
 import sys
 import threading
+import thread
+import Queue
+import time
 import traceback
 import re
 import os.path
 import logging
 import copy
+import itertools
 # This module should be usable on systems without wx.
 
 verbose = True
@@ -49,25 +57,352 @@ def DBOperationalError():
         return sqlite3.OperationalError
 
 
+class DBQueryCancelledException(DBException):
+    '''Raised for queries that were cancelled (see QueryFuture.cancel).'''
+
+
 class DBDisconnectedException(Exception):
     """
     Raised when a query or other database operation fails because the
-    database is shutting down or the connection has been lost.
+    database is shutting down or the connection has been lost, and a fresh
+    connection could not be used in its place.
     """
-    def with_mysql_retry(cls, f):
-        """
-        Decorator that tries calling its function a second time if a
-        DBDisconnectedException occurs the first time.
-        """
-        def fn(db, *args, **kwargs):
+
+# MySQL error codes meaning the connection is gone:
+# 2006 (server has gone away), 2013 (lost connection), 1053 (server shutdown)
+MYSQL_DISCONNECT_ERRORS = [2006, 2013, 1053]
+MYSQL_SERVER_GONE_ERROR = 2006
+
+def get_connection_id():
+    '''Returns the ID used to key the current thread's database connection.
+    Thread names are not unique, so the thread ident is included.'''
+    t = threading.currentThread()
+    return '%s-%s'%(t.getName(), thread.get_ident())
+
+
+class ConnectionPool(object):
+    '''
+    A bounded pool of database connections.
+    Connections are checked out for the exclusive use of one thread and
+    checked back in when that thread is done with them. Idle connections are
+    health-checked before they are handed out again and are replaced if they
+    have gone bad. When max_size connections are in use, checkout blocks for
+    up to timeout seconds waiting for one to be checked in.
+    '''
+    def __init__(self, create, ping, max_size=10, timeout=60, reclaim=None):
+        '''
+        create -- function returning a new connection
+        ping -- function taking a connection that raises an exception if the
+                connection is no longer usable
+        reclaim -- optional function called periodically while waiting for a
+                   connection, to check in connections that were abandoned
+        '''
+        self.create = create
+        self.ping = ping
+        self.reclaim = reclaim
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+        self.stats = {'created'   : 0,
+                      'checkouts' : 0,
+                      'checkins'  : 0,
+                      'reconnects': 0,
+                      'discarded' : 0,
+                      'waits'     : 0,
+                      }
+
+    def checkout(self, timeout=None):
+        '''Returns a healthy connection, creating one if the pool has room.
+        timeout -- seconds to wait for a free connection instead of the 
+                   pool's timeout
+        '''
+        if timeout is None:
+            timeout = self.timeout
+        start = time.time()
+        while True:
+            self._cond.acquire()
+            try:
+                if self._idle or self._size < self.max_size:
+                    self.stats['checkouts'] += 1
+                    if self._idle:
+                        conn = self._idle.pop()
+                    else:
+                        conn = None
+                        self._size += 1
+                    break
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    raise DBException('Timed out waiting for a database connection. '
+                                      'All %d connections in the pool are in use.'
+                                      %(self.max_size))
+                self.stats['waits'] += 1
+                self._cond.wait(min(remaining, 1.0))
+            finally:
+                self._cond.release()
+            if self.reclaim:
+                self.reclaim()
+
+        if conn is not None:
+            try:
+                self.ping(conn)
+                return conn
+            except Exception, e:
+                logging.info('Pooled database connection failed health check; reconnecting. (%s)'%(e))
+                self._close(conn)
+                self.stats['reconnects'] += 1
+        try:
+            conn = self.create()
+        except:
+            self._release_slot()
+            raise
+        self.stats['created'] += 1
+        return conn
+
+    def checkin(self, conn):
+        '''Returns a connection to the pool.'''
+        self._cond.acquire()
+        try:
+            self.stats['checkins'] += 1
+            self._idle.append(conn)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def discard(self, conn):
+        '''Closes a checked out connection and frees its slot in the pool.'''
+        self._close(conn)
+        self.stats['discarded'] += 1
+        self._release_slot()
+
+    def reconnect(self, conn):
+        '''Replaces a broken checked out connection with a new one.'''
+        self._close(conn)
+        self.stats['reconnects'] += 1
+        try:
+            conn = self.create()
+        except:
+            self._release_slot()
+            raise
+        self.stats['created'] += 1
+        return conn
+
+    def close_idle(self):
+        '''Closes all idle connections.'''
+        self._cond.acquire()
+        try:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        for conn in idle:
+            self._close(conn)
+
+    def get_stats(self):
+        '''Returns a dict of pool statistics.'''
+        self._cond.acquire()
+        try:
+            stats = dict(self.stats)
+            stats['max_size'] = self.max_size
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._size - len(self._idle)
+        finally:
+            self._cond.release()
+        return stats
+
+    def _release_slot(self):
+        self._cond.acquire()
+        try:
+            self._size -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+# Number of threads that run the queries given to DBConnect.submit
+QUERY_WORKERS = 2
+
+class QueryFuture(object):
+    '''
+    The pending result of a query run in the background by DBConnect.submit.
+    '''
+    def __init__(self, db, query, method, kwargs):
+        self.query = query
+        self._db = db
+        self._method = method
+        self._kwargs = kwargs
+        self._state = 'pending'      # pending, running, cancelled or done
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._connID = None
+        self._interrupting = None    # set by cancel once the interrupt is sent
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+
+    def cancel(self):
+        '''
+        Cancels the query. A query that hasn't started yet is never run, and
+        a running query is interrupted on the database. Returns False if the
+        query had already finished.
+        '''
+        with self._lock:
+            if self._state == 'done':
+                return False
+            if self._state == 'cancelled':
+                return True
+            was_running = self._state == 'running'
+            self._state = 'cancelled'
+            connID = self._connID
+            if was_running:
+                self._interrupting = threading.Event()
+        if was_running:
+            # NOTE: the worker waits for _interrupting before it moves on to 
+            #       another query on the same connection, so the interrupt
+            #       can't hit the wrong query.
             try:
-                return f(db, *args, **kwargs)
-            except DBDisconnectedException:
-                logging.info('Lost connection to the MySQL database; reconnecting.')
-                db.connect()
-                return f(db, *args, **kwargs)
-        return fn
-    with_mysql_retry = classmethod(with_mysql_retry)
+                self._db._interrupt(connID)
+            except Exception, e:
+                logging.error('Could not interrupt query: %s'%(e))
+            finally:
+                self._interrupting.set()
+        else:
+            self._set_exception(DBQueryCancelledException('Query was cancelled.'))
+        return True
+
+    def cancelled(self):
+        return self._state == 'cancelled'
+
+    def done(self):
+        '''Returns whether the query has finished or been cancelled.'''
+        return self._finished.isSet()
+
+    def result(self, timeout=None):
+        '''
+        Waits for the query to finish and returns what the DBConnect method
+        returned. Raises DBQueryCancelledException if the query was 
+        cancelled, or whatever exception the query raised.
+        '''
+        self._finished.wait(timeout)
+        if not self._finished.isSet():
+            raise DBException('Timed out waiting for query.')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        '''Waits for the query to finish and returns the exception it raised,
+        or None.'''
+        self._finished.wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, fn):
+        '''
+        Calls fn(future) when the query finishes or is cancelled, or right
+        away if it already has. NOTE: fn is usually called from a worker
+        thread, so GUI code must pass the result to the main thread (see
+        guiutils.BackgroundQuery).
+        '''
+        with self._lock:
+            if not self._finished.isSet():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _run(self):
+        '''Runs the query on the current (worker) thread.'''
+        with self._lock:
+            if self._state != 'pending':
+                return
+            self._state = 'running'
+            self._connID = get_connection_id()
+            self._db.interrupted.discard(self._connID)
+        try:
+            result = getattr(self._db, self._method)(self.query, **self._kwargs)
+            exception = None
+        except Exception, e:
+            result, exception = None, e
+        with self._lock:
+            if self._state == 'cancelled':
+                result, exception = None, DBQueryCancelledException('Query was cancelled.')
+            else:
+                self._state = 'done'
+            interrupting = self._interrupting
+        if interrupting is not None:
+            interrupting.wait()
+        self._db.interrupted.discard(self._connID)
+        if exception is not None:
+            self._set_exception(exception)
+        else:
+            self._set_result(result)
+
+    def _set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def _set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._finished.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logging.error('Error in query callback:\n%s'%(traceback.format_exc()))
+
+
+class QueryWorker(threading.Thread):
+    '''Runs QueryFutures from a queue, using its own database connection.
+    A None in the queue stops the worker, which then returns its connection
+    to the pool.'''
+    def __init__(self, queue):
+        threading.Thread.__init__(self)
+        self.setName('QueryWorker_%s'%(self.getName()))
+        self.setDaemon(True)
+        self.queue = queue
+        self.start()
+
+    def run(self):
+        while True:
+            future = self.queue.get()
+            if future is None:
+                db = DBConnect.getInstance()
+                if get_connection_id() in db.connections:
+                    db.CloseConnection()
+                return
+            future._run()
+
+class ParallelQueryWorker(QueryWorker):
+    '''A QueryWorker for DBConnect.execute_parallel. It checks out its 
+    connection before taking any queries, without waiting for one, and if 
+    the pool has none free it stops right away and puts None in the stopped
+    queue, leaving the queries to the other workers.'''
+    def __init__(self, queue, stopped):
+        self.stopped = stopped
+        QueryWorker.__init__(self, queue)
+
+    def run(self):
+        try:
+            DBConnect.getInstance().connect(timeout=0)
+        except DBException, e:
+            logging.info('[%s] No free connection for parallel queries: %s'
+                         %(get_connection_id(), e))
+            self.stopped.put(None)
+            return
+        QueryWorker.run(self)
 
 def sqltype_to_pythontype(t):
     '''
@@ -87,6 +422,238 @@ def sqltype_to_pythontype(t):
           t.startswith('NVARCHAR') or t in ['TEXT', 'CLOB']):
         return str
     
+def _column_dtype(pytype):
+    '''returns the numpy dtype used to hold a column of the given python type
+    '''
+    if pytype is int:
+        return np.int64
+    elif pytype is float:
+        return np.float64
+    else:
+        return object
+
+def _structured_array(col_names, columns):
+    '''returns a numpy structured array with the given columns'''
+    # Structured array field names must be unique
+    names = []
+    for col in col_names:
+        name = col
+        while name in names:
+            name += '_'
+        names.append(name)
+    sarray = np.empty(len(columns[0]) if columns else 0,
+                      dtype=[(name, c.dtype) for name, c in zip(names, columns)])
+    for name, c in zip(names, columns):
+        sarray[name] = c
+    return sarray
+
+def _typed_column(values, pytype=None):
+    '''
+    values -- a 1-d object array of values fetched from the database
+    pytype -- the python type of the column (from sqltype_to_pythontype) or
+              None if it should be inferred from the values
+    returns values converted to an array of the appropriate dtype. NULLs in
+    numeric columns are converted to NaN.
+    '''
+    if pytype not in (int, float, None):
+        return values
+    nulls = np.equal(values, None)
+    try:
+        if nulls.any():
+            filled = values.copy()
+            filled[nulls] = np.nan
+            return filled.astype(np.float64)
+        if pytype is not None:
+            return values.astype(_column_dtype(pytype))
+    except (ValueError, TypeError, decimal.InvalidOperation):
+        # SQLite doesn't enforce column types, so fall back on the data
+        pass
+    inferred = np.array(values.tolist())
+    if inferred.dtype.kind in 'biuf':
+        return inferred
+    if inferred.dtype == object:
+        # eg: MySQL DECIMAL values
+        try:
+            return values.astype(np.float64)
+        except (ValueError, TypeError, decimal.InvalidOperation):
+            pass
+    return values
+
+# Axis scales for the histograms computed in the database
+LINEAR_SCALE = 'linear'
+LOG_SCALE    = 'log'
+LOG2_SCALE   = 'log2'
+
+def _to_scale(values, scale):
+    '''maps values in data units to the given scale'''
+    if scale == LOG_SCALE:
+        return np.log10(values)
+    elif scale == LOG2_SCALE:
+        return np.log2(values)
+    return values
+
+def _from_scale(values, scale):
+    '''maps values in the given scale back to data units'''
+    if scale == LOG_SCALE:
+        return 10.0 ** values
+    elif scale == LOG2_SCALE:
+        return 2.0 ** values
+    return values
+
+
+# Size of the pieces CSV files are split into for parsing when creating a
+# SQLite database from ExportToDatabase output
+CSV_CHUNK_BYTES = 16 * 1024 * 1024
+# Most chunks being parsed or waiting to be written at once, so memory use
+# doesn't grow with the number of cores
+CSV_MAX_PENDING_CHUNKS = 8
+# Number of rows used to infer column types and number of rows inserted at
+# a time when creating a SQLite database from image_csv_file/object_csv_file
+CSV_SAMPLE_ROWS = 10000
+CSV_BATCH_ROWS = 10000
+
+def _csv_value_converter(pytype):
+    '''returns a function that converts a csv string to the given python type
+    (as returned by sqltype_to_pythontype). Empty strings become NULL.'''
+    if pytype is int:
+        def convert(v):
+            try:
+                return int(v)
+            except ValueError:
+                if v == '':
+                    return None
+                try:
+                    return float(v)
+                except ValueError:
+                    return v
+    elif pytype is float:
+        def convert(v):
+            try:
+                return float(v)
+            except ValueError:
+                if v == '':
+                    return None
+                return v
+    else:
+        def convert(v):
+            return v
+    return convert
+
+# Matches the characters csv_record_offsets looks for
+_CSV_QUOTE_OR_EOL = re.compile(r'["\r\n]')
+
+def csv_record_offsets(filename, chunk_bytes):
+    '''
+    Returns the offsets at which to split a csv file into pieces of about
+    chunk_bytes for parse_csv_range, starting with 0. Each offset follows a
+    line break that isn't inside a quoted field, so no record is split.
+    This reads the whole file, but only counts quotes between split points.
+    '''
+    offsets = [0]
+    target = chunk_bytes
+    in_quotes = False
+    pos = 0
+    f = open(filename, 'rb')
+    try:
+        while True:
+            block = f.read(CSV_CHUNK_BYTES)
+            if not block:
+                break
+            i = 0
+            while i < len(block):
+                if pos + i < target:
+                    # skip ahead to the next split point
+                    j = min(target - pos, len(block))
+                    if block.count('"', i, j) % 2:
+                        in_quotes = not in_quotes
+                    i = j
+                    continue
+                m = _CSV_QUOTE_OR_EOL.search(block, i)
+                if m is None:
+                    break
+                if m.group() == '"':
+                    in_quotes = not in_quotes
+                elif not in_quotes:
+                    offsets.append(pos + m.end())
+                    target = pos + m.end() + chunk_bytes
+                i = m.end()
+            pos += len(block)
+    finally:
+        f.close()
+    if offsets[-1] >= pos > 0:
+        offsets.pop()
+    return offsets
+
+def parse_csv_range(args):
+    '''
+    Parses the records of a csv file in a range of bytes that starts and ends
+    on record boundaries (see csv_record_offsets).
+    args -- (filename, start, end, coltypes) where coltypes is a list of python
+            types for the columns (see sqltype_to_pythontype)
+    returns a tuple (rows, nbytes) where rows is a list of tuples of typed
+    values and nbytes is the size of the range.
+    NOTE: this is run in worker processes, so it must be picklable and can't
+          touch the database.
+    '''
+    import csv
+    filename, start, end, coltypes = args
+    converters = [_csv_value_converter(t) for t in coltypes]
+    f = open(filename, 'rb')
+    try:
+        f.seek(start)
+        data = f.read(end - start)
+    finally:
+        f.close()
+    # splitlines handles '\n', '\r\n' and '\r' line endings
+    rows = [tuple([conv(v) for conv, v in zip(converters, row)])
+            for row in csv.reader(data.splitlines(True)) if len(row) > 0]
+    return rows, end - start
+
+# Matches statements that modify the database (see DBConnect._note_write)
+WRITE_QUERY = re.compile(r'\s*(INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER|'
+                         r'RENAME|TRUNCATE|LOAD)\b', re.IGNORECASE)
+
+# Default number of rows sent to the database per statement by bulk_insert
+INSERT_BATCH_ROWS = 1000
+
+_is_nonfinite = np.frompyfunc(
+    lambda v: isinstance(v, (float, np.floating)) and (np.isnan(v) or np.isinf(v)), 1, 1)
+
+def _insert_values(chunk):
+    '''
+    Converts a 2D array of rows into a list of tuples of native python values
+    suitable for a parameterized insert. NaN and inf values become None (NULL),
+    but strings such as "nan" are kept as they are.
+    '''
+    cols = []
+    for col in chunk.T:
+        if col.dtype.kind == 'f':
+            vals = np.where(np.isfinite(col), col.astype(object), None)
+        elif col.dtype.kind == 'O':
+            vals = np.where(_is_nonfinite(col).astype(bool), None, col)
+            vals = [v.item() if isinstance(v, np.generic) else v for v in vals]
+        else:
+            vals = col.tolist()
+        cols.append(vals)
+    return zip(*cols)
+
+def _insert_batches(rows, batch_size):
+    '''
+    Splits rows (a 2D numpy array or an iterable of row sequences) into lists
+    of at most batch_size insertable tuples (see _insert_values).
+    '''
+    if isinstance(rows, np.ndarray):
+        for start in xrange(0, len(rows), batch_size):
+            yield _insert_values(rows[start:start+batch_size])
+    else:
+        import itertools
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, batch_size))
+            if len(chunk) == 0:
+                break
+            yield _insert_values(np.array(chunk, dtype=object))
+
 #TODO: this doesn't belong in this module
 def get_data_table_from_csv_reader(reader):
     '''reads a csv table into a 2d list'''
@@ -178,15 +745,16 @@ def GetWhereClauseForObjects(obkeys, table_name=None):
 
     return split(obkeys,table_name)
 
-def GetWhereClauseForImages(imkeys):
+def GetWhereClauseForImages(imkeys, table_name=None):
     '''
     Return a SQL WHERE clause that matches any of the given image keys.
     Example: GetWhereClauseForImages([(3,), (4,)]) => 
              "(ImageNumber IN (3, 4))"
     '''
     imkeys.sort()
+    key_cols = image_key_columns(table_name)
     if not p.table_id:
-        return '%s IN (%s)'%(p.image_id, ','.join([str(k[0]) for k in imkeys]))
+        return '%s IN (%s)'%(key_cols[0], ','.join([str(k[0]) for k in imkeys]))
     else:
         imkeys = np.array(imkeys)
         count = 0
@@ -196,8 +764,8 @@ def GetWhereClauseForImages(imkeys):
             imnums = imkeys[(imkeys[:,0]==tnum), 1]
             count += len(imnums)
             if len(imnums)>0:
-                wheres += ['(%s=%s AND %s IN (%s))'%(p.table_id, tnum, 
-                            p.image_id, ','.join([str(k) for k in imnums]))]
+                wheres += ['(%s=%s AND %s IN (%s))'%(key_cols[0], tnum, 
+                            key_cols[1], ','.join([str(k) for k in imnums]))]
             tnum += 1
         return ' OR '.join(wheres)
 
@@ -258,6 +826,24 @@ def get_csv_filenames_from_sql_file():
     return imcsvs, obcsvs
 
 
+# Path (less the platform's shared library suffix) of the compiled SQLite 
+# extension built from sqlite_plugins/classify.c
+SQLITE_CLASSIFIER_EXTENSION = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                           'sqlite_plugins', 'classify')
+
+def stump_model_string(thresholds, a, b):
+    '''
+    Returns the model argument for the stump_classifier() SQL function in
+    sqlite_plugins/classify.c.
+    thresholds -- array of stump thresholds
+    a, b -- (num_stumps x num_classes) arrays of the class weights for when a 
+            feature is above or not above its threshold
+    '''
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    values = np.hstack((np.asarray(thresholds, dtype=float), a.flatten(), b.flatten()))
+    return '%d %d %s'%(a.shape[0], a.shape[1], ' '.join(['%.17g'%(v) for v in values]))
+
 class SqliteClassifier():
     def __init__(self):
         pass
@@ -279,138 +865,108 @@ class DBConnect(Singleton):
     '''
     DBConnect abstracts calls to MySQLdb/SQLite. It's a singleton that maintains
     unique connections for each thread that uses it.  These connections are 
-    automatically created on "execute", and results are automatically returned
-    as a list.
+    automatically checked out of a bounded connection pool on "execute", and
+    results are automatically returned as a list.
+    The pool size is set by the db_pool_size property (default 10).
     '''
     def __init__(self):
         self.classifierColNames = None
         self.connections = {}
         self.cursors = {}
         self.connectionInfo = {}
+        self.connectionOwners = {}   # threads that checked out each connection
+        self.pool = None
+        self.query_cache = None      # see execute_cached
+        self.query_profiler = None   # see get_query_profile
+        self.pending_profiles = {}   # results being fetched, by connID
+        self.query_queue = None      # see submit
+        self.query_workers = []
+        self.interrupted = set()     # connIDs whose query has been cancelled
+        self._table_names = None
         #self.link_cols = {}  # link_cols['table'] = columns that link 'table' to the per-image table
         self.sqlite_classifier = SqliteClassifier()
+        self.sqlite_classifier_extension = False  # was classify.c loaded
         self.gui_parent = None
 
     def __str__(self):
         return string.join([ (key + " = " + str(val) + "\n")
                             for (key, val) in self.__dict__.items()])
             
-    def connect(self, empty_sqlite_db=False):
+    def connect(self, empty_sqlite_db=False, timeout=None):
         '''
-        Attempts to create a new connection to the specified database using
-          the current thread name as a connection ID.
+        Checks a connection out of the connection pool for the current thread.
+          The connection is held until CloseConnection is called from this
+          thread, or until the thread exits.
+        timeout -- seconds to wait if all the pooled connections are in use
+                   (default: the pool's timeout)
         If properties.db_type is 'sqlite', it will create a sqlite db in a
           temporary directory from the csv files specified by
           properties.image_csv_file and properties.object_csv_file
         '''
-        connID = threading.currentThread().getName()
+        connID = get_connection_id()
         
         logging.info('[%s] Connecting to the database...'%(connID))
-        # If this connection ID already exists print a warning
+        # If this thread already has a connection there's nothing to do
         if connID in self.connections.keys():
-            if self.connectionInfo[connID] == (p.db_host, p.db_user, 
-                                               (p.db_passwd or None), p.db_name):
+            if self.connectionInfo[connID] == self._get_connection_info():
                 logging.warn('A connection already exists for this thread. %s as %s@%s (connID = "%s").'%(p.db_name, p.db_user, p.db_host, connID))
+                return
             else:
                 raise DBException, 'A connection already exists for this thread (%s). Close this connection first.'%(connID,)
 
-        # MySQL database: connect normally
-        if p.db_type.lower() == 'mysql':
-            import MySQLdb
-            from MySQLdb.cursors import SSCursor
+        if p.db_type.lower() not in ['mysql', 'sqlite']:
+            # Unknown database type (this should never happen)
+            raise DBException, "Unknown db_type in properties: '%s'\n"%(p.db_type)
+
+        if p.db_type.lower() == 'sqlite' and not p.db_sqlite_file:
+            # Compute a UNIQUE database name for these files
+            import md5
+            dbpath = os.getenv('USERPROFILE') or os.getenv('HOMEPATH') or \
+                os.path.expanduser('~')
+            dbpath = os.path.join(dbpath,'CPA')
             try:
-                conn = MySQLdb.connect(host=p.db_host, db=p.db_name, 
-                                       user=p.db_user, passwd=(p.db_passwd or None))
-                self.connections[connID] = conn
-                self.cursors[connID] = SSCursor(conn)
-                self.connectionInfo[connID] = (p.db_host, p.db_user, 
-                                               (p.db_passwd or None), p.db_name)
-                logging.debug('[%s] Connected to database: %s as %s@%s'%(connID, p.db_name, p.db_user, p.db_host))
-            except DBError(), e:
-                raise DBException, 'Failed to connect to database: %s as %s@%s (connID = "%s").\n  %s'%(p.db_name, p.db_user, p.db_host, connID, e)
-            
+                os.listdir(dbpath)
+            except OSError:
+                os.mkdir(dbpath)
+            if p.db_sql_file:
+                csv_dir = os.path.split(p.db_sql_file)[0] or '.'
+                imcsvs, obcsvs = get_csv_filenames_from_sql_file()
+                files = imcsvs + obcsvs + [os.path.split(p.db_sql_file)[1]]
+                hash = md5.new()
+                for fname in files:
+                    t = os.stat(csv_dir + os.path.sep + fname).st_mtime
+                    hash.update('%s%s'%(fname,t))
+                dbname = 'CPA_DB_%s.db'%(hash.hexdigest())
+            else:
+                imtime = os.stat(p.image_csv_file).st_mtime
+                obtime = os.stat(p.object_csv_file).st_mtime
+                l = '%s%s%s%s'%(p.image_csv_file,p.object_csv_file,imtime,obtime)
+                dbname = 'CPA_DB_%s.db'%(md5.md5(l).hexdigest())
+                
+            p.db_sqlite_file = os.path.join(dbpath, dbname)
+
+        # Give back connections held by threads that have since exited
+        self._release_dead_threads()
+        if self.pool is None:
+            self.pool = ConnectionPool(self._create_connection, 
+                                       self._ping_connection,
+                                       max_size=int(p.db_pool_size or 10),
+                                       reclaim=self._release_dead_threads)
+        try:
+            conn = self.pool.checkout(timeout)
+        except DBError(), e:
+            raise DBException, 'Failed to connect to database: %s as %s@%s (connID = "%s").\n  %s'%(p.db_name, p.db_user, p.db_host, connID, e)
+        self.connections[connID] = conn
+        self.cursors[connID] = self._create_cursor(conn)
+        self.connectionInfo[connID] = self._get_connection_info()
+        self.connectionOwners[connID] = threading.currentThread()
+
+        if p.db_type.lower() == 'mysql':
+            logging.debug('[%s] Connected to database: %s as %s@%s'%(connID, p.db_name, p.db_user, p.db_host))
+
         # SQLite database: create database from CSVs
         elif p.db_type.lower() == 'sqlite':
-            import sqlite3 as sqlite
-            
-            if not p.db_sqlite_file:
-                # Compute a UNIQUE database name for these files
-                import md5
-                dbpath = os.getenv('USERPROFILE') or os.getenv('HOMEPATH') or \
-                    os.path.expanduser('~')
-                dbpath = os.path.join(dbpath,'CPA')
-                try:
-                    os.listdir(dbpath)
-                except OSError:
-                    os.mkdir(dbpath)
-                if p.db_sql_file:
-                    csv_dir = os.path.split(p.db_sql_file)[0] or '.'
-                    imcsvs, obcsvs = get_csv_filenames_from_sql_file()
-                    files = imcsvs + obcsvs + [os.path.split(p.db_sql_file)[1]]
-                    hash = md5.new()
-                    for fname in files:
-                        t = os.stat(csv_dir + os.path.sep + fname).st_mtime
-                        hash.update('%s%s'%(fname,t))
-                    dbname = 'CPA_DB_%s.db'%(hash.hexdigest())
-                else:
-                    imtime = os.stat(p.image_csv_file).st_mtime
-                    obtime = os.stat(p.object_csv_file).st_mtime
-                    l = '%s%s%s%s'%(p.image_csv_file,p.object_csv_file,imtime,obtime)
-                    dbname = 'CPA_DB_%s.db'%(md5.md5(l).hexdigest())
-                    
-                p.db_sqlite_file = os.path.join(dbpath, dbname)
             logging.info('[%s] SQLite file: %s'%(connID, p.db_sqlite_file))
-            self.connections[connID] = sqlite.connect(p.db_sqlite_file)
-            self.connections[connID].text_factory = str
-            self.cursors[connID] = self.connections[connID].cursor()
-            self.connectionInfo[connID] = ('sqlite', 'cpa_user', '', 'CPA_DB')
-            self.connections[connID].create_function('greatest', -1, max)
-            # Create MEDIAN function
-            class median:
-                def __init__(self):
-                    self.reset()
-                def reset(self):
-                    self.values = []
-                def step(self, val):
-                    if val is not None:
-                        if not np.isnan(float(val)):
-                            self.values.append(float(val))
-                def finalize(self):
-                    n = len(self.values)
-                    if n == 0:
-                        return None
-                    self.values.sort()
-                    if n%2 == 1:
-                        return self.values[n//2]
-                    else:
-                        return (self.values[n//2-1] + self.values[n//2]) / 2
-            self.connections[connID].create_aggregate('median', 1, median)
-            # Create STDDEV function
-            class stddev:
-                def __init__(self):
-                    self.reset()
-                def reset(self):
-                    self.values = []
-                def step(self, val):
-                    if val is not None:
-                        if not np.isnan(float(val)):
-                            self.values.append(float(val))
-                def finalize(self):
-                    if len(self.values) == 0:
-                        return None
-                    avg = np.mean(self.values)
-                    b = np.sum([(x-avg)**2 for x in self.values])
-                    std = np.sqrt(b/len(self.values))
-                    return std
-            self.connections[connID].create_aggregate('stddev', 1, stddev)
-            # Create REGEXP function
-            def regexp(expr, item):
-                reg = re.compile(expr)
-                return reg.match(item) is not None
-            self.connections[connID].create_function("REGEXP", 2, regexp)
-            # Create classifier function
-            self.connections[connID].create_function('classifier', -1, self.sqlite_classifier.classify)
-            
             try:
                 # Try the connection
                 if empty_sqlite_db:
@@ -439,44 +995,170 @@ class DBConnect(Singleton):
                     else:
                         raise DBException, 'Database at %s appears to be empty.'%(p.db_sqlite_file)
             logging.debug('[%s] Connected to database: %s'%(connID, p.db_sqlite_file))
-        # Unknown database type (this should never happen)
+
+    def _get_connection_info(self):
+        if p.db_type.lower() == 'sqlite':
+            return ('sqlite', 'cpa_user', '', 'CPA_DB')
+        return (p.db_host, p.db_user, (p.db_passwd or None), p.db_name)
+
+    def _create_connection(self):
+        '''Opens a new connection to the database in the properties. Used by
+        the connection pool.'''
+        if p.db_type.lower() == 'mysql':
+            import MySQLdb
+            return MySQLdb.connect(host=p.db_host, db=p.db_name, 
+                                   user=p.db_user, passwd=(p.db_passwd or None))
+
+        import sqlite3 as sqlite
+        # Pooled connections may be handed from one thread to another, but
+        # the pool guarantees only one thread uses a connection at a time.
+        conn = sqlite.connect(p.db_sqlite_file, check_same_thread=False)
+        conn.text_factory = str
+        conn.create_function('greatest', -1, max)
+        # MEDIAN, STDDEV, REGEXP and quantile functions
+        sqliteudfs.register(conn, int(p.sqlite_median_sample_size or 0))
+        # Create classifier function
+        conn.create_function('classifier', -1, self.sqlite_classifier.classify)
+        # Use the compiled classifier if it has been built
+        self.sqlite_classifier_extension = self._load_sqlite_extension(
+                                              conn, SQLITE_CLASSIFIER_EXTENSION)
+        return conn
+
+    def _load_sqlite_extension(self, conn, path):
+        '''Loads the compiled SQLite extension at path (without its suffix) 
+        into the connection. Returns whether it could be loaded.'''
+        if not any([os.path.exists(path + ext) for ext in ['.so', '.dylib', '.dll']]):
+            return False
+        try:
+            conn.enable_load_extension(True)
+            try:
+                conn.load_extension(path)
+            finally:
+                conn.enable_load_extension(False)
+        except Exception, e:
+            # Not all builds of python's sqlite3 module can load extensions
+            logging.debug('Could not load SQLite extension "%s": %s'%(path, e))
+            return False
+        return True
+
+    def _ping_connection(self, conn):
+        '''Raises an exception if the given connection is no longer usable.'''
+        if p.db_type.lower() == 'mysql':
+            conn.ping()
         else:
-            raise DBException, "Unknown db_type in properties: '%s'\n"%(p.db_type)
+            conn.execute('select 1').fetchall()
+
+    def _create_cursor(self, conn):
+        if p.db_type.lower() == 'mysql':
+            from MySQLdb.cursors import SSCursor
+            return SSCursor(conn)
+        return conn.cursor()
+
+    def _release_dead_threads(self):
+        '''Checks connections held by threads that have exited back into the
+        pool.'''
+        for connID, owner in self.connectionOwners.items():
+            if not owner.isAlive():
+                logging.debug('Releasing connection held by exited thread "%s".'%(connID))
+                self.CloseConnection(connID)
+
+    def _reconnect(self, connID):
+        '''Replaces the connection for connID with a fresh one from the pool
+        and returns its cursor. If no new connection can be made, connID is
+        left without a connection, since its slot in the pool was freed.'''
+        try:
+            conn = self.pool.reconnect(self.connections[connID])
+        except:
+            self.connections.pop(connID, None)
+            self.cursors.pop(connID, None)
+            self.connectionInfo.pop(connID, None)
+            self.connectionOwners.pop(connID, None)
+            raise
+        self.connections[connID] = conn
+        self.cursors[connID] = self._create_cursor(conn)
+        return self.cursors[connID]
+
+    def get_pool_stats(self):
+        '''Returns a dict of connection pool statistics: max_size, size,
+        idle, in_use, and running totals of connections created, checkouts,
+        checkins, reconnects, discarded connections, and waits for a free
+        connection.'''
+        if self.pool is None:
+            return {}
+        return self.pool.get_stats()
 
     def setup_sqlite_classifier(self, thresh, a, b):
         self.sqlite_classifier.setup_classifier(thresh, a, b)
 
+    def has_sqlite_classifier_extension(self):
+        '''Returns whether the stump_classifier() SQL function compiled from
+        sqlite_plugins/classify.c is available.'''
+        if not get_connection_id() in self.connections.keys():
+            self.connect()
+        return self.sqlite_classifier_extension
+
     def Disconnect(self):
         for connID in self.connections.keys():
             self.CloseConnection(connID)
+        if self.pool is not None:
+            self.pool.close_idle()
+            self.pool = None
         self.connections = {}
         self.cursors = {}
         self.connectionInfo = {}
+        self.connectionOwners = {}
         self.classifierColNames = None
+        self.query_cache = None
+        self._table_names = None
     
     def CloseConnection(self, connID=None):
+        '''Commits and returns the connection for connID (default: the current
+        thread's) to the connection pool.'''
         if not connID:
-            connID = threading.currentThread().getName()
-        if connID in self.connections.keys():
-            try:
-                self.connections[connID].commit()
-            except: pass
-            self.cursors.pop(connID)
-            self.connections.pop(connID).close()
+            connID = get_connection_id()
+        # NOTE: pop() so two threads releasing the same connection can't both
+        #       check it in
+        conn = self.connections.pop(connID, None)
+        self.pending_profiles.pop(connID, None)
+        if conn is not None:
+            cursor = self.cursors.pop(connID)
+            self.connectionOwners.pop(connID, None)
             (db_host, db_user, db_passwd, db_name) = self.connectionInfo.pop(connID)
+            try:
+                cursor.close()
+                conn.commit()
+            except Exception:
+                # Don't return a broken connection to the pool
+                self.pool.discard(conn)
+            else:
+                self.pool.checkin(conn)
             logging.info('Closed connection: %s as %s@%s (connID="%s").' % (db_name, db_user, db_host, connID))
         else:
             logging.warn('No database connection ID "%s" found!' %(connID))
 
-    @DBDisconnectedException.with_mysql_retry
+    def _is_disconnect_error(self, e):
+        return (p.db_type.lower() == 'mysql' and 
+                isinstance(e, DBOperationalError()) and 
+                len(e.args) > 0 and e.args[0] in MYSQL_DISCONNECT_ERRORS)
+
+    def _can_retry(self, query, e):
+        '''Returns whether a query that failed with the disconnect error e
+        can safely be run again on a new connection: SELECTs always can, but
+        other statements only if the server went away (2006) before the
+        statement was sent, since they may already have taken effect.'''
+        return (query.lstrip()[:6].upper() == 'SELECT' or 
+                e.args[0] == MYSQL_SERVER_GONE_ERROR)
+
     def execute(self, query, args=None, silent=False, return_result=True):
         '''
         Executes the given query using the connection associated with
         the current thread.  Returns the results as a list of rows
         unless return_result is false.
+        If the connection turns out to have been lost, it is replaced with a
+        new one and the query is tried once more (see _can_retry).
         '''
         # Grab a new connection if this is a new thread
-        connID = threading.currentThread().getName()
+        connID = get_connection_id()
         if not connID in self.connections.keys():
             self.connect()
 
@@ -484,35 +1166,346 @@ class DBConnect(Singleton):
             cursor = self.cursors[connID]
         except KeyError, e:
             raise DBException, 'No such connection: "%s".\n' %(connID)
+        if connID in self.interrupted:
+            # The job this query is part of was cancelled (see submit)
+            raise DBQueryCancelledException('Query was cancelled.')
         
-        # Finally make the query
-        try:
-            if verbose and not silent: 
-                logging.debug('[%s] %s'%(connID, query))
+        def run(cursor):
+            self._end_fetch(connID, finished=False)
+            start = time.time()
             if p.db_type.lower()=='sqlite':
                 if args:
-                    raise 'Can\'t pass args to sqlite execute!'
+                    raise DBException('Can\'t pass args to sqlite execute!')
                 cursor.execute(query)
             else:
                 cursor.execute(query, args=args)
+            result = None
             if return_result:
-                return self._get_results_as_list()
+                result = self._get_results_as_list()
+                self._profile_query(query, start, result, connID)
+            else:
+                # profiled once the rows have been fetched (see _end_fetch)
+                self.pending_profiles[connID] = [query, start, 0, 0]
+            return result
+
+        if WRITE_QUERY.match(query):
+            self._note_write(query)
+
+        # Finally make the query
+        if verbose and not silent: 
+            logging.debug('[%s] %s'%(connID, query))
+        try:
+            return run(cursor)
         except Exception, e:
-            try:
-                if isinstance(e, DBOperationalError()) and e.args[0] in [2006, 2013, 1053]:
-                    raise DBDisconnectedException()
-                else:
-                    raise DBException, ('Database query failed for connection "%s"'
+            if connID in self.interrupted:
+                raise DBQueryCancelledException('Query was cancelled.')
+            if not self._is_disconnect_error(e):
+                raise DBException, ('Database query failed for connection "%s"'
                                     '\nQuery was: "%s"'
                                     '\nException was: %s'%(connID, query, e))
-            except Exception, e2:
-                raise DBException, ('Database query failed for connection "%s" and failed to reconnect'
-                                    '\nQuery was: "%s"'
-                                    '\nFirst exception was: %s'
-                                    '\nSecond exception was: %s'%(connID, query, e, e2))
+            if not self._can_retry(query, e):
+                # The statement may have been applied, so it's up to the
+                # caller to try it again. The next query reconnects.
+                raise DBDisconnectedException('Lost connection to the database while '
+                                              'running: "%s" (%s)'%(query, e))
+        logging.info('[%s] Lost connection to the database; reconnecting.'%(connID))
+        try:
+            return run(self._reconnect(connID))
+        except Exception, e2:
+            if self._is_disconnect_error(e2):
+                raise DBDisconnectedException('Lost connection to the database and '
+                                              'failed to reconnect: %s'%(e2))
+            raise DBException, ('Database query failed for connection "%s" after reconnecting'
+                                '\nQuery was: "%s"'
+                                '\nException was: %s'%(connID, query, e2))
             
+    def execute_cached(self, query, return_colnames=False):
+        '''
+        Executes a read-only query like execute, but when the query_cache 
+        property is on, the results are kept in memory and on disk and are 
+        reused by later calls (in this or later sessions) with the same query 
+        text, for as long as the tables it reads haven't been modified.
+        Queries on tables whose modification time can't be determined (eg: 
+        temporary tables, or InnoDB tables on older MySQL servers) are never
+        cached.
+        return_colnames -- also return the result column names, since 
+                           GetResultColumnNames won't work after a cache hit.
+                           Returns (rows, colnames).
+        '''
+        cache = self._get_query_cache()
+        key = None
+        if cache is not None:
+            tables = self.get_tables_in_query(query)
+            dates = self.get_table_modify_dates(tables)
+            if tables and None not in dates.values():
+                key = repr((self._get_database_id(), ' '.join(query.split()),
+                            sorted(dates.items())))
+                hit = cache.get(key)
+                if hit is not None:
+                    colnames, rows = hit
+                    if return_colnames:
+                        return list(rows), list(colnames)
+                    return list(rows)
+        rows = self.execute(query)
+        colnames = self.GetResultColumnNames()
+        if key is not None:
+            cache.put(key, tables, colnames, list(rows))
+        if return_colnames:
+            return rows, colnames
+        return rows
+
+    def execute_and_commit(self, query, silent=False):
+        '''Runs a query that modifies the database and commits it. Meant for
+        execute_parallel, whose workers otherwise only commit when they are
+        done with all the queries.'''
+        self.execute(query, silent=silent)
+        self.Commit()
+
+    def submit(self, query, method='execute', **kwargs):
+        '''
+        Runs a query in the background and returns a QueryFuture for its 
+        result, so the calling (GUI) thread isn't blocked while it runs.
+        method -- the name of the DBConnect method that runs the query, eg:
+                  'execute', 'execute_to_arrays' or 'execute_cached'
+        kwargs -- other arguments to pass to that method
+        The query can be cancelled with the future's cancel method.
+        '''
+        future = QueryFuture(self, query, method, kwargs)
+        if self.query_queue is None:
+            self.query_queue = Queue.Queue()
+            self.query_workers = [QueryWorker(self.query_queue) 
+                                  for i in range(QUERY_WORKERS)]
+        self.query_queue.put(future)
+        return future
+
+    def GetParallelQueryCount(self):
+        '''
+        Returns the number of connections to run queries on at once with
+        execute_parallel: db_parallel_queries from the properties, or by
+        default the number of cores of the database server. MySQL only
+        reports that with a thread pool (thread_pool_size), so otherwise the
+        cores of this computer are counted. No more are used than the pool
+        has free, since connections held by other threads (eg: the workers
+        of submit) may not be given back until later.
+        '''
+        if p.db_parallel_queries:
+            n = int(p.db_parallel_queries)
+        else:
+            n = None
+            if p.db_type.lower() == 'mysql':
+                try:
+                    n = int(self.execute('SELECT @@thread_pool_size', silent=True)[0][0])
+                except Exception:
+                    pass
+            if not n:
+                import multiprocessing
+                n = multiprocessing.cpu_count()
+        # the calling thread keeps its own connection
+        if not get_connection_id() in self.connections.keys():
+            self.connect()
+        self._release_dead_threads()
+        stats = self.pool.get_stats()
+        return max(1, min(n, stats['max_size'] - stats['in_use']))
+
+    def execute_parallel(self, queries, workers=None, method='execute', **kwargs):
+        '''
+        Runs the queries on several connections at once, and yields 
+        (i, result) for each query i as it finishes, in the order they
+        finish.
+        workers -- the number of connections to use (default: 
+                   GetParallelQueryCount())
+        method -- the name of the DBConnect method that runs each query, as
+                  for submit
+        kwargs -- other arguments to pass to that method
+        If a query fails, or the caller stops iterating (eg: by raising an
+        exception to cancel), the queries that haven't finished are 
+        cancelled. The worker connections are returned to the pool once the
+        queries are done.
+        Workers that find no free connection in the pool leave the queries
+        to the others, and if none gets a connection, the queries are run
+        one at a time on the calling thread.
+        '''
+        workers = min(workers or self.GetParallelQueryCount(), len(queries))
+        futures = [QueryFuture(self, query, method, kwargs) for query in queries]
+        # gets the index of each query that finishes, or None for each 
+        # worker that couldn't get a connection
+        finished = Queue.Queue()
+        work = Queue.Queue()
+        for i, future in enumerate(futures):
+            future.add_done_callback(lambda future, i=i: finished.put(i))
+            work.put(future)
+        for i in xrange(workers):
+            # tells each worker to stop once the queries are taken
+            work.put(None)
+        for i in xrange(workers):
+            ParallelQueryWorker(work, finished)
+        running = workers
+        try:
+            n = 0
+            while n < len(futures):
+                if running == 0 and finished.empty():
+                    future = work.get()
+                    if future is not None:
+                        future._run()
+                    continue
+                i = finished.get()
+                if i is None:
+                    running -= 1
+                    continue
+                n += 1
+                yield i, futures[i].result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def _interrupt(self, connID):
+        '''Stops the query running on the given connection.'''
+        conn = self.connections.get(connID)
+        if conn is None:
+            return
+        self.interrupted.add(connID)
+        logging.info('[%s] Cancelling query.'%(connID))
+        if p.db_type.lower() == 'sqlite':
+            conn.interrupt()
+        else:
+            # Kill the query from another connection. The connection itself
+            # is kept.
+            self.execute('KILL QUERY %d'%(conn.thread_id()))
+
+    def invalidate_query_cache(self, tables=None):
+        '''
+        Drops cached results (see execute_cached) that read any of the given
+        tables, or all cached results if tables is None. Code that modifies 
+        tables without going through execute should call this.
+        '''
+        self._table_names = None
+        if self._get_query_cache() is not None:
+            self.query_cache.invalidate(tables)
+
+    def get_query_cache_stats(self):
+        '''Returns a dict of query cache statistics: entries in memory, hits,
+        disk_hits, misses and disk_bytes. Empty if the cache is off.'''
+        if self._get_query_cache() is None:
+            return {}
+        return self.query_cache.get_stats()
+
+    def _get_query_cache(self):
+        '''Returns the query cache, creating it if the query_cache property
+        is on. Returns None if it is off.'''
+        if p.query_cache != 'yes':
+            return None
+        if self.query_cache is None:
+            import querycache
+            cache_dir = p.query_cache_dir
+            if not cache_dir:
+                cache_dir = os.path.join(os.getenv('USERPROFILE') or os.getenv('HOMEPATH') or 
+                                         os.path.expanduser('~'), 'CPA', 'query_cache')
+            self.query_cache = querycache.QueryCache(
+                cache_dir, max_disk_bytes=int(float(p.query_cache_size or 500) * 2**20))
+        return self.query_cache
+
+    def _get_database_id(self):
+        '''Identifies the database in query cache keys (without credentials).'''
+        if p.db_type.lower() == 'sqlite':
+            return ('sqlite', os.path.abspath(p.db_sqlite_file))
+        return ('mysql', p.db_host, p.db_port, p.db_name)
+
+    def get_tables_in_query(self, query):
+        '''Returns the names of the database tables mentioned in a query.'''
+        if self._table_names is None:
+            self._table_names = self.GetTableNames()
+        words = set([w.lower() for w in re.findall(r'\w+', query)])
+        return [t for t in self._table_names if t.lower() in words]
+
+    def _get_query_profiler(self):
+        if self.query_profiler is None:
+            threshold = p.slow_query_threshold
+            self.query_profiler = queryprofiler.QueryProfiler(
+                slow_threshold=float(threshold) if threshold else None)
+            if p.slow_query_log:
+                handler = logging.FileHandler(p.slow_query_log)
+                handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+                queryprofiler.slow_logger.addHandler(handler)
+        return self.query_profiler
+
+    def _profile_query(self, query, start, result, connID, nrows=None, 
+                       nbytes=None, explain=True):
+        '''Records a query in the query profile (see get_query_profile).'''
+        explainer = None
+        if (explain and p.slow_query_explain == 'yes' and 
+            query.lstrip()[:6].upper() == 'SELECT'):
+            explainer = lambda q: self._explain(connID, q)
+        self._get_query_profiler().record(query, start, time.time() - start,
+                                          result, connID, explainer, nrows, nbytes)
+
+    def _note_fetched(self, rows, connID=None):
+        '''Counts rows fetched from the result of an execute with 
+        return_result=False towards the query's profile.'''
+        pending = self.pending_profiles.get(connID or get_connection_id())
+        if pending is not None:
+            pending[2] += len(rows)
+            pending[3] += queryprofiler.estimate_bytes(rows)
+
+    def _end_fetch(self, connID=None, finished=True):
+        '''
+        Records the query whose result is being fetched on the connection,
+        if any, in the query profile, with the time taken up to now and the
+        rows fetched so far. Called once the result has been read, or when 
+        the next query is run (finished=False). In that case the query isn't
+        EXPLAINed, since an unbuffered result may still be pending.
+        '''
+        connID = connID or get_connection_id()
+        pending = self.pending_profiles.pop(connID, None)
+        if pending is not None:
+            query, start, nrows, nbytes = pending
+            self._profile_query(query, start, None, connID, nrows, nbytes,
+                                explain=finished)
+
+    def _explain(self, connID, query):
+        '''Returns the query plan of a query as text. Uses a separate cursor
+        so the results of the query itself (eg: column names) are kept, and
+        so the EXPLAIN isn't profiled itself.'''
+        cursor = self.connections[connID].cursor()
+        try:
+            if p.db_type.lower() == 'sqlite':
+                cursor.execute('EXPLAIN QUERY PLAN ' + query)
+            else:
+                cursor.execute('EXPLAIN ' + query)
+            return '\n'.join(['\t'.join([str(v) for v in row]) for row in cursor.fetchall()])
+        finally:
+            cursor.close()
+
+    def get_query_profile(self, top=None, sort_by='total_time'):
+        '''
+        Returns totals for the queries run so far, grouped by query shape 
+        (the query with its values blanked out), as a list of dicts with keys
+        shape, count, total_time, mean_time, max_time, rows, bytes and tools.
+        Sorted by sort_by in descending order.
+        '''
+        return self._get_query_profiler().get_shape_stats(top, sort_by)
+
+    def get_recent_queries(self, n=None):
+        '''Returns records of the n most recent queries (see
+        queryprofiler.QueryRecord), newest first.'''
+        return self._get_query_profiler().get_recent(n)
+
+    def get_query_profile_report(self, top=20):
+        '''Returns a text report of the query shapes that took the most time.'''
+        return self._get_query_profiler().report(top)
+
+    def reset_query_profile(self):
+        self._get_query_profiler().reset()
+
+    def _note_write(self, query):
+        '''Drops cached state that a modifying query may have made stale.'''
+        words = re.findall(r'\w+', query)
+        if words and words[0].upper() in ['CREATE', 'DROP', 'ALTER', 'RENAME']:
+            self._table_names = None
+        if self.query_cache is not None:
+            self.query_cache.invalidate(words)
+
     def Commit(self):
-        connID = threading.currentThread().getName()
+        connID = get_connection_id()
         try:
             logging.debug('[%s] Commit'%(connID))
             self.connections[connID].commit()
@@ -522,14 +1515,17 @@ class DBConnect(Singleton):
             raise DBException, 'No such connection: "%s".\n' %(connID)
 
     def GetNextResult(self):
-        connID = threading.currentThread().getName()
+        connID = get_connection_id()
         try:
-            return self.cursors[connID].next()
+            row = self.cursors[connID].next()
+            self._note_fetched([row], connID)
+            return row
         except DBError(), e:
             raise DBException, \
                 'Error retrieving next result from database: %s'%(e,)
             return None
         except StopIteration, e:
+            self._end_fetch(connID)
             return None
         except KeyError, e:
             raise DBException, 'No such connection: "%s".\n' %(connID)
@@ -539,7 +1535,7 @@ class DBConnect(Singleton):
         Returns a list of results retrieved from the last execute query.
         NOTE: this function automatically called by execute.
         '''
-        connID = threading.currentThread().getName()
+        connID = get_connection_id()
         return list(self.cursors[connID].fetchall())
 
     def result_dtype(self):
@@ -548,7 +1544,7 @@ class DBConnect(Singleton):
         result can be stored.
         """
         #XXX: This doesn't work for SQLite... no cursor.description_flags
-        cursor = self.cursors[threading.currentThread().getName()]
+        cursor = self.cursors[get_connection_id()]
         descr = []
         for (name, type_code, display_size, internal_size, precision, 
              scale, null_ok), flags in zip(cursor.description, 
@@ -572,18 +1568,137 @@ class DBConnect(Singleton):
         return descr
 
     def get_results_as_structured_array(self, n=None):
-        #XXX: this doesn't work for SQLite
+        '''
+        Returns the results of the last execute query as a numpy structured
+        array. Rows are fetched n at a time (default: 100000).
+        '''
+        return self._get_results_as_arrays(n or 100000, structured=True)
+
+    def execute_to_arrays(self, query, chunk_rows=100000, structured=False,
+                          silent=False):
+        '''
+        Executes the given query and returns the result as a list of typed
+        numpy arrays, one per result column, or as a single numpy structured
+        array if structured is True.
+        Rows are pulled from the cursor chunk_rows at a time so the result is
+        never held in memory as a list of python tuples. Column dtypes are
+        taken from GetColumnTypes for the tables referenced in the query;
+        computed columns are typed from the data. NULLs in numeric columns
+        are returned as NaN.
+        '''
+        coltypes = self._get_column_types_for_query(query)
+        self.execute(query, silent=silent, return_result=False)
+        return self._get_results_as_arrays(chunk_rows, structured, coltypes)
+
+    def iter_execute_to_arrays(self, query, chunk_rows=100000, structured=False,
+                               silent=False):
+        '''
+        Like execute_to_arrays, but yields the result in blocks of at most
+        chunk_rows rows as they are fetched, so results that don't fit in 
+        memory can be processed. On MySQL the rows are streamed from the 
+        server; on SQLite the cursor is stepped through. No other query may
+        be run on this thread until the iteration is finished or closed.
+        Column dtypes may differ between blocks for columns that are typed 
+        from the data.
+        '''
+        coltypes = self._get_column_types_for_query(query)
+        self.execute(query, silent=silent, return_result=False)
         col_names = self.GetResultColumnNames()
-        connID = threading.currentThread().getName()
-        records = []
+        types = [coltypes.get(col, None) for col in col_names]
+        cursor = self.cursors[get_connection_id()]
+        finished = False
+        try:
+            for columns in self._iter_result_chunks(cursor, chunk_rows, types):
+                if structured:
+                    yield _structured_array(col_names, columns)
+                else:
+                    yield columns
+            finished = True
+        finally:
+            if not finished and p.db_type.lower() == 'mysql':
+                # the rest of the result has to be read before the 
+                # connection can be used again
+                while True:
+                    rows = cursor.fetchmany(chunk_rows)
+                    if len(rows) == 0:
+                        break
+                    self._note_fetched(rows)
+                self._end_fetch()
+
+    def box_stats(self, query, nvalues=1, chunk_rows=100000, **kwargs):
+        '''
+        Computes box plot statistics of the result of a query, reading it a 
+        block at a time, so only the statistics are kept in memory.
+        query -- a query whose first nvalues columns are the values and whose
+                 remaining columns are the group keys
+        kwargs -- other arguments to boxstats.BoxStats
+        Returns a list of nvalues boxstats.BoxStats objects with their
+        statistics computed.
+        '''
+        boxes = [boxstats.BoxStats(**kwargs) for i in xrange(nvalues)]
+        for columns in self.iter_execute_to_arrays(query, chunk_rows=chunk_rows):
+            for box, values in zip(boxes, columns[:nvalues]):
+                box.add(values, columns[nvalues:])
+        for box in boxes:
+            box.stats()
+        return boxes
+
+    def _iter_result_chunks(self, cursor, chunk_rows, types):
+        '''Yields the remaining results of the cursor as lists of typed 
+        numpy column arrays of at most chunk_rows rows.'''
         while True:
-            r = self.cursors[connID].fetchmany(n)
-            print len(r)
-            if len(r) == 0:
+            rows = cursor.fetchmany(chunk_rows)
+            if len(rows) == 0:
+                self._end_fetch()
                 break
-            records.extend(list(r))
-        return np.array(records, dtype=self.result_dtype())
-    
+            self._note_fetched(rows)
+            block = np.array(rows, dtype=object)
+            yield [_typed_column(block[:,i], types[i]) for i in xrange(len(types))]
+
+    def _get_column_types_for_query(self, query):
+        '''
+        Returns a dict mapping column names to python types for all columns
+        of the database tables named in the FROM and JOIN clauses of query.
+        '''
+        tables = re.findall(r'(?:FROM|JOIN)\s+`?(\w+)`?', query, re.IGNORECASE)
+        tables = set(tables).intersection(self.GetTableNames())
+        coltypes = {}
+        for table in tables:
+            for col, coltype in zip(self.GetColumnNames(table),
+                                    self.GetColumnTypes(table)):
+                coltypes.setdefault(col, coltype)
+        return coltypes
+
+    def _get_results_as_arrays(self, chunk_rows, structured=False, coltypes={}):
+        '''
+        Fetches the results of the last execute query chunk_rows at a time
+        and returns them as a list of numpy column arrays (or a structured
+        array if structured is True).
+        coltypes -- dict mapping column names to python types (see
+                    GetColumnTypes). Columns not found here are typed from
+                    the data.
+        '''
+        connID = get_connection_id()
+        cursor = self.cursors[connID]
+        col_names = self.GetResultColumnNames()
+        types = [coltypes.get(col, None) for col in col_names]
+        chunks = [[] for col in col_names]
+        for columns in self._iter_result_chunks(cursor, chunk_rows, types):
+            for i in xrange(len(col_names)):
+                chunks[i].append(columns[i])
+        columns = []
+        for i in xrange(len(col_names)):
+            if len(chunks[i]) == 0:
+                columns.append(np.array([], dtype=_column_dtype(types[i])))
+            elif any([c.dtype == object for c in chunks[i]]):
+                # string-valued chunks can't be upcast with the rest
+                columns.append(np.concatenate([c.astype(object) for c in chunks[i]]))
+            else:
+                columns.append(np.concatenate(chunks[i]))
+        if not structured:
+            return columns
+        return _structured_array(col_names, columns)
+
     def GetObjectIDAtIndex(self, imKey, index):
         '''
         Returns the true object ID of the nth object in an image.
@@ -597,7 +1712,32 @@ class DBConnect(Singleton):
                                      %(p.object_id, p.object_table, where_clause, index - 1))
         object_number = object_number[0][0]
         return tuple(list(imKey)+[int(object_number)])
-    
+
+    def GetObjectIDsFromImages(self, imKeys, batch_size=1000):
+        '''
+        Returns a dict mapping each of the given image keys to a sorted
+        numpy array of the IDs of the objects in that image. The IDs are
+        fetched with one query per batch_size images.
+        '''
+        key_size = len(image_key_columns())
+        imKeys = [tuple(imKey) for imKey in imKeys]
+        ids = dict([(imKey, np.zeros(0, dtype=np.int64)) for imKey in imKeys])
+        for i in xrange(0, len(imKeys), batch_size):
+            batch = imKeys[i : i + batch_size]
+            cols = self.execute_to_arrays('SELECT %s, %s FROM %s WHERE %s ORDER BY %s, %s'%(
+                        UniqueImageClause(), p.object_id, p.object_table,
+                        GetWhereClauseForImages(list(batch)), UniqueImageClause(),
+                        p.object_id))
+            if len(cols[0]) == 0:
+                continue
+            keys = np.column_stack(cols[:key_size]).astype(np.int64)
+            obids = np.asarray(cols[key_size], dtype=np.int64)
+            # the rows are sorted by image, so split where the image key changes
+            starts = np.flatnonzero(np.r_[True, np.any(keys[1:] != keys[:-1], axis=1)])
+            for start, end in zip(starts, np.r_[starts[1:], len(obids)]):
+                ids[tuple(keys[start].tolist())] = obids[start:end]
+        return ids
+
     def GetPerImageObjectCounts(self):
         '''
         Returns a list of (imKey, obCount) tuples. 
@@ -608,9 +1748,9 @@ class DBConnect(Singleton):
             return []
                 
         select = 'SELECT '+UniqueImageClause(p.object_table)+', COUNT('+p.object_table+'.'+p.object_id + ') FROM '+p.object_table + ' GROUP BY '+UniqueImageClause(p.object_table)
-        result1 = self.execute(select)
+        result1 = self.execute_cached(select)
         select = 'SELECT '+UniqueImageClause(p.image_table)+' FROM '+p.image_table
-        result2 = self.execute(select)
+        result2 = self.execute_cached(select)
 
         counts = {}
         for r in result1:
@@ -637,6 +1777,14 @@ class DBConnect(Singleton):
         select = 'SELECT '+p.cell_x_loc+', '+p.cell_y_loc+' FROM '+p.object_table+' WHERE '+GetWhereClauseForImages([imKey])+' ORDER BY '+p.object_id
         return self.execute(select)
 
+    def GetObjectIDsAndCoordsFromImage(self, imKey):
+        ''' Returns arrays of the object IDs and the x and y coordinates of
+        all objects in the given image. NULL coordinates are NaN. '''
+        select = 'SELECT %s, %s, %s FROM %s WHERE %s'%(p.object_id, p.cell_x_loc, 
+                    p.cell_y_loc, p.object_table, GetWhereClauseForImages([imKey]))
+        obIDs, xs, ys = self.execute_to_arrays(select)
+        return obIDs.astype(np.int64), xs.astype(float), ys.astype(float)
+
     def GetObjectNear(self, imkey, x, y, silent=False):
         ''' Returns obKey of the closest object to x, y in an image. '''
         delta_x = '(%s - %d)'%(p.cell_x_loc, x)
@@ -692,6 +1840,25 @@ class DBConnect(Singleton):
         If reverse is set to true, the dictionary will map
         group keys to image keys instead.
 
+        """
+        key_size = p.table_id and 2 or 1
+        res, col_names = self.group_rows(group, filter)
+        d = {}
+        for row in res:
+            if reverse:
+                d[row[key_size:]] = []
+        for row in res:
+            if reverse:
+                d[row[key_size:]] += [row[:key_size]]
+            else:
+                d[row[:key_size]] = row[key_size:]
+        return d, col_names
+
+    def group_rows(self, group, filter=None):
+        """
+        Returns the rows of the group query for the given group, each
+        an image key followed by a group key, and a list of column 
+        names for the group keys.
         """
         key_size = p.table_id and 2 or 1
         query = p._groups[group]
@@ -706,13 +1873,13 @@ class DBConnect(Singleton):
                                                           ','.join(image_key_columns()))
             query = query[:where_idx] + join_clause + query[where_idx:]
         try:
-            res = self.execute(query)
+            res, col_names = self.execute_cached(query, return_colnames=True)
         except DBException, e:
             raise DBException('Group query failed for group "%s". Check the SQL'
                               ' syntax in your properties file.\n'
                               'Error was: "%s"'%(group, e))
         
-        col_names = self.GetResultColumnNames()[key_size:]
+        col_names = col_names[key_size:]
         from_clause = query[from_idx+6 : where_idx].strip()
         if ',' not in from_clause and ' ' not in from_clause:
             col_names = ['%s.%s'%(from_clause, col) for col in col_names]
@@ -724,17 +1891,7 @@ class DBConnect(Singleton):
                                     'in your FROM clause. Please try rewriting your '
                                     'query without aliases and try again.'%(group))
             col_names = [col.strip() for col in query[7 : from_idx].split(',')][len(image_key_columns()):]
-
-        d = {}
-        for row in res:
-            if reverse:
-                d[row[key_size:]] = []
-        for row in res:
-            if reverse:
-                d[row[key_size:]] += [row[:key_size]]
-            else:
-                d[row[:key_size]] = row[key_size:]
-        return d, col_names
+        return res, col_names
     
     def filter_sql(self, filter_name):
         f = p._filters[filter_name]
@@ -751,7 +1908,7 @@ class DBConnect(Singleton):
     def GetFilteredImages(self, filter_name):
         ''' Returns a list of imKeys from the given filter. '''
         try:
-            return self.execute(filter_sql(filter_name))
+            return self.execute_cached(self.filter_sql(filter_name))
         except Exception, e:
             logging.error('Filter query failed for filter "%s". Check the MySQL syntax in your properties file.'%(filter_name))
             logging.error(e)
@@ -1081,7 +2238,7 @@ class DBConnect(Singleton):
     
     def GetResultColumnNames(self):
         ''' Returns the column names of the last query on this connection. '''
-        connID = threading.currentThread().getName()
+        connID = get_connection_id()
         return [x[0] for x in self.cursors[connID].description]
 
     def GetCellDataForClassifier(self, obKey):
@@ -1117,6 +2274,53 @@ class DBConnect(Singleton):
         values = [x if type(x) in [int, long, float] else 0.0 for x in data[0]]
         return np.array(values)
 
+    def GetCellDataBatch(self, obkeys, columns=None):
+        '''
+        Returns the measurements for many objects at once as a 2D float array 
+        with one row per object key, in the order the keys were given.
+        obkeys -- a sequence of object keys
+        columns -- the object_table columns to fetch (all by default, as in 
+                   GetCellData). Non-numeric values are returned as 0.0.
+        Rows for objects that aren't in the database are all NaN, as are NULL
+        measurements, whatever the column type. 
+        The keys are written to a temporary table and joined against the 
+        object table, so this costs one query regardless of how many keys 
+        are requested.
+        '''
+        if columns is None:
+            columns = self.GetColumnNames(p.object_table)
+        data = np.empty((len(obkeys), len(columns)))
+        data[:] = np.nan
+        if len(obkeys) == 0:
+            return data
+        
+        key_cols = list(object_key_columns())
+        keys_table = '_cpa_obkeys'
+        self.drop_temporary_table(keys_table)
+        self.execute('CREATE TEMPORARY TABLE %s (_row INT, %s)'%(keys_table, 
+                     ', '.join(['%s INT'%(col) for col in key_cols])))
+        self.bulk_insert(keys_table, ['_row'] + key_cols,
+                         ([i] + list(key) for i, key in enumerate(obkeys)))
+        try:
+            res = self.execute_to_arrays('SELECT k._row, o.`%s` FROM %s k JOIN %s o ON %s'%(
+                    '`, o.`'.join(columns), keys_table, p.object_table,
+                    ' AND '.join(['o.%s=k.%s'%(col, col) for col in key_cols])),
+                    silent=True)
+        finally:
+            self.drop_temporary_table(keys_table)
+        
+        rows = res[0].astype(int)
+        for i, col in enumerate(res[1:]):
+            if col.dtype.kind not in 'biuf':
+                col = np.array([x if type(x) in [int, long, float] else 
+                                np.nan if x is None else 0.0 for x in col])
+            data[rows, i] = col
+        if len(rows) < len(obkeys):
+            missing = np.setdiff1d(np.arange(len(obkeys)), rows)
+            logging.error('No data for %d of %d obKeys: %s'%(len(missing), len(obkeys),
+                          ', '.join([str(obkeys[i]) for i in missing[:10]])))
+        return data
+
     def GetPlateNames(self):
         '''
         Returns the names of each plate in the per-image table.
@@ -1211,91 +2415,72 @@ class DBConnect(Singleton):
         Creates an SQLite database from files specified in properties
         image_csv_file and object_csv_file.
         '''
+        self._create_sqlite_table_from_csv(p.image_table, p.image_csv_file)
+        self._create_sqlite_table_from_csv(p.object_table, p.object_csv_file)
+        # Commit only at very end. No use in committing if the db is incomplete.
+        self.Commit()
+
+    def _create_sqlite_table_from_csv(self, tablename, filename):
+        '''
+        Creates and populates a table from a csv file with a header row.
+        Column types are inferred from the first CSV_SAMPLE_ROWS rows, and the
+        rows are then streamed into the table CSV_BATCH_ROWS at a time with 
+        parameterized inserts, so the file is never held in memory.
+        '''
         import csv
-        # CREATE THE IMAGE TABLE
-        # All the ugly code is to establish the type of each column in the table
-        # so we can form a proper CREATE TABLE statement.
-        f = open(p.image_csv_file, 'U')
+        import itertools
+        f = open(filename, 'U')
         r = csv.reader(f)
         columnLabels = r.next()
         columnLabels = [lbl.strip() for lbl in columnLabels]
-        dtable = get_data_table_from_csv_reader(r)
-        colTypes = self.InferColTypesFromData(dtable, len(columnLabels))
+        sample = [row for row in itertools.islice(r, CSV_SAMPLE_ROWS) if len(row) > 0]
+        colTypes = self.InferColTypesFromData(sample, len(columnLabels))
         
         # Build the CREATE TABLE statement
-        statement = 'CREATE TABLE '+p.image_table+' ('
+        statement = 'CREATE TABLE '+tablename+' ('
         statement += ',\n'.join([lbl+' '+colTypes[i] for i, lbl in enumerate(columnLabels)])
         keys = ','.join([x for x in [p.table_id, p.image_id, p.object_id] if x in columnLabels])
         statement += ',\nPRIMARY KEY (' + keys + ') )'
-        f.close()
         
-        logging.info('Creating table: %s'%(p.image_table))
-        self.execute('DROP TABLE IF EXISTS %s'%(p.image_table))
-        self.execute(statement)
-        
-        # CREATE THE OBJECT TABLE
-        # For the object table we assume that all values are type FLOAT
-        # except for the primary keys
-        f = open(p.object_csv_file, 'U')
-        r = csv.reader(f)
-        columnLabels = r.next()
-        columnLabels = [lbl.strip() for lbl in columnLabels]
-        dtable = get_data_table_from_csv_reader(r)
-        colTypes = self.InferColTypesFromData(dtable, len(columnLabels))
-        statement = 'CREATE TABLE '+p.object_table+' ('
-        statement += ',\n'.join([lbl+' '+colTypes[i] for i, lbl in enumerate(columnLabels)])
-        keys = ','.join([x for x in [p.table_id, p.image_id, p.object_id] if x in columnLabels])
-        statement += ',\nPRIMARY KEY (' + keys + ') )'
-        f.close()
-    
-        logging.info('Creating table: %s'%(p.object_table))
-        self.execute('DROP TABLE IF EXISTS '+p.object_table)
+        logging.info('Creating table: %s'%(tablename))
+        self.execute('DROP TABLE IF EXISTS %s'%(tablename))
         self.execute(statement)
         
-        # POPULATE THE IMAGE TABLE
-        f = open(p.image_csv_file, 'U')
-        r = csv.reader(f)
-        row = r.next() # skip the headers
-        row = r.next()
-        while row: 
-            self.execute('INSERT INTO '+p.image_table+' VALUES ('+','.join(["'%s'"%(i) for i in row])+')',
-                         silent=True)
-            try:
-                row = r.next()
-            except StopIteration:
+        # POPULATE THE TABLE
+        converters = [_csv_value_converter(sqltype_to_pythontype(t)) for t in colTypes]
+        command = 'INSERT INTO %s VALUES (%s)'%(tablename, ','.join(['?'] * len(columnLabels)))
+        cursor = self.cursors[get_connection_id()]
+        rows = itertools.chain(sample, r)
+        nrows = 0
+        while True:
+            chunk = list(itertools.islice(rows, CSV_BATCH_ROWS))
+            if len(chunk) == 0:
                 break
+            # blank rows are skipped, but don't end the file
+            batch = [tuple([conv(v) for conv, v in zip(converters, row)])
+                     for row in chunk if len(row) > 0]
+            if len(batch) > 0:
+                cursor.executemany(command, batch)
+                nrows += len(batch)
         f.close()
+        logging.info('Inserted %d rows into %s'%(nrows, tablename))
         
-        # POPULATE THE OBJECT TABLE
-        f = open(p.object_csv_file, 'U')
-        r = csv.reader(f)
-        row = r.next() # skip the headers
-        row = r.next()
-        while row: 
-            self.execute('INSERT INTO '+p.object_table+' VALUES ('+','.join(["'%s'"%(i) for i in row])+')',
-                         silent=True)
-            try:
-                row = r.next()
-            except StopIteration: break
-        f.close()
-        
-        self.Commit()
-        
+
     def CreateSQLiteDBFromCSVs(self):
         '''
         Creates an SQLite database from files generated by CellProfiler's
         ExportToDatabase module.
+        CSV files are split into byte ranges that are parsed and converted
+        to typed rows in worker processes, while this thread writes the rows
+        with journaling and syncing turned off. Primary keys are built as
+        unique indexes once all the data is in.
         '''
-        import csv
-        
         imcsvs, obcsvs = get_csv_filenames_from_sql_file()
                 
         # Verify that the CSVs exist
         csv_dir = os.path.split(p.db_sql_file)[0] or '.'
         dir_files = os.listdir(csv_dir)
-        print dir_files
         for file in imcsvs + obcsvs:
-            print file
             assert file in dir_files, ('File "%s" was specified in %s but was '
                                       'not found in %s.'%(file, os.path.split(p.db_sql_file)[1], csv_dir))
         assert len(imcsvs)>0, ('Failed to parse image csv filenames from %s. '
@@ -1326,71 +2511,78 @@ class DBConnect(Singleton):
                     in_create_stmt = True
         f.close()
         
+        # Primary keys are deferred until the tables are populated since
+        # inserting into an indexed table is much slower.
+        primary_keys = []
         for q in create_stmts:
+            table = re.match(r'\s*CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?`?(\w+)`?', 
+                             q, re.IGNORECASE).group(1)
+            pk = re.search(r',\s*PRIMARY\s+KEY\s*\(([^)]*)\)', q, re.IGNORECASE)
+            if pk:
+                q = q[:pk.start()] + q[pk.end():]
+                primary_keys += [(table, pk.group(1))]
             self.execute(q)
         
-        import wx
-        if self.gui_parent is not None and issubclass(self.gui_parent.__class__, wx.Window):
-            dlg = wx.ProgressDialog('Creating sqlite DB...', '0% Complete', 100, self.gui_parent, wx.PD_ELAPSED_TIME | wx.PD_ESTIMATED_TIME | wx.PD_REMAINING_TIME | wx.PD_CAN_ABORT)
+        dlg = None
+        if self.gui_parent is not None:
+            import wx
+            if issubclass(self.gui_parent.__class__, wx.Window):
+                dlg = wx.ProgressDialog('Creating sqlite DB...', '0% Complete', 100, self.gui_parent, wx.PD_ELAPSED_TIME | wx.PD_ESTIMATED_TIME | wx.PD_REMAINING_TIME | wx.PD_CAN_ABORT)
+
+        # split the files into ranges of about CSV_CHUNK_BYTES
+        jobs = []
+        for table, files in [(p.image_table, imcsvs), (p.object_table, obcsvs)]:
+            coltypes = [sqltype_to_pythontype(t) for t in self.GetColumnTypeStrings(table)]
+            for file in files:
+                path = os.path.join(csv_dir, file)
+                offsets = csv_record_offsets(path, CSV_CHUNK_BYTES) + [os.path.getsize(path)]
+                for start, end in zip(offsets[:-1], offsets[1:]):
+                    jobs += [(table, (path, start, end, coltypes))]
+        total_bytes = float(sum([end - start for table, (path, start, end, coltypes) in jobs]) or 1)
+
+        pool = None
+        if len(jobs) > 1 and not hasattr(sys, 'frozen'):
+            # Multiprocessing is not supported from frozen executables
+            import multiprocessing
+            # Only keep a few chunks in flight so parsed rows don't pile up
+            # in memory faster than they can be written.
+            max_pending = min(2 * max(1, multiprocessing.cpu_count() - 1),
+                              CSV_MAX_PENDING_CHUNKS)
+            nprocs = max(1, max_pending / 2)
+            pool = multiprocessing.Pool(nprocs)
+            def parsed_chunks():
+                pending = []
+                for table, args in jobs:
+                    pending += [(table, pool.apply_async(parse_csv_range, (args,)))]
+                    if len(pending) >= max_pending:
+                        table, res = pending.pop(0)
+                        yield table, res.get()
+                for table, res in pending:
+                    yield table, res.get()
         else:
-            dlg = None
-
-        # find the number of bytes we're going to read
-        total_bytes = 0
-        for file in imcsvs + obcsvs:
-            total_bytes += os.path.getsize(os.path.join(csv_dir, file))
-        total_bytes = float(total_bytes)
-
-        base_bytes = 0
-        connID = threading.currentThread().getName()
-        # populate tables with contents of csv files
-        for file in imcsvs:
-            logging.info('Populating image table with data from %s'%file)
-            f = open(os.path.join(csv_dir, file), 'U')
-            r = csv.reader(f)
-            row1 = r.next()
-            command = 'INSERT INTO '+p.image_table+' VALUES ('+','.join(['?' for i in row1])+')'
-            self.cursors[connID].execute(command, row1)
-            self.cursors[connID].executemany(command, [l for l in r if len(l)>0])
-            f.close()
-            base_bytes += os.path.getsize(os.path.join(csv_dir, file))
-            pct = min(int(100 * base_bytes / total_bytes), 100)
-            if dlg:
-                c, s = dlg.Update(pct, '%d%% Complete'%(pct))
-                if not c:
-                    try:
-                        os.remove(p.db_sqlite_file)
-                    except OSError:
-                        wx.MessageBox('Could not remove incomplete database'
-                                      ' at "%s". This file must be removed '
-                                      'manually or CPAnalyst will load it '
-                                      'the next time use use the current '
-                                      'database settings.', 'Error')
-                    raise Exception, 'cancelled load'
-            logging.info("... loaded %d%% of CSV data"%(pct))
-
-        line_count = 0
-        for file in obcsvs:
-            logging.info('Populating object table with data from %s'%file)
-            f = open(csv_dir+os.path.sep+file, 'U')
-            r = csv.reader(f)
-            row1 = r.next()
-            command = 'INSERT INTO '+p.object_table+' VALUES ('+','.join(['?' for i in row1])+')'
-            # guess at a good number of lines, about 250 megabytes, assuming floats)
-            nlines = (250*1024*1024) / (len(row1) * 64)
-            self.cursors[connID].execute(command, row1)
-            while True:
-                # fetch a certain number of lines efficiently
-                args = [l for idx, l in zip(range(nlines), r) if len(l) > 0]
-                if args == []:
-                    break
-                self.cursors[connID].executemany(command, args)
-                line_count += len(args)
-
-                pct = min(int(100 * (f.tell() + base_bytes) / total_bytes), 100)
+            def parsed_chunks():
+                for table, args in jobs:
+                    yield table, parse_csv_range(args)
+
+        connID = get_connection_id()
+        cursor = self.cursors[connID]
+        cursor.execute('PRAGMA journal_mode = OFF')
+        cursor.execute('PRAGMA synchronous = OFF')
+        try:
+            # populate tables with contents of csv files
+            nbytes = 0
+            for table, (rows, chunk_bytes) in parsed_chunks():
+                if len(rows) > 0:
+                    command = 'INSERT INTO %s VALUES (%s)'%(table, ','.join(['?']*len(rows[0])))
+                    cursor.executemany(command, rows)
+                nbytes += chunk_bytes
+                pct = min(int(100 * nbytes / total_bytes), 100)
                 if dlg:
                     c, s = dlg.Update(pct, '%d%% Complete'%(pct))
                     if not c:
+                        if pool:
+                            pool.terminate()
+                            pool = None
                         try:
                             os.remove(p.db_sqlite_file)
                         except OSError:
@@ -1401,13 +2593,20 @@ class DBConnect(Singleton):
                                           'database settings.', 'Error')
                         raise Exception, 'cancelled load'
                 logging.info("... loaded %d%% of CSV data"%(pct))
-            f.close()
-            base_bytes += os.path.getsize(os.path.join(csv_dir, file))
-
-        # Commit only at very end. No use in committing if the db is incomplete.
-        self.Commit()
-        if dlg:
-            dlg.Destroy()
+            
+            for table, cols in primary_keys:
+                logging.info('Creating primary key index on %s (%s)'%(table, cols))
+                cursor.execute('CREATE UNIQUE INDEX %s_pk ON %s (%s)'%(table, table, cols))
+            # Commit only at very end. No use in committing if the db is incomplete.
+            self.Commit()
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+            cursor.execute('PRAGMA synchronous = FULL')
+            cursor.execute('PRAGMA journal_mode = DELETE')
+            if dlg:
+                dlg.Destroy()
 
     def table_exists(self, name):
         res = []
@@ -1455,6 +2654,15 @@ class DBConnect(Singleton):
         else:
             self.execute('CREATE TEMPORARY TABLE %s (%s)'%(tablename, coldefs))
 
+    def drop_temporary_table(self, tablename):
+        '''Drops a temporary table if it exists. Unlike DROP TABLE, this won't
+        drop a regular table of the same name or, on MySQL, commit the open
+        transaction.'''
+        if p.db_type.lower() == 'mysql':
+            self.execute('DROP TEMPORARY TABLE IF EXISTS %s'%(tablename))
+        else:
+            self.execute('DROP TABLE IF EXISTS temp.%s'%(tablename))
+
     def create_default_indexes_on_table(self, tablename):
         '''automatically adds indexes to all the image, object, and well key 
         columns in the specified table
@@ -1463,25 +2671,194 @@ class DBConnect(Singleton):
             if key in self.GetColumnNames(tablename):
                 self.execute('CREATE INDEX %s ON %s (%s)'%('%s_%s'%(tablename,key), tablename, key))
 
+    def GetIndexedColumns(self, table):
+        '''Returns a list of tuples of the columns of each index on the given
+        table, in index order. Column names are lower case.'''
+        indexes = {}
+        if p.db_type.lower() == 'mysql':
+            # Key_name, Seq_in_index, Column_name
+            for row in self.execute('SHOW INDEX FROM %s'%(table)):
+                indexes.setdefault(row[2], []).append((int(row[3]), row[4].lower()))
+        else:
+            for row in self.execute('PRAGMA index_list(%s)'%(table)):
+                name = row[1]
+                for seqno, cid, col in self.execute('PRAGMA index_info("%s")'%(name)):
+                    indexes.setdefault(name, []).append((seqno, col.lower()))
+            # An INTEGER PRIMARY KEY is the rowid, which isn't listed
+            pk = [row for row in self.execute('PRAGMA table_info(%s)'%(table)) if row[5]]
+            if len(pk) == 1 and pk[0][2].upper() == 'INTEGER':
+                indexes['rowid'] = [(0, pk[0][1].lower())]
+        return [tuple([col for seq, col in sorted(cols)]) for cols in indexes.values()]
+
+    def GetRecommendedIndexes(self):
+        '''
+        Returns a list of (table, columns) for the indexes CPA's queries rely
+        on: the image and object keys (which per-image object lookups use),
+        plate and well, the class table keys, the columns that link tables
+        together, and the columns used by groups and filters.
+        '''
+        tables = dict([(t.lower(), t) for t in self.GetTableNames()])
+        wanted = []
+        def want(table, cols):
+            if table and table.lower() in tables and cols:
+                wanted.append((tables[table.lower()], tuple(cols)))
+
+        want(p.image_table, image_key_columns())
+        if p.plate_id and p.well_id:
+            want(p.image_table, [p.plate_id, p.well_id])
+        elif p.well_id:
+            want(p.image_table, [p.well_id])
+        if p.object_table:
+            want(p.object_table, object_key_columns())
+            want(p.class_table, object_key_columns())
+        # Linked tables
+        if p.link_columns_table and p.link_columns_table.lower() in tables:
+            links = {}
+            for table1, table2, col1, col2 in self.execute(
+                    'SELECT table1, table2, col1, col2 FROM %s'%(p.link_columns_table)):
+                links.setdefault((table1, table2), []).append(col1)
+            for (table1, table2), cols in sorted(links.items()):
+                want(table1, cols)
+        # Group columns (other than the image key)
+        for group, query in sorted(p._groups.items()):
+            match = re.match(r'\s*SELECT\s+(.+?)\s+FROM\s+(.+?)(\s+WHERE\s+.*)?$',
+                             ' '.join(query.split()), re.IGNORECASE)
+            if match is None:
+                continue
+            for table in [t.strip() for t in match.group(2).split(',')]:
+                cols = [c.strip().split('.')[-1] for c in match.group(1).split(',')
+                        if c.strip().split('.')[0] in (table, c.strip())]
+                want(table, [c for c in cols if c not in image_key_columns()])
+        # Filter columns. Measurements on the object table are skipped: an
+        # index on one is costly to build and seldom used for range filters.
+        import sqltools
+        for name, fltr in sorted(p._filters.items()):
+            if isinstance(fltr, sqltools.Filter):
+                for col in fltr.get_columns():
+                    if col.table != p.object_table:
+                        want(col.table, [col.col])
+            else:
+                # old-style SQL filter: index the WHERE clause columns
+                match = re.search(r'\sFROM\s+(.+?)\s+WHERE\s+(.*)$',
+                                  ' '.join(fltr.split()), re.IGNORECASE)
+                if match is None:
+                    continue
+                words = re.findall(r'[A-Za-z_]\w*',
+                                   re.sub(r'("[^"]*"|\'[^\']*\')', '', match.group(2)))
+                for table in [t.strip() for t in match.group(1).split(',')]:
+                    if table == p.object_table or table.lower() not in tables:
+                        continue
+                    colnames = self.GetColumnNames(table)
+                    for word in words:
+                        if word in colnames and word not in image_key_columns():
+                            want(table, [word])
+        # Drop duplicates and columns that don't exist
+        result = []
+        for table, cols in wanted:
+            colnames = [c.lower() for c in self.GetColumnNames(table)]
+            if (table, cols) not in result and all([c.lower() in colnames for c in cols]):
+                result.append((table, cols))
+        return result
+
+    def EnsureIndexes(self, create=False):
+        '''
+        Checks that the indexes CPA's queries rely on (see
+        GetRecommendedIndexes) exist, and creates the missing ones if create
+        is True. An existing index counts if its leading columns are the
+        recommended ones. Views are skipped.
+        returns a list of (table, columns) of the indexes that are missing
+        '''
+        t0 = time.time()
+        missing = []
+        indexed = {}
+        views = {}
+        for table, cols in self.GetRecommendedIndexes():
+            if table not in views:
+                views[table] = self.is_view(table)
+                if views[table]:
+                    logging.info('%s is a view. Skipping its index check.'%(table))
+            if views[table]:
+                continue
+            if table not in indexed:
+                indexed[table] = self.GetIndexedColumns(table)
+            lcols = tuple([c.lower() for c in cols])
+            if not any([idx[:len(lcols)] == lcols for idx in indexed[table]]):
+                missing.append((table, cols))
+        logging.info('Checked database indexes in %.2f seconds.'%(time.time() - t0))
+        if not missing:
+            return missing
+        for table, cols in missing:
+            logging.warn('Missing index on %s (%s).'%(table, ', '.join(cols)))
+        if not create:
+            return missing
+
+        still_missing = []
+        for table, cols in missing:
+            name = ('cpa_%s_%s'%(table, '_'.join(cols)))[:64]
+            logging.info('Creating index %s on %s (%s)...'%(name, table, ', '.join(cols)))
+            t0 = time.time()
+            try:
+                self.execute('CREATE INDEX %s ON %s (%s)'%(name, table, ', '.join(cols)))
+            except DBException, e:
+                # eg: TEXT columns in MySQL need a prefix length
+                logging.error('Could not create index %s: %s'%(name, e))
+                still_missing.append((table, cols))
+            else:
+                logging.info('Created index %s in %.2f seconds.'%(name, time.time() - t0))
+        self.Commit()
+        return still_missing
+
+    def bulk_insert(self, tablename, colnames, rows, batch_size=None, callback=None):
+        '''
+        Inserts rows into an existing table with parameterized inserts.
+        tablename -- the table to insert into
+        colnames -- the names of the columns that the row values go into
+        rows -- a 2D numpy array or any iterable of row sequences
+        batch_size -- number of rows sent per statement (INSERT_BATCH_ROWS by
+                      default)
+        callback -- optional function called with the number of rows inserted 
+                    so far after each batch. Return False to stop inserting.
+        NaN and inf values are inserted as NULL. Nothing is committed; callers
+        should Commit once all their rows are in.
+        returns the number of rows inserted
+        '''
+        connID = get_connection_id()
+        if not connID in self.connections.keys():
+            self.connect()
+        cursor = self.cursors[connID]
+        if p.db_type.lower() == 'mysql':
+            placeholder = '%s'
+        else:
+            placeholder = '?'
+        # MySQLdb rewrites executemany on an INSERT into multi-row INSERT
+        # statements, so one batch is one round trip on either backend.
+        query = 'INSERT INTO %s (%s) VALUES (%s)'%(tablename, ', '.join(colnames),
+                                                   ', '.join([placeholder] * len(colnames)))
+        if verbose:
+            logging.debug('[%s] %s'%(connID, query))
+        self._note_write(query)
+        nrows = 0
+        for batch in _insert_batches(rows, batch_size or INSERT_BATCH_ROWS):
+            try:
+                cursor.executemany(query, batch)
+            except Exception, e:
+                raise DBException, ('Bulk insert failed for connection "%s"'
+                                    '\nQuery was: "%s"'
+                                    '\nException was: %s'%(connID, query, e))
+            nrows += len(batch)
+            if callback is not None and callback(nrows) == False:
+                break
+        return nrows
+
     def insert_rows_into_table(self, tablename, colnames, coltypes, rows):
         '''Inserts the given rows into the table
         '''
-        for row in rows:
-            vals = []
-            for i, val in enumerate(row):
-                if (coltypes[i]=='FLOAT' and (np.isinf(val) or np.isnan(val))
-                    or val is None):
-                    vals += ['NULL']
-                else:
-                    vals += ['"%s"'%val]
-            vals = ', '.join(vals)
-            self.execute('INSERT INTO %s (%s) VALUES (%s)'%(
-                          tablename, ', '.join(colnames), vals), silent=True)
+        return self.bulk_insert(tablename, colnames, rows)
     
     def CreateTempTableFromData(self, dtable, colnames, tablename, temporary=True):
         '''Creates and populates a temporary table in the database.
         '''
-        return CreateTableFromData(dtable, colnames, tablename, temporary=temporary)
+        return self.CreateTableFromData(dtable, colnames, tablename, temporary=temporary)
     
     def CreateTableFromData(self, dtable, colnames, tablename, temporary=False, coltypes=None):
         '''Creates and populates a table in the database.
@@ -1496,12 +2873,14 @@ class DBConnect(Singleton):
         if coltypes is None:
             coltypes = self.InferColTypesFromData(dtable, len(colnames))
         self.create_empty_table(tablename, colnames, coltypes, temporary)
-        self.create_default_indexes_on_table(tablename)
         logging.info('Populating %stable %s...'%((temporary and 'temporary ' or ''), tablename))
-        self.insert_rows_into_table(tablename, colnames, coltypes, dtable)
+        self.bulk_insert(tablename, colnames, dtable)
+        # Indexing after the insert is cheaper than updating the indexes per row
+        self.create_default_indexes_on_table(tablename)
         self.Commit()
         return True
     
+    
     def is_view(self, table):
         if p.db_type == 'sqlite':
             return False
@@ -1512,30 +2891,31 @@ class DBConnect(Singleton):
     def CheckTables(self):
         '''
         Queries the DB to check that the per_image and per_object
-        tables agree on image numbers.
+        tables agree on image numbers, and that they are indexed.
         '''
+        # Check for (and, if create_indexes is on, create) missing indexes
+        missing = self.EnsureIndexes(create=(p.create_indexes == 'yes'))
+        key_indexes = [(p.image_table, tuple(image_key_columns()))]
+        if p.object_table:
+            key_indexes += [(p.object_table, tuple(object_key_columns()))]
+        missing_keys = [(t, cols) for t, cols in missing if (t, cols) in key_indexes]
+        if missing_keys:
+            import wx
+            wx.MessageDialog(self.gui_parent, 'The following indexes are missing:\n%s\n'
+                'Without them, database performance will be severely slowed.\n'
+                'Set create_indexes = yes in your properties file, or choose '
+                '"Check database indexes" from the Advanced menu, to create them. '
+                'To avoid this warning, set check_tables = false in your '
+                'properties file.'%('\n'.join(['  %s (%s)'%(t, ', '.join(cols))
+                                               for t, cols in missing_keys])),
+                'Missing column index', 
+                style=wx.OK|wx.ICON_EXCLAMATION).ShowModal()
+
         if p.db_type=='sqlite':
             logging.warn('Skipping table checking step for sqlite')
             return
 
         logging.info('Checking database tables...')
-        if not self.is_view(p.image_table):
-            # For now, don't check indices on views.
-            # Check for index on image_table
-            res = self.execute('SHOW INDEX FROM %s'%(p.image_table))
-            idx_cols = [r[4] for r in res]
-            for col in image_key_columns():
-                if col not in idx_cols:
-                    import wx
-                    wx.MessageDialog(self.gui_parent, 'Column "%s" is not indexed in table '
-                        '"%s" Without column indices, dabase performance will be '
-                        'severly slowed.\n'
-                        'To avoid this warning, set check_tables = false in your '
-                        'properties file.'%(col, p.object_table),
-                        'Missing column index', 
-                        style=wx.OK|wx.ICON_EXCLAMATION).ShowModal()
-        else:
-            logging.warn('%s is a view. CheckTables will skip the index check on this table'%(p.image_table))
 
         # Explicitly check for TableNumber in case it was not specified in props file
         if not p.object_table and 'TableNumber' in self.GetColumnNames(p.image_table):
@@ -1545,23 +2925,6 @@ class DBConnect(Singleton):
         if not p.object_table:
             return
         
-        if not self.is_view(p.object_table):
-            # Check for index on object_table
-            res = self.execute('SHOW INDEX FROM %s'%(p.object_table))
-            idx_cols = [r[4] for r in res]
-            for col in object_key_columns():
-                if col not in idx_cols:
-                    import wx
-                    wx.MessageDialog(self.gui_parent, 'Column "%s" is not indexed in table '
-                        '"%s" Without column indices, dabase performance will be '
-                        'severly slowed.\n'
-                        'To avoid this warning, set check_tables = false in your '
-                        'properties file.'%(col, p.object_table),
-                        'Missing column index', 
-                        style=wx.OK|wx.ICON_EXCLAMATION).ShowModal()
-        else:
-            logging.warn('%s is a view. CheckTables will skip the index check on this table'%(p.object_table))
-        
         # Explicitly check for TableNumber in case it was not specified in props file
         if ('TableNumber' not in object_key_columns()) and ('TableNumber' in self.GetColumnNames(p.object_table)):
             raise 'Indexed column "TableNumber" was found in the database but not in your properties file.'
@@ -1591,42 +2954,141 @@ class DBConnect(Singleton):
                 logging.warn('WARNING: Images were found in "%s" that had a NULL or empty "%s" column value'%(p.image_table, p.plate_id))
         logging.info('Done checking database tables.')
 
-    def histogram(self, column, table_or_query, nbins, range=None):
+    def _histogram_source(self, table_or_query):
+        '''Returns the from clause for table_or_query, which is a table name,
+        a from clause or a SELECT query.'''
+        if table_or_query.strip().lower().startswith('select'):
+            return '(%s) AS histogram_source'%(table_or_query)
+        return table_or_query
+
+    def _scaled(self, column, scale):
+        '''Returns (expr, condition): the SQL expression for column in the
+        given scale (LINEAR_SCALE, LOG_SCALE or LOG2_SCALE), and the condition
+        for the rows where it is defined.'''
+        if scale == LOG_SCALE:
+            return 'LOG10(%s)'%(column), '%s > 0'%(column)
+        elif scale == LOG2_SCALE:
+            return 'LOG2(%s)'%(column), '%s > 0'%(column)
+        elif scale == LINEAR_SCALE:
+            return column, '%s IS NOT NULL'%(column)
+        raise ValueError, 'Unknown scale "%s"'%(scale)
+
+    def _histogram_ranges(self, exprs, scales, table_clause, conditions, ranges):
+        '''Returns the [(lo, hi), ...] range of each of the scaled expressions
+        exprs. ranges are given in data units; where they are None the
+        range of the data is computed in the database.'''
+        if None in ranges:
+            aggs = ', '.join(['MIN(%s), MAX(%s)'%(expr, expr) for expr in exprs])
+            res = self.execute('SELECT %s FROM %s WHERE %s'%
+                               (aggs, table_clause, ' AND '.join(conditions)))[0]
+        out = []
+        for i, (rng, scale) in enumerate(zip(ranges, scales)):
+            if rng is None:
+                lo, hi = res[2*i], res[2*i+1]
+                if lo is None:
+                    # no rows
+                    lo, hi = 0., 1.
+                lo, hi = float(lo), float(hi)
+            else:
+                lo, hi = rng
+                if scale != LINEAR_SCALE and lo <= 0:
+                    raise ValueError, 'Log scale ranges must be positive.'
+                lo, hi = float(_to_scale(lo, scale)), float(_to_scale(hi, scale))
+            if lo == hi:
+                lo, hi = lo - 0.5, hi + 0.5
+            out.append((lo, hi))
+        return out
+
+    def _bin_expression(self, expr, nbins, lo, hi):
+        '''Returns the SQL expression for the bin (0 to nbins) of expr
+        between lo and hi. Values equal to hi fall in bin nbins.'''
+        scaled = '(%s - (%r)) * %r'%(expr, float(lo), nbins / float(hi - lo))
+        if p.db_type.lower() == 'sqlite':
+            # The value is non-negative, so truncation is the floor
+            return 'CAST(%s AS INTEGER)'%(scaled)
+        return 'FLOOR(%s)'%(scaled)
+
+    def histogram(self, column, table_or_query, nbins, range=None,
+                  scale=LINEAR_SCALE, where=None):
         """
-        Compute a 1-D histogram entirely in the database.
-        column          -- a single column name, as a string
-        table_or_query  -- either a table name or a subquery, as a string
+        Compute a 1-D histogram entirely in the database, so that only the
+        counts are transferred.
+        column          -- a single column name or expression, as a string
+        table_or_query  -- a table name, a from clause (eg: "t1, t2") or a
+                           SELECT query that column is selected from
         nbins           -- the number of desired bins in the histogram
-        range           -- the lower and upper range of the bins
+        range           -- the lower and upper range of the bins. By default
+                           the range of the data is used.
+        scale           -- LINEAR_SCALE, LOG_SCALE or LOG2_SCALE. With a log
+                           scale the bins are evenly spaced in the log of the
+                           values, and values <= 0 are left out.
+        where           -- (optional) conditions the rows must meet, eg: the
+                           where clause of a QueryBuilder with a filter
 
         Returns (hist, bin_edges), where hist is a numpy array of size
-        nbins and bin_edges is a numpy array of size nbins + 1.
+        nbins and bin_edges is a numpy array of size nbins + 1, in data units.
         """
-        if ' ' in table_or_query:
-            table_clause = "(%s) as foo"%(query,)
-        else:
-            table_clause = table_or_query
-
-        if range is None:
-            data = self.execute("select min(%s), max(%s) from %s" %
-                                (column, column, table_clause))
-            min = data[0][0]
-            max = data[0][1]
-        else:
-            min, max = range
-            
-        clause = ("round(%d * (%s - (%f)) / (%f - (%f)))" % 
-                  (nbins, column, min, max, min))
+        table_clause = self._histogram_source(table_or_query)
+        expr, cond = self._scaled(column, scale)
+        conditions = [cond] + ([where] if where else [])
+        [(lo, hi)] = self._histogram_ranges([expr], [scale], table_clause,
+                                            conditions, [range])
+
+        clause = self._bin_expression(expr, nbins, lo, hi)
+        conditions += ['%s >= %r'%(expr, lo), '%s <= %r'%(expr, hi)]
+        res = self.execute("SELECT %s AS bin, COUNT(*) FROM %s "
+                           "WHERE %s GROUP BY bin"%
+                           (clause, table_clause, ' AND '.join(conditions)))
         h = np.zeros(nbins)
-        res = self.execute("select %s as bin, count(*) from %s "
-                           "where %s <= %d "
-                           "group by %s order by bin" % (clause, table_clause,
-                                                         clause, nbins, clause))
-        for bin, count in res:
-            if bin == nbins:
-                bin -= 1
-            h[bin] = count
-        return h, np.linspace(min, max, nbins + 1)
+        if res:
+            bins, counts = [np.array(c, dtype=float) for c in zip(*res)]
+            # Values on the upper edge are counted in the last bin
+            h = np.bincount(np.minimum(bins.astype(int), nbins - 1),
+                            weights=counts, minlength=nbins)
+        return h, _from_scale(np.linspace(lo, hi, nbins + 1), scale)
+
+    def histogram2d(self, xcol, ycol, table_or_query, nx=50, ny=50, range=None,
+                    xscale=LINEAR_SCALE, yscale=LINEAR_SCALE, where=None):
+        '''
+        Compute a 2-D histogram entirely in the database, so that only the
+        counts are transferred.
+        xcol, ycol      -- the x and y columns or expressions, as strings
+        table_or_query  -- a table name, a from clause (eg: "t1, t2") or a
+                           SELECT query that xcol and ycol are selected from
+        nx, ny          -- the number of bins along x and y
+        range           -- [[xmin, xmax], [ymin, ymax]], the range of the 
+                           bins. By default the range of the data is used.
+        xscale, yscale  -- LINEAR_SCALE, LOG_SCALE or LOG2_SCALE, as for
+                           histogram
+        where           -- (optional) conditions the rows must meet
+        
+        Returns (hist, xedges, yedges) like np.histogram2d: hist is an 
+        nx by ny array of counts, and the bin edges are in data units.
+        '''
+        table_clause = self._histogram_source(table_or_query)
+        xexpr, xcond = self._scaled(xcol, xscale)
+        yexpr, ycond = self._scaled(ycol, yscale)
+        conditions = [xcond, ycond] + ([where] if where else [])
+        (xmin, xmax), (ymin, ymax) = self._histogram_ranges(
+            [xexpr, yexpr], [xscale, yscale], table_clause, conditions,
+            range or [None, None])
+        
+        xbin = self._bin_expression(xexpr, nx, xmin, xmax)
+        ybin = self._bin_expression(yexpr, ny, ymin, ymax)
+        conditions += ['%s >= %r'%(xexpr, xmin), '%s <= %r'%(xexpr, xmax),
+                       '%s >= %r'%(yexpr, ymin), '%s <= %r'%(yexpr, ymax)]
+        res = self.execute('SELECT %s AS xbin, %s AS ybin, COUNT(*) FROM %s '
+                           'WHERE %s GROUP BY xbin, ybin'%
+                           (xbin, ybin, table_clause, ' AND '.join(conditions)))
+        hist = np.zeros((nx, ny))
+        if res:
+            xbins, ybins, counts = [np.array(c, dtype=float) for c in zip(*res)]
+            # Values on the upper edge are counted in the last bins
+            idx = (np.minimum(xbins.astype(int), nx - 1) * ny +
+                   np.minimum(ybins.astype(int), ny - 1))
+            hist = np.bincount(idx, weights=counts, minlength=nx * ny).reshape(nx, ny)
+        return (hist, _from_scale(np.linspace(xmin, xmax, nx + 1), xscale),
+                _from_scale(np.linspace(ymin, ymax, ny + 1), yscale))
 
     def get_objects_modify_date(self):
         if p.db_type.lower() == 'mysql':
@@ -1634,6 +3096,22 @@ class DBConnect(Singleton):
         else:
             return os.path.getmtime(p.db_sqlite_file)
 
+    def get_table_modify_dates(self, tables):
+        '''Returns a dict mapping each of the given tables to the time it was
+        last modified, or None where that isn't known. With SQLite this is 
+        the modification time of the database file.'''
+        if len(tables) == 0:
+            return {}
+        if p.db_type.lower() == 'mysql':
+            res = self.execute("SELECT TABLE_NAME, UPDATE_TIME FROM INFORMATION_SCHEMA.TABLES "
+                               "WHERE TABLE_SCHEMA='%s' AND TABLE_NAME IN (%s)"%(
+                               p.db_name, ', '.join(["'%s'"%(t) for t in tables])))
+            dates = dict(res)
+            return dict([(t, dates.get(t)) for t in tables])
+        else:
+            mtime = os.path.getmtime(p.db_sqlite_file)
+            return dict([(t, mtime) for t in tables])
+
     def verify_objects_modify_date_earlier(self, later):
         cur = self.get_objects_modify_date()
         return self.get_objects_modify_date() <= later
@@ -1642,6 +3120,83 @@ class DBConnect(Singleton):
         self.gui_parent = parent
 
         
+KEYSET_INLINE_BYTES = 50000
+_keyset_ids = itertools.count()
+
+class KeySet(object):
+    '''
+    A set of image keys or object keys to restrict a query to. Small sets 
+    are written into the query as a WHERE clause. When that clause would be
+    longer than KEYSET_INLINE_BYTES, the keys are loaded into a temporary 
+    table instead and the clause refers to that table. Temporary tables 
+    belong to a connection, so queries using the clause must run on the 
+    same thread, before the KeySet is closed. 
+    Example:
+        with KeySet(imkeys) as keys:
+            db.execute('SELECT * FROM %s WHERE %s'%(p.image_table, 
+                                                    keys.where_clause()))
+    '''
+    def __init__(self, keys):
+        self.keys = sorted(set([tuple(k) for k in keys]))
+        self.is_image_keys = (len(self.keys) == 0 or 
+                              len(self.keys[0]) == len(image_key_columns()))
+        if self.is_image_keys:
+            self.key_cols = list(image_key_columns())
+        else:
+            self.key_cols = list(object_key_columns())
+        self.table = None
+        self.inline = {}
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, type, value, tb):
+        self.close()
+        
+    def __len__(self):
+        return len(self.keys)
+
+    def where_clause(self, table_name=None):
+        '''
+        Returns a SQL condition that matches rows whose key is in the set.
+        table_name -- the table (or alias) to take the key columns from, if
+                      the query reads more than one table.
+        '''
+        if len(self.keys) == 0:
+            return '(1=0)'
+        if self.table is None:
+            if table_name not in self.inline:
+                if self.is_image_keys:
+                    clause = GetWhereClauseForImages(list(self.keys), table_name)
+                else:
+                    clause = GetWhereClauseForObjects(self.keys, table_name)
+                self.inline[table_name] = '(%s)'%(clause)
+            if len(self.inline[table_name]) <= KEYSET_INLINE_BYTES:
+                return self.inline[table_name]
+            self._create_table()
+        if len(self.key_cols) == 1:
+            col = (table_name and table_name + '.' or '') + self.key_cols[0]
+            return '(%s IN (SELECT %s FROM %s))'%(col, self.key_cols[0], self.table)
+        if table_name is None:
+            table_name = self.is_image_keys and p.image_table or p.object_table
+        return '(EXISTS (SELECT 1 FROM %s k WHERE %s))'%(self.table, 
+                    ' AND '.join(['k.%s=%s.%s'%(col, table_name, col) for col in self.key_cols]))
+
+    def _create_table(self):
+        db = DBConnect.getInstance()
+        self.table = '_cpa_keys_%d'%(_keyset_ids.next())
+        db.execute('CREATE TEMPORARY TABLE %s (%s, PRIMARY KEY (%s))'%(self.table, 
+                   ', '.join(['%s INT'%(col) for col in self.key_cols]), 
+                   ', '.join(self.key_cols)))
+        db.bulk_insert(self.table, self.key_cols, self.keys, batch_size=10000)
+        
+    def close(self):
+        '''Drops the temporary table, if one was made.'''
+        if self.table is not None:
+            DBConnect.getInstance().drop_temporary_table(self.table)
+            self.table = None
+    
+
 class Entity(object):
     """Abstract class containing code that is common to Images and
     Objects.  Do not instantiate directly."""
@@ -1668,10 +3223,28 @@ class Entity(object):
             n -- a non-negative integer or None
 
             If n is None or n >= length, return all results.
+            The results are read in batches and reservoir sampled, so only
+            the sample is kept in memory.
             """
-            list = self.db._get_results_as_list()
-            n = min(n, len(self))
-            return random.sample(list, n)
+            cursor = self.db.cursors[get_connection_id()]
+            sample = []
+            seen = 0
+            while True:
+                rows = cursor.fetchmany(10000)
+                if len(rows) == 0:
+                    self.db._end_fetch()
+                    break
+                self.db._note_fetched(rows)
+                for row in rows:
+                    if n is None or seen < n:
+                        sample.append(row)
+                    else:
+                        i = random.randint(0, seen)
+                        if i < n:
+                            sample[i] = row
+                    seen += 1
+            random.shuffle(sample)
+            return sample
 
         def next(self):
             try:
@@ -1682,7 +3255,8 @@ class Entity(object):
                     raise StopIteration
             except GeneratorExit:
                 print "GeneratorExit"
-                self.db.cursors[connID].fetchall()
+                self.db._note_fetched(self.db.cursors[get_connection_id()].fetchall())
+                self.db._end_fetch()
 
     def __init__(self):
         self._where = []
@@ -1739,12 +3313,60 @@ class Entity(object):
     def count(self):
         c = DBConnect.getInstance().execute(self.all_query(columns=["COUNT(*)"]))[0][0]
         c = max(0, c - (self._offset or 0))
-        c = max(c, self._limit or 0)
+        if self._limit is not None:
+            c = min(c, self._limit)
         return c
 
     def all(self):
         return self.dbiter(self, DBConnect.getInstance())
 
+    def iter_batches(self, n=10000):
+        """
+        Yields the results as numpy structured arrays of at most n rows, 
+        reading them from the database as they're needed. No other query 
+        may be run on this thread until the iteration is done.
+
+        >>> for block in Objects().project([feature]).iter_batches(100000):
+        ...     total += block[feature].sum()
+        """
+        return DBConnect.getInstance().iter_execute_to_arrays(
+            self.all_query(), chunk_rows=n, structured=True)
+
+    def to_array(self, n=100000):
+        """Returns all the results as a numpy structured array, reading
+        them n rows at a time."""
+        return DBConnect.getInstance().execute_to_arrays(
+            self.all_query(), chunk_rows=n, structured=True)
+
+    def sample(self, n, batch_size=10000):
+        """
+        Returns a uniform random sample of n of the results (or all of them
+        if there are fewer) as a numpy structured array. The results are 
+        read in batches and reservoir sampled, so only the sample is kept 
+        in memory.
+        """
+        names = sample = None
+        seen = 0
+        for block in self.iter_batches(batch_size):
+            if sample is None:
+                names = block.dtype.names
+                sample = [block[name][:0] for name in names]
+            # Row i of the results fills the sample until it has n rows, 
+            # then replaces a random row with probability n / (i + 1).
+            fill = max(0, min(n - seen, len(block)))
+            i = np.arange(seen + fill, seen + len(block))
+            slots = (np.random.random(len(i)) * (i + 1)).astype(np.int64)
+            replace = slots < n
+            for f, name in enumerate(names):
+                col = block[name]
+                dtype = np.promote_types(sample[f].dtype, col.dtype)
+                sample[f] = np.concatenate([sample[f].astype(dtype), col[:fill]])
+                sample[f][slots[replace]] = col[fill:][replace]
+            seen += len(block)
+        if sample is None:
+            return self.to_array()
+        return _structured_array(names, sample)
+
     def all_query(self, columns=None):
         return "SELECT %s FROM %s %s %s %s %s" % (
             ",".join(columns or self.columns()),
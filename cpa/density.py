@@ -5,6 +5,7 @@ from multiclasssql import filter_table_prefix
 from properties import Properties
 import guiutils as ui 
 from gating import GatingHelper
+from util import heatmap_from_histogram
 from wx.combo import OwnerDrawnComboBox as ComboBox
 import imagetools
 import logging
@@ -118,6 +119,9 @@ class DataSourcePanel(wx.Panel):
         self.gate_choice.addobserver(self.on_gate_selected)
         wx.EVT_COMBOBOX(self.colormap_choice, -1, self.on_cmap_selected)
         wx.EVT_BUTTON(self.update_chart_btn, -1, self.update_figpanel)
+        # The counts are binned in the background so the window stays
+        # responsive
+        self.points_query = ui.BackgroundQuery(self, self.update_chart_btn)
         
         self.SetSizer(sizer)
         self.Show(1)
@@ -204,9 +208,28 @@ class DataSourcePanel(wx.Panel):
                 or (self.y_column.table != p.image_table and db.adjacent(p.object_table, self.y_column.table))
                 )
         
-    def update_figpanel(self, evt=None):
+    def update_figpanel(self, evt=None, then=None):
+        '''
+        Bins the points in the database in the background and plots the 
+        counts when they arrive.
+        then -- a function to call once the counts are plotted
+        '''
+        if evt is not None and self.points_query.running():
+            # The update button reads "Cancel" while the counts are loading
+            self.points_query.cancel()
+            return
         self.gate_choice.set_gatable_columns([self.x_column, self.y_column])
-        points = self._load_points()
+        gridsize = int(self.gridsize_input.GetValue())
+        q = self._points_query()
+        self.points_query.submit(
+            lambda res: self._plot_histogram(res, then),
+            str(self.x_column), 'histogram2d', ycol=str(self.y_column),
+            table_or_query=q.get_from_clause(), where=q.get_where_clause(),
+            nx=gridsize, ny=gridsize,
+            xscale=self.x_scale_choice.GetStringSelection(),
+            yscale=self.y_scale_choice.GetStringSelection())
+
+    def _plot_histogram(self, (hist, xedges, yedges), then=None):
         self.figpanel.setgridsize(int(self.gridsize_input.GetValue()))
         self.figpanel.set_x_scale(self.x_scale_choice.GetStringSelection())
         self.figpanel.set_y_scale(self.y_scale_choice.GetStringSelection())
@@ -214,18 +237,20 @@ class DataSourcePanel(wx.Panel):
         self.figpanel.set_x_label(self.x_column.col)
         self.figpanel.set_y_label(self.y_column.col)
         self.figpanel.set_colormap(self.colormap_choice.GetStringSelection())
-        self.figpanel.setpointslists(points)
+        self.figpanel.sethistogram(hist, xedges, yedges)
         self.figpanel.draw()
         self.update_gate_helper()
+        if then is not None:
+            then()
         
-    def _load_points(self):
+    def _points_query(self):
         q = sql.QueryBuilder()
         select = [self.x_column, self.y_column]
         q.set_select_clause(select)
         if self.filter != None:
             q.add_filter(self.filter)
             
-        return db.execute(str(q))
+        return q
         
     def save_settings(self):
         '''save_settings is called when saving a workspace to file.
@@ -281,16 +306,17 @@ class DataSourcePanel(wx.Panel):
             self.color_scale_choice.SetStringSelection(settings['color scale'])
         if 'filter' in settings:
             self.filter_choice.SetStringSelection(settings['filter'])
-        self.update_figpanel()
-        if 'x-lim' in settings:
-            self.figpanel.subplot.set_xlim(eval(settings['x-lim']))
-        if 'y-lim' in settings:
-            self.figpanel.subplot.set_ylim(eval(settings['y-lim']))
-        if 'gate' in settings:
-            self.gate_choice.SetStringSelection(settings['gate'])
-            self.figpanel.gate_helper.set_displayed_gate(
-                p.gates[settings['gate']], self.x_column, self.y_column)
-        self.figpanel.draw()
+        def set_view():
+            if 'x-lim' in settings:
+                self.figpanel.subplot.set_xlim(eval(settings['x-lim']))
+            if 'y-lim' in settings:
+                self.figpanel.subplot.set_ylim(eval(settings['y-lim']))
+            if 'gate' in settings:
+                self.gate_choice.SetStringSelection(settings['gate'])
+                self.figpanel.gate_helper.set_displayed_gate(
+                    p.gates[settings['gate']], self.x_column, self.y_column)
+            self.figpanel.draw()
+        self.update_figpanel(then=set_view)
 
         
 class DensityPanel(FigureCanvasWxAgg):
@@ -306,7 +332,7 @@ class DensityPanel(FigureCanvasWxAgg):
         self.gate_helper = GatingHelper(self.subplot, self)
 
         self.navtoolbar = None
-        self.point_list = []
+        self.histogram = None
         self.gridsize = 50
         self.cb = None
         self.x_scale = LINEAR_SCALE
@@ -318,39 +344,36 @@ class DensityPanel(FigureCanvasWxAgg):
         
         self.canvas.mpl_connect('button_release_event', self.on_release)
     
-    def setpointslists(self, points):
+    def sethistogram(self, hist, xedges, yedges):
+        '''
+        Plots a 2-D histogram of the points, as computed by 
+        DBConnect.histogram2d with this panel's gridsize and x and y scales.
+        '''
         self.subplot.clear()
-        self.point_list = points        
-        plot_pts = np.array(points).astype(float)
-        
-        if self.x_scale == LOG_SCALE:
-            plot_pts = plot_pts[(plot_pts[:,0]>0)]
-        if self.y_scale == LOG_SCALE:
-            plot_pts = plot_pts[(plot_pts[:,1]>0)]
+        self.histogram = (hist, xedges, yedges)
+        counts, extent = heatmap_from_histogram(hist, xedges, yedges,
+                                                logscale=(self.color_scale==LOG_SCALE))
+        # Leave empty bins blank
+        counts = np.ma.masked_equal(counts, 0)
         
-        hb = self.subplot.hexbin(plot_pts[:, 0], plot_pts[:, 1], 
-                                 gridsize=self.gridsize,
-                                 xscale=self.x_scale,
-                                 yscale=self.y_scale,
-                                 bins=self.color_scale,
-                                 cmap=matplotlib.cm.get_cmap(self.cmap))
+        mesh = self.subplot.pcolormesh(xedges, yedges, counts,
+                                       cmap=matplotlib.cm.get_cmap(self.cmap))
+        self.subplot.set_xscale(self.x_scale)
+        self.subplot.set_yscale(self.y_scale)
         
         if self.cb:
             # Remove the existing colorbar and reclaim the space so when we add
-            # a colorbar to the new hexbin subplot, it doesn't get indented.
+            # a colorbar to the new subplot, it doesn't get indented.
             self.figure.delaxes(self.figure.axes[1])
             self.figure.subplots_adjust(right=0.90)
-        self.cb = self.figure.colorbar(hb)
+        self.cb = self.figure.colorbar(mesh)
         if self.color_scale==LOG_SCALE:
             self.cb.set_label('log10(N)')
         
         self.subplot.set_xlabel(self.x_label)
         self.subplot.set_ylabel(self.y_label)
         
-        xmin = np.nanmin(plot_pts[:,0])
-        xmax = np.nanmax(plot_pts[:,0])
-        ymin = np.nanmin(plot_pts[:,1])
-        ymax = np.nanmax(plot_pts[:,1])
+        xmin, xmax, ymin, ymax = extent
 
         # Pad all sides
         if self.x_scale==LOG_SCALE:
@@ -371,8 +394,9 @@ class DensityPanel(FigureCanvasWxAgg):
     
         self.reset_toolbar()
     
-    def getpointslists(self):
-        return self.point_list
+    def gethistogram(self):
+        '''returns the (hist, xedges, yedges) last plotted'''
+        return self.histogram
     
     def setgridsize(self, gridsize):
         self.gridsize = gridsize
@@ -31,6 +31,7 @@ from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg as Canvas
 from matplotlib.backends.backend_wx import NavigationToolbar2Wx
 from imagetools import ShowImage
 from dbconnect import DBConnect
+from objectcoords import ObjectCoordsCache
 from properties import Properties
 
 SVD = 'SVD: Singular Value Decomposition'
@@ -122,7 +123,7 @@ class PlotPanel(wx.Panel):
         imViewer = ShowImage(self.actual_key[:-1], self.chMap[:],
                              parent=self.classifier, brightness=1.0,
                              contrast=None)
-        imViewer.imagePanel.SelectPoint(db.GetObjectCoords(self.actual_key))
+        imViewer.imagePanel.SelectPoint(ObjectCoordsCache.getInstance().GetObjectCoords(self.actual_key))
 
     def hide_show_legend(self, event):
         '''
@@ -569,23 +570,19 @@ class PlotMain(wx.Frame):
         self.filter_col_names(p.object_table)
          
         all_keys = map(db.GetObjectsFromImage, db.GetAllImageKeys())
-
-        obj_counts = db.GetPerImageObjectCounts()
-        total_obj_count = sum(k[1] for k in obj_counts) 
-
-        for key in all_keys:
-            if key:
-                measurements = len(db.GetCellDataForClassifier(key[0]))
-                break
-
-        data = np.zeros((total_obj_count, measurements))
-        data_dic = {}
         key_list = [key for image_keys in all_keys for key in image_keys]
-        nKeys = float(len(key_list))
-        for index, key in enumerate(key_list):
-            cb(index / nKeys)
-            data[index, :] = db.GetCellDataForClassifier(key)
-            data_dic[index] = key
+        if db.classifierColNames is None:
+            db.GetColnamesForClassifier()
+
+        # Fetch the measurements a batch of objects per query
+        BATCH_SIZE = 5000
+        data = np.zeros((len(key_list), len(db.classifierColNames)))
+        for start in xrange(0, len(key_list), BATCH_SIZE):
+            if cb:
+                cb(start / float(len(key_list)))
+            batch = key_list[start : start + BATCH_SIZE]
+            data[start : start + len(batch)] = db.GetCellDataBatch(batch, db.classifierColNames)
+        data_dic = dict(enumerate(key_list))
 
         return data, data_dic
 
@@ -732,8 +732,100 @@ class BitmapPopup(wx.MiniFrame):
         dc.DrawBitmap(self.bmp, 0, 0)
         dc.EndDrawing()
 
-        
-        
+
+
+# Event posted to a window when a query run by its BackgroundQuery finishes
+EVT_QUERY_DONE_ID = wx.NewId()
+
+def EVT_QUERY_DONE(win, func):
+    '''
+    Any class that wishes to handle QueryDoneEvents must call this function
+    with itself as the first parameter, and a handler as the second parameter.
+    '''
+    win.Connect(-1, -1, EVT_QUERY_DONE_ID, func)
+
+
+class QueryDoneEvent(wx.PyEvent):
+    '''
+    This event is posted when a background query finishes. data is the
+    query's dbconnect.QueryFuture.
+    '''
+    def __init__(self, data):
+        wx.PyEvent.__init__(self)
+        self.SetEventType(EVT_QUERY_DONE_ID)
+        self.data = data
+
+
+class BackgroundQuery(object):
+    '''
+    Runs a window's queries in the background (see DBConnect.submit) so the
+    window stays responsive while they run. One query runs at a time:
+    submitting a new one cancels the last, as does destroying the window.
+    win -- the window the results are delivered to
+    button -- a button to relabel "Cancel" while a query is running. The
+              button's handler should call cancel() if running() is True.
+    '''
+    def __init__(self, win, button=None):
+        self.win = win
+        self.button = button
+        self.button_label = button and button.GetLabel()
+        self.future = None
+        self.handler = None
+        EVT_QUERY_DONE(win, self._on_query_done)
+        win.Bind(wx.EVT_WINDOW_DESTROY, self._on_destroy)
+
+    def submit(self, handler, query, method='execute', **kwargs):
+        '''
+        Cancels the running query, if any, and runs this one with the given
+        DBConnect method (see DBConnect.submit). handler(result) is called
+        on the main thread when the query finishes, unless it is cancelled.
+        '''
+        self.cancel()
+        self.handler = handler
+        self.future = db.submit(query, method, **kwargs)
+        self.future.add_done_callback(self._post)
+        if self.button:
+            self.button.SetLabel('Cancel')
+        return self.future
+
+    def running(self):
+        return self.future is not None
+
+    def cancel(self):
+        if self.future is not None:
+            future, self.future = self.future, None
+            future.cancel()
+            logging.info('Query cancelled.')
+        if self.button:
+            self.button.SetLabel(self.button_label)
+
+    def _post(self, future):
+        # called from the query worker thread
+        if future is self.future and self.win:
+            wx.PostEvent(self.win, QueryDoneEvent(future))
+
+    def _on_query_done(self, evt):
+        future = evt.data
+        if future is not self.future:
+            # cancelled, or a query of another BackgroundQuery on this window
+            evt.Skip()
+            return
+        self.future = None
+        if self.button:
+            self.button.SetLabel(self.button_label)
+        try:
+            result = future.result()
+        except dbconnect.DBQueryCancelledException:
+            return
+        self.handler(result)
+
+    def _on_destroy(self, evt):
+        if evt.GetEventObject() == self.win:
+            self.button = None
+            self.cancel()
+        evt.Skip()
+
+
 def show_objects_from_gate(gatename, warn=100):
     '''Launch a CellMontageFrame with the objects in the specified gate.
     gatename -- name of the gate to apply
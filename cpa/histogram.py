@@ -94,6 +94,9 @@ class DataSourcePanel(wx.Panel):
         wx.EVT_COMBOBOX(self.table_choice, -1, self.on_table_selected)
         wx.EVT_BUTTON(self.update_chart_btn, -1, self.update_figpanel)
         self.gate_choice.addobserver(self.on_gate_selected)
+        # The counts are binned in the background so the window stays
+        # responsive
+        self.points_query = ui.BackgroundQuery(self, self.update_chart_btn)
         
         self.SetSizer(sizer)
         self.Show(1)
@@ -147,25 +150,43 @@ class DataSourcePanel(wx.Panel):
                 or (self.x_column.table != p.image_table and db.adjacent(p.object_table, self.x_column.table))
                 )
         
-    def update_figpanel(self, evt=None):
+    def update_figpanel(self, evt=None, then=None):
+        '''
+        Bins the column in the database in the background and plots the
+        counts when they arrive.
+        then -- a function to call once the counts are plotted
+        '''
+        if evt is not None and self.points_query.running():
+            # The update button reads "Cancel" while the counts are loading
+            self.points_query.cancel()
+            return
         self.gate_choice.set_gatable_columns([self.x_column])
-        points = self._load_points()
-        bins = int(self.bins_input.GetValue())
+        q = self._points_query()
+        self.points_query.submit(
+            lambda res: self._plot_histogram(res, then),
+            str(self.x_column), 'histogram',
+            table_or_query=q.get_from_clause(), where=q.get_where_clause(),
+            nbins=int(self.bins_input.GetValue()),
+            scale=self.x_scale_choice.GetStringSelection())
+
+    def _plot_histogram(self, (hist, bin_edges), then=None):
         self.figpanel.set_x_label(self.x_column.col)
         self.figpanel.set_x_scale(self.x_scale_choice.GetStringSelection())
         self.figpanel.set_y_scale(self.y_scale_choice.GetStringSelection())
-        self.figpanel.setpoints(points, bins)
+        self.figpanel.sethistogram(hist, bin_edges)
         self.update_gate_helper()
         self.figpanel.draw()
+        if then is not None:
+            then()
         
-    def _load_points(self):
+    def _points_query(self):
         q = sql.QueryBuilder()
         select = [self.x_column]
         q.set_select_clause(select)
         if self.filter is not None:
             q.add_filter(self.filter)
             
-        return np.array(db.execute(str(q))).T[0]
+        return q
 
     def save_settings(self):
         '''save_settings is called when saving a workspace to file.
@@ -202,20 +223,21 @@ class DataSourcePanel(wx.Panel):
             self.y_scale_choice.SetStringSelection(settings['y-scale'])
         if 'filter' in settings:
             self.filter_choice.SetStringSelection(settings['filter'])
-        self.update_figpanel()
-        if 'x-lim' in settings:
-            self.figpanel.subplot.set_xlim(eval(settings['x-lim']))
-        if 'y-lim' in settings:
-            self.figpanel.subplot.set_ylim(eval(settings['y-lim']))
-        if 'gate' in settings:
-            self.gate_choice.SetStringSelection(settings['gate'])
-            self.figpanel.gate_helper.set_displayed_gate(
-                p.gates[settings['gate']], self.x_column, None)
-        self.figpanel.draw()
+        def set_view():
+            if 'x-lim' in settings:
+                self.figpanel.subplot.set_xlim(eval(settings['x-lim']))
+            if 'y-lim' in settings:
+                self.figpanel.subplot.set_ylim(eval(settings['y-lim']))
+            if 'gate' in settings:
+                self.gate_choice.SetStringSelection(settings['gate'])
+                self.figpanel.gate_helper.set_displayed_gate(
+                    p.gates[settings['gate']], self.x_column, None)
+            self.figpanel.draw()
+        self.update_figpanel(then=set_view)
         
 
 class HistogramPanel(FigureCanvasWxAgg):
-    def __init__(self, parent, points, bins=100, **kwargs):
+    def __init__(self, parent, **kwargs):
         self.figure = Figure()
         FigureCanvasWxAgg.__init__(self, parent, -1, self.figure, **kwargs)
         self.canvas = self.figure.canvas
@@ -232,48 +254,36 @@ class HistogramPanel(FigureCanvasWxAgg):
         self.x_label = ''
         self.log_y = False
         self.x_scale = LINEAR_SCALE
-        self.setpoints(points, bins)
         
         self.canvas.mpl_connect('button_release_event', self.on_release)
                 
-    def setpoints(self, points, bins):
+    def sethistogram(self, hist, bin_edges):
         ''' Updates the data to be plotted and redraws the plot.
-        points - array of samples
-        bins - number of bins to aggregate points in
+        hist - the count in each bin, as computed by DBConnect.histogram
+               with this panel's x scale
+        bin_edges - the edges of the bins, in data units
         '''
-        points = np.array(points).astype('f')
-        self.bins = bins
-        x_label = self.x_label
-
         self.subplot.clear()
-        # log xform the data, ignoring non-positives
-        # XXX: This will not work for selection since the data is changed
-        if self.x_scale in [LOG_SCALE, LOG2_SCALE]:
-            if self.x_scale == LOG_SCALE:
-                points = np.log(points[points>0])
-                x_label = 'Log(%s)'%(self.x_label)
-            elif self.x_scale == LOG2_SCALE:
-                points = np.log2(points[points>0])
-                x_label = 'Log2(%s)'%(self.x_label)
-            ignored = len(points[points<=0])
-            if ignored>0:
-                logging.warn('Histogram ignored %s negative value%s.'%
-                             (ignored, (ignored!=1 and's' or '')))
-
-        # hist apparently doesn't like nans, need to preen them out first
-        points = points[~ np.isnan(points)]
-        
         # nothing to plot?
-        if len(points)==0:
+        if np.sum(hist) == 0:
             logging.warn('No data to plot.')
             return
         
-        self.subplot.hist(points, self.bins, 
+        # Plot the counts as weights of the bin centers, so the bars look
+        # just like a histogram of the points.
+        self.subplot.hist((bin_edges[:-1] + bin_edges[1:]) / 2.0, bin_edges,
+                          weights=hist,
                           facecolor=[0.0,0.62,1.0], 
                           edgecolor='none',
                           log=self.log_y,
                           alpha=0.75)
-        self.subplot.set_xlabel(x_label)
+        # The x axis stays in data units on log scales, so gates drawn on
+        # the plot apply to the column values.
+        if self.x_scale == LOG_SCALE:
+            self.subplot.set_xscale('log')
+        elif self.x_scale == LOG2_SCALE:
+            self.subplot.set_xscale('log', basex=2)
+        self.subplot.set_xlabel(self.x_label)
         self.reset_toolbar()
     
     def set_x_label(self, label):
@@ -296,7 +306,7 @@ class HistogramPanel(FigureCanvasWxAgg):
         return self.navtoolbar
 
     def reset_toolbar(self):
-        '''Clears the navigation toolbar history. Called after setpoints.'''
+        '''Clears the navigation toolbar history. Called after sethistogram.'''
         # Cheat since there is no way reset
         if self.navtoolbar:
             self.navtoolbar._views.clear()
@@ -359,8 +369,7 @@ class Histogram(wx.Frame, CPATool):
         CPATool.__init__(self)
         self.SetName(self.tool_name)
         self.SetBackgroundColour(wx.NullColor)
-        points = []
-        figpanel = HistogramPanel(self, points)
+        figpanel = HistogramPanel(self)
         configpanel = DataSourcePanel(self, figpanel)
         figpanel.set_configpanel(configpanel)
         self.SetToolBar(figpanel.get_toolbar())
@@ -3,6 +3,7 @@ A special image panel meant to be dragged and dropped.
 '''
 from dbconnect import DBConnect
 from imagepanel import ImagePanel
+from objectcoords import ObjectCoordsCache
 from properties import Properties
 import imagetools
 import cPickle
@@ -102,7 +103,7 @@ class ImageTile(ImagePanel):
                 imViewer = imagetools.ShowImage(obKey[:-1], self.chMap[:], parent=self.classifier,
                                         brightness=self.brightness, contrast=self.contrast,
                                         scale=self.scale)
-                imViewer.imagePanel.SelectPoint(db.GetObjectCoords(obKey))
+                imViewer.imagePanel.SelectPoint(ObjectCoordsCache.getInstance().GetObjectCoords(obKey))
         elif choice == 1:
             self.bin.SelectAll()
         elif choice == 2:
@@ -116,7 +117,7 @@ class ImageTile(ImagePanel):
         imViewer = imagetools.ShowImage(self.obKey[:-1], list(self.chMap), parent=self.classifier,
                                         brightness=self.brightness, contrast=self.contrast,
                                         scale=self.scale)
-        imViewer.imagePanel.SelectPoint(db.GetObjectCoords(self.obKey))
+        imViewer.imagePanel.SelectPoint(ObjectCoordsCache.getInstance().GetObjectCoords(self.obKey))
         
     def Select(self):
         if not self.selected:
@@ -11,6 +11,7 @@
 
 from dbconnect import *
 from datamodel import DataModel
+from objectcoords import ObjectCoordsCache
 from imagecontrolpanel import *
 from imagepanel import ImagePanel
 from properties import Properties
@@ -22,6 +23,7 @@ import wx
 
 p = Properties.getInstance()
 db = DBConnect.getInstance()
+coord_cache = ObjectCoordsCache.getInstance()
 
 REQUIRED_PROPERTIES = ['channels_per_image','image_channel_colors', 'object_name', 'image_names', 'image_id']
 
@@ -163,7 +165,7 @@ class ImageViewerPanel(ImagePanel):
     def ToggleObjectNumbers(self):
         self.show_object_numbers = not self.show_object_numbers
         if self.show_object_numbers:
-            self.ob_coords = db.GetAllObjectCoordsFromImage(self.img_key)
+            self.ob_coords = coord_cache.GetAllObjectCoordsFromImage(self.img_key)
         self.Refresh()
 
     def ToggleClassRepresentation(self):
@@ -489,7 +491,7 @@ class ImageViewer(wx.Frame):
         # Get object coordinates in image and display
         classCoords = {}
         for className, obKeys in classHits.items():
-            classCoords[className] = [db.GetObjectCoords(key) for key in obKeys]
+            classCoords[className] = coord_cache.GetObjectsCoords(obKeys)
         self.SetClasses(classCoords)
 
     def OnPaneChanged(self, evt=None):
@@ -560,8 +562,8 @@ class ImageViewer(wx.Frame):
 
     def SelectAll(self):
         if p.object_table:
-            coords = db.GetAllObjectCoordsFromImage(self.img_key)
-            self.selection = db.GetObjectsFromImage(self.img_key)
+            coords = coord_cache.GetAllObjectCoordsFromImage(self.img_key)
+            self.selection = coord_cache.GetObjectsFromImage(self.img_key)
             if p.rescale_object_coords:
                 coords = [rescale_image_coord_to_display(x, y) for (x, y) in coords]
             self.imagePanel.SetSelectedPoints(coords)
@@ -571,7 +573,7 @@ class ImageViewer(wx.Frame):
         self.imagePanel.DeselectAll()
 
     def SelectObject(self, obkey):
-        coord = db.GetObjectCoords(obkey)
+        coord = coord_cache.GetObjectCoords(obkey)
         if p.rescale_object_coords:
             coord = rescale_image_coord_to_display(coord[0], coord[1])
         self.selection += [coord]
@@ -590,7 +592,7 @@ class ImageViewer(wx.Frame):
             y = evt.GetPosition().y / self.imagePanel.scale
             if p.rescale_object_coords:
                 x, y = rescale_display_coord_to_image(x, y)
-            obKey = db.GetObjectNear(self.img_key, x, y)
+            obKey = coord_cache.GetObjectNear(self.img_key, x, y)
 
             if not obKey: return
 
@@ -605,7 +607,7 @@ class ImageViewer(wx.Frame):
                     self.selection.remove(obKey)
 
             # select the object
-            (x,y) = db.GetObjectCoords(obKey)            
+            (x,y) = coord_cache.GetObjectCoords(obKey)
             if p.rescale_object_coords:
                 x, y = rescale_image_coord_to_display(x, y)
             self.imagePanel.TogglePointSelection((x,y))
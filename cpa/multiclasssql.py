@@ -1,17 +1,35 @@
+from __future__ import with_statement
+import hashlib
 import numpy
 import sys
+import logging
 from dbconnect import *
 from properties import Properties
 from datamodel import DataModel
+import scoring
+from stumpmodel import StumpModel
 
 db = DBConnect.getInstance()
 p = Properties.getInstance()
 dm = DataModel.getInstance()
 
 temp_stump_table = "_stump"
-temp_score_table = "_scores"
-temp_class_table = "_class"
 filter_table_prefix = '_filter_'
+# The score table is computed again after this many updates in a row, so
+# that rounding errors don't build up in the scores
+MAX_SCORE_TABLE_UPDATES = 20
+
+def has_classifier_function():
+    '''
+    Returns whether the database has a compiled stump classifier function:
+    the classifier UDF on MySQL or the extension in sqlite_plugins on SQLite.
+    '''
+    if p.db_type.lower() == 'sqlite':
+        return db.has_sqlite_classifier_extension()
+    try:
+        return len(db.execute("SELECT * from mysql.func where name='classifier'")) > 0
+    except:
+        return False
 
 def translate(weaklearners):
     '''
@@ -21,22 +39,19 @@ def translate(weaklearners):
     num_features = len(weaklearners)
     nClasses = len(weaklearners[0][2])
 
-    has_classifier_function = False
     if p.db_type.lower() == 'sqlite':
         thresholds = numpy.array([wl[1] for wl in weaklearners])
         a = numpy.array([wl[2] for wl in weaklearners])
         b = numpy.array([wl[3] for wl in weaklearners])
+        if db.has_sqlite_classifier_extension():
+            return "stump_classifier('%s', %s)"%(stump_model_string(thresholds, a, b),
+                                                 ",".join([wl[0] for wl in weaklearners]))
         db.setup_sqlite_classifier(thresholds, a, b)
         return "classifier(%s)"%(",".join([wl[0] for wl in weaklearners]))
     
     if p.db_type.lower() == 'mysql':
         # MySQL
-        try:
-            res = db.execute("SELECT * from mysql.func where name='classifier'")
-            has_classifier_function = len(res) > 0
-        except:
-            has_classifier_function = False
-        if has_classifier_function:
+        if has_classifier_function():
             num_stumps = len(weaklearners)
             featurenames = "1," + ",".join([wl[0] for wl in weaklearners])
             thresholds = "0,"+",".join([str(wl[1]) for wl in weaklearners])
@@ -54,8 +69,7 @@ def FilterObjectsFromClassN(clNum, weaklearners, filterKeys):
     weaklearners: Weak learners from fastgentleboostingmulticlass.train
     filterKeys: (optional) A specific list of imKeys OR obKeys (NOT BOTH)
         to classify.
-        * WARNING: If this list is too long, you may exceed the size limit to
-          MySQL queries. 
+        * Long lists are loaded into a temporary table (see KeySet).
         * Useful when fetching N objects from a particular class. Use the
           DataModel to get batches of random objects, and sift through them
           here until N objects of the desired class have been accumulated.
@@ -67,35 +81,277 @@ def FilterObjectsFromClassN(clNum, weaklearners, filterKeys):
 
     class_query = translate(weaklearners)
 
-    if filterKeys != []:
-        if isinstance(filterKeys, str):
-            whereclause = filterKeys + " AND"
+    if isinstance(filterKeys, str):
+        return db.execute('SELECT '+UniqueObjectClause()+' FROM %s WHERE %s AND %s=%d '%(
+                          p.object_table, filterKeys, class_query, clNum))
+    
+    with KeySet(filterKeys) as keys:
+        if len(keys) > 0:
+            whereclause = keys.where_clause(p.object_table) + " AND"
         else:
-            isImKey = len(filterKeys[0]) == len(image_key_columns())
-            if isImKey:
-                whereclause = GetWhereClauseForImages(filterKeys) + " AND"
-            else:
-                whereclause = GetWhereClauseForObjects(filterKeys) + " AND"
+            whereclause = ""
+        return db.execute('SELECT '+UniqueObjectClause()+' FROM %s WHERE %s %s=%d '%(p.object_table, whereclause, class_query, clNum))
+
+
+def create_stump_table(weaklearners):
+    '''
+    Loads the weak learners into temp_stump_table for stump_class_query and
+    returns them compiled (see stumpmodel.StumpModel). The table has a row
+    (feature, lo, hi, score1, score2, ...) for each interval (lo, hi]
+    between consecutive thresholds of each column the model uses, where
+    feature is the column's index in the model's columns and the scores are
+    the sums of the column's stumps for each class when its value is in that
+    interval. lo is NULL for the first interval and hi for the last.
+    '''
+    model = StumpModel(weaklearners)
+    score_cols = ['score%d'%(k+1) for k in range(model.nclasses)]
+    db.execute('DROP TABLE IF EXISTS %s'%(temp_stump_table))
+    db.execute('CREATE TABLE %s (feature INT, lo DOUBLE, hi DOUBLE, %s)'%(
+        temp_stump_table, ', '.join(['%s DOUBLE'%(col) for col in score_cols])))
+    rows = []
+    for feature, (thresholds, table) in enumerate(zip(model.thresholds, model.tables)):
+        bounds = [None] + thresholds.tolist() + [None]
+        rows += [[feature, bounds[j], bounds[j+1]] + table[j].tolist()
+                 for j in range(len(table))]
+    db.bulk_insert(temp_stump_table, ['feature', 'lo', 'hi'] + score_cols, rows)
+    db.execute('CREATE INDEX idx_%s ON %s (feature)'%(temp_stump_table, temp_stump_table))
+    db.Commit()
+    return model
+
+
+def stump_scores_query(model, tables, where_clause, area_column=None):
+    '''
+    Returns a query for the object keys and class scores ("score1",
+    "score2", ...) of the objects in tables that match where_clause, scored
+    with the stumps loaded by create_stump_table. The value of each column
+    the model uses is joined with its interval in the stump table and the
+    interval scores are summed by object, so the rules never become
+    expressions. A NULL value is not above any threshold, as in translate.
+    If area_column is given, its values are also selected (as "area").
+    '''
+    keys = object_key_columns()
+    key_select = ', '.join(['%s AS %s'%(col, key) for col, key in
+                            zip(object_key_columns(p.object_table), keys)])
+    area_select = ''
+    if area_column is not None:
+        area_select = ', %s AS area'%(_objectify(area_column))
+    values = ' UNION ALL '.join(['SELECT %s, %d AS feature, COALESCE(%s, %r) AS val%s FROM %s WHERE %s'
+                                 %(key_select, feature, _objectify(col), float(thresholds[0]),
+                                   area_select, tables, where_clause)
+                                 for feature, (col, thresholds) in enumerate(zip(model.columns, model.thresholds))])
+    return ('SELECT %s, %s%s FROM (%s) AS v JOIN %s AS s ON s.feature = v.feature '
+            'AND (s.lo IS NULL OR v.val > s.lo) AND (s.hi IS NULL OR v.val <= s.hi) '
+            'GROUP BY %s'
+            %(', '.join(['v.%s'%(key) for key in keys]),
+              ', '.join(['SUM(s.score%d) AS score%d'%(k+1, k+1) for k in range(model.nclasses)]),
+              area_column and ', MAX(v.area) AS area' or '',
+              values, temp_stump_table,
+              ', '.join(['v.%s'%(key) for key in keys])))
+
+def _argmax_expression(scores):
+    '''Returns an expression for the 1-based number of the first of the
+    score expressions with the highest value, as in translate.'''
+    if len(scores) == 1:
+        # one-argument MAX is an aggregate in SQLite, and GREATEST needs two
+        return '1'
+    if p.db_type.lower() == 'mysql':
+        greatest = 'GREATEST'
     else:
-        whereclause = ""
+        greatest = 'MAX'
+    return 'CASE %s(%s) %s END'%(greatest, ', '.join(scores),
+                                 ' '.join(['WHEN %s THEN %d'%(score, k+1) for k, score in enumerate(scores)]))
+
+def stump_class_query(model, tables, where_clause, area_column=None):
+    '''
+    Returns a query for the object keys and 1-based class ("class") of the
+    objects in tables that match where_clause (see stump_scores_query).
+    '''
+    scores = ['score%d'%(k+1) for k in range(model.nclasses)]
+    return 'SELECT %s, %s AS class%s FROM (%s) AS scores'%(
+        ', '.join(object_key_columns()), _argmax_expression(scores),
+        area_column and ', area' or '',
+        stump_scores_query(model, tables, where_clause, area_column))
 
-    return db.execute('SELECT '+UniqueObjectClause()+' FROM %s WHERE %s %s=%d '%(p.object_table, whereclause, class_query, clNum))
 
+def _object_table_version():
+    '''Returns the number of rows in the object table and, on MySQL, the
+    time it was last modified. With SQLite that time is the database file's,
+    which changes whenever the score table is written, so it isn't used.'''
+    nobjects = db.execute('SELECT COUNT(*) FROM %s'%(p.object_table))[0][0]
+    if p.db_type.lower() == 'mysql':
+        return nobjects, db.get_table_modify_dates([p.object_table])[p.object_table]
+    return nobjects, None
 
-def object_scores(weaklearners):
-    stump_stmnts, score_stmnts, find_max_query, _, _ = \
-                  translate(weaklearners)
-    db.execute('DROP TABLE IF EXISTS _stump')
-    db.execute('DROP TABLE IF EXISTS _scores')
-    [db.execute(stump_query) for stump_query in stump_stmnts] 
-    [db.execute(score_query) for score_query in score_stmnts]
-    col_names = db.GetColumnNames('_scores')
-    col_types = db.GetColumnTypes('_scores')
-    type_mapping = { long: 'i4', float: 'f8' }
-    dtype = numpy.dtype([(name, type_mapping[type])
-                         for name, type in zip(col_names, col_types)])
-    res = db.execute('SELECT * from _scores')
-    return numpy.array(map(tuple, res), dtype)
+def _learners(weaklearners, version):
+    '''Returns the (column, threshold, a, b) of each weak learner, as
+    floats, and a fingerprint of the learners up to and including it and of
+    the object table version (see _object_table_version).'''
+    fingerprint = '%s %d %r'%(p.object_table, len(weaklearners[0][2]), version)
+    learners = []
+    for wl in weaklearners:
+        learner = (wl[0], float(wl[1]), map(float, wl[2]), map(float, wl[3]))
+        fingerprint = hashlib.sha1(fingerprint + repr(learner)).hexdigest()
+        learners += [learner + (fingerprint,)]
+    return learners
+
+def update_score_table(weaklearners, cb=None):
+    '''
+    Brings p.score_table up to date with weaklearners. The table holds the
+    object keys and each object's class scores summed over the weak learners
+    listed in the table <score_table>_learners. If the listed learners start
+    with the same learners as weaklearners, only the learners after those
+    are subtracted or added; otherwise the scores are computed again. They
+    are also computed again if the object table has changed, or after
+    MAX_SCORE_TABLE_UPDATES updates.
+    cb: callback function to update with the fraction complete. It can 
+        raise an exception to cancel, which leaves the table as it was.
+    RETURNS: whether the table had to be updated.
+    '''
+    learners_table = p.score_table + '_learners'
+    version = _object_table_version()
+    learners = _learners(weaklearners, version)
+    stored = []
+    updates = 0
+    if (db.table_exists(p.score_table) and db.table_exists(learners_table) and
+        'updates' in db.GetColumnNames(learners_table)):
+        for col, thresh, a, b, fingerprint, updates in db.execute(
+                'SELECT feature, threshold, a, b, fingerprint, updates FROM %s ORDER BY position'%(learners_table)):
+            stored += [(col, thresh, map(float, a.split()), map(float, b.split()), fingerprint)]
+        if db.execute('SELECT COUNT(*) FROM %s'%(p.score_table))[0][0] != version[0]:
+            stored = []
+    shared = 0
+    while (shared < min(len(stored), len(learners)) and
+           stored[shared][-1] == learners[shared][-1]):
+        shared += 1
+    if shared == len(stored) == len(learners):
+        return False
+    if updates >= MAX_SCORE_TABLE_UPDATES:
+        shared = 0
+    changes = [l[:4] + (None,) for l in learners[shared:]]
+    if shared > 0:
+        changes += [(col, thresh, [-v for v in a], [-v for v in b], None)
+                    for col, thresh, a, b, fingerprint in stored[shared:]]
+        logging.info('Updating %s with %d of %d rules.'%(p.score_table, len(changes), len(learners)))
+        updates += 1
+    else:
+        changes = weaklearners
+        updates = 0
+        logging.info('Computing %s with %d rules.'%(p.score_table, len(learners)))
+
+    # The updated scores go into a new table, a range of images at a time
+    keys = list(object_key_columns())
+    scores = ['score%d'%(k+1) for k in range(len(weaklearners[0][2]))]
+    new_table = p.score_table + '_new'
+    try:
+        model = create_stump_table(changes)
+        db.execute('DROP TABLE IF EXISTS %s'%(new_table))
+        db.execute('CREATE TABLE %s (%s, %s)'%(new_table, object_key_defs(),
+                                               ', '.join(['%s DOUBLE'%(score) for score in scores])))
+        db.Commit()
+        queries = []
+        for where_clause in _where_clauses(None):
+            query = stump_scores_query(model, p.object_table, where_clause)
+            if shared > 0:
+                query = 'SELECT %s, %s FROM (%s) AS d JOIN %s AS o ON %s'%(
+                    ', '.join(['d.%s'%(key) for key in keys]),
+                    ', '.join(['o.%s + d.%s'%(score, score) for score in scores]),
+                    query, p.score_table,
+                    ' AND '.join(['d.%s = o.%s'%(key, key) for key in keys]))
+            queries += ['INSERT INTO %s (%s) %s'%(new_table, ', '.join(keys + scores), query)]
+        # SQLite only lets one connection write at a time
+        if p.db_type.lower() == 'sqlite':
+            workers = 1
+        else:
+            workers = db.GetParallelQueryCount()
+        ranges = db.execute_parallel(queries, workers, method='execute_and_commit', silent=True)
+        try:
+            for n, (i, res) in enumerate(ranges):
+                if cb:
+                    cb(min(1, (n + 1) / float(len(queries))))
+        finally:
+            # cancels the remaining queries if cb raised an exception
+            ranges.close()
+        db.execute('DROP TABLE IF EXISTS %s'%(p.score_table))
+        db.execute('ALTER TABLE %s RENAME TO %s'%(new_table, p.score_table))
+    finally:
+        db.execute('DROP TABLE IF EXISTS %s'%(temp_stump_table))
+        db.execute('DROP TABLE IF EXISTS %s'%(new_table))
+    db.execute('CREATE INDEX idx_%s ON %s (%s)'%(p.score_table, p.score_table, ', '.join(keys)))
+
+    db.execute('DROP TABLE IF EXISTS %s'%(learners_table))
+    db.execute('CREATE TABLE %s (position INT, feature VARCHAR(255), threshold DOUBLE, '
+               'a TEXT, b TEXT, fingerprint VARCHAR(40), updates INT)'%(learners_table))
+    db.bulk_insert(learners_table, ['position', 'feature', 'threshold', 'a', 'b', 'fingerprint', 'updates'],
+                   [(i, col, thresh, ' '.join(['%.17g'%(v) for v in a]),
+                     ' '.join(['%.17g'%(v) for v in b]), fingerprint, updates)
+                    for i, (col, thresh, a, b, fingerprint) in enumerate(learners)])
+    db.Commit()
+    db.invalidate_query_cache([p.score_table, learners_table])
+    return True
+
+def score_table_class_query(nclasses, tables, where_clause, area_column=None):
+    '''
+    Returns a query for the object keys and 1-based class ("class") of the
+    objects in tables that match where_clause, from their scores in
+    p.score_table (see update_score_table).
+    '''
+    scores = ['sc.score%d'%(k+1) for k in range(nclasses)]
+    area_select = ''
+    if area_column is not None:
+        area_select = ', %s AS area'%(_objectify(area_column))
+    return 'SELECT %s, %s AS class%s FROM %s, %s AS sc WHERE %s AND %s'%(
+        ', '.join(['%s AS %s'%(col, key) for col, key in
+                   zip(object_key_columns(p.object_table), object_key_columns())]),
+        _argmax_expression(scores), area_select, tables, p.score_table, where_clause,
+        ' AND '.join(['%s = sc.%s'%(col, key) for col, key in
+                      zip(object_key_columns(p.object_table), object_key_columns())]))
+
+
+def _objectify(field):
+    return "%s.%s"%(p.object_table, field)
+
+def _key_compare(cols, key, op):
+    '''
+    Returns a condition that the tuple of cols compares to the tuple key
+    with op ('>' or '<='), written out column by column since not all
+    databases (eg: SQLite before 3.15) support row value comparisons.
+    '''
+    strict = {'>' : '>', '<=' : '<'}[op]
+    clause = '%s %s %d'%(cols[-1], op, key[-1])
+    for col, val in reversed(zip(cols[:-1], key[:-1])):
+        clause = '%s %s %d OR (%s = %d AND %s)'%(col, strict, val, col, val, clause)
+    return '(%s)'%(clause)
+
+def _key_ranges(imkeys, key_cols, stepsize):
+    '''
+    Returns where clauses that split the rows into disjoint ranges of image
+    keys, (lo, hi], that each hold stepsize of the sorted image keys imkeys
+    and together cover all rows, including any with keys outside imkeys.
+    key_cols -- the image key columns to compare
+    '''
+    thresholds = imkeys[stepsize-1:-1:stepsize]
+    if len(thresholds) == 0:
+        return ['(1=1)']
+    bounds = [None] + thresholds + [None]
+    clauses = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        conditions = []
+        if lo is not None:
+            conditions += [_key_compare(key_cols, lo, '>')]
+        if hi is not None:
+            conditions += [_key_compare(key_cols, hi, '<=')]
+        clauses += [' AND '.join(conditions)]
+    return clauses
+
+def _where_clauses(filter_name):
+    '''
+    Returns where clauses that split the object table into disjoint ranges
+    of about 1% of the images (in the filter), of at least 50 images each.
+    '''
+    imkeys = dm.GetAllImageKeys(filter_name)
+    imkeys.sort()
+    stepsize = max(len(imkeys) / 100, 50)
+    return _key_ranges(imkeys, image_key_columns(p.object_table), stepsize)
 
 
 def create_perobject_class_table(classnames, rules):
@@ -105,6 +361,10 @@ def create_perobject_class_table(classnames, rules):
     if p.class_table is None:
         raise ValueError('"class_table" in properties file is not set.')
 
+    if p.scoring_engine == 'numpy':
+        columns, predict = scoring.stump_predictor(rules)
+        return scoring.CreatePerObjectClassTable(columns, predict, classnames)
+
     index_cols = UniqueObjectClause()
     class_cols = UniqueObjectClause() + ', class, class_number'
     class_col_defs = object_key_defs() + ', class VARCHAR (%d)'%(max([len(c) for c in classnames])+1) + ', class_number INT'
@@ -114,11 +374,29 @@ def create_perobject_class_table(classnames, rules):
     db.execute('DROP TABLE IF EXISTS %s'%(p.class_table))
     db.execute('CREATE TABLE %s (%s)'%(p.class_table, class_col_defs))
     db.execute('CREATE INDEX idx_%s ON %s (%s)'%(p.class_table, p.class_table, index_cols))
-        
-    case_expr = 'CASE %s'%(translate(rules)) + ''.join([" WHEN %d THEN '%s'"%(n+1, classnames[n]) for n in range(nClasses)]) + " END"
-    case_expr2 = 'CASE %s'%(translate(rules)) + ''.join([" WHEN %d THEN '%s'"%(n+1, n+1) for n in range(nClasses)]) + " END"
-    db.execute('INSERT INTO %s (%s) SELECT %s, %s, %s FROM %s'%(p.class_table, class_cols, index_cols, case_expr, case_expr2, p.object_table))
+
+    if p.score_table:
+        update_score_table(rules)
+        def class_query(where_clause):
+            return score_table_class_query(nClasses, p.object_table, where_clause)
+    elif has_classifier_function():
+        class_expr = translate(rules)
+        def class_query(where_clause):
+            return 'SELECT %s, %s AS class FROM %s WHERE %s'%(index_cols, class_expr,
+                                                              p.object_table, where_clause)
+    else:
+        model = create_stump_table(rules)
+        def class_query(where_clause):
+            return stump_class_query(model, p.object_table, where_clause)
+
+    # Each object is classified once, a range of images at a time
+    label_expr = 'CASE class' + ''.join([" WHEN %d THEN '%s'"%(n+1, classnames[n].replace("'", "''")) for n in range(nClasses)]) + " END"
+    for where_clause in _where_clauses(None):
+        db.execute('INSERT INTO %s (%s) SELECT %s, %s, class FROM (%s) AS classes'
+                   %(p.class_table, class_cols, index_cols, label_expr, class_query(where_clause)))
     db.Commit()
+    db.execute('DROP TABLE IF EXISTS %s'%(temp_stump_table))
+    db.invalidate_query_cache([p.class_table])
     
 def PerImageCounts(weaklearners, filter_name=None, cb=None):
     '''
@@ -132,43 +410,12 @@ def PerImageCounts(weaklearners, filter_name=None, cb=None):
         If p.area_scoring_column is set, then area scores will be appended to
         the object scores.
     '''
+    if p.scoring_engine == 'numpy':
+        columns, predict = scoring.stump_predictor(weaklearners)
+        return scoring.PerImageCounts(columns, predict, len(weaklearners[0][2]),
+                                      filter_name, cb)
 
-    def objectify(field):
-        return "%s.%s"%(p.object_table, field)
-
-    def where_clauses():
-        imkeys = dm.GetAllImageKeys(filter_name)
-        imkeys.sort()
-        stepsize = max(len(imkeys) / 100, 50)
-        key_thresholds = imkeys[-1:1:-stepsize]
-        key_thresholds.reverse()
-        if p.table_id:
-            # split each table independently
-            def splitter():
-                yield "(%s = %d) AND (%s <= %d)"%(objectify(p.table_id), key_thresholds[0][0], 
-                                                  objectify(p.image_id), key_thresholds[0][1])
-                for lo, hi in zip(key_thresholds[:-1], key_thresholds[1:]):
-                    if lo[0] == hi[0]:
-                        # block within one table
-                        yield "(%s = %d) AND (%s > %d) AND (%s <= %d)"%(objectify(p.table_id), lo[0], 
-                                                                        objectify(p.image_id), lo[1], 
-                                                                        objectify(p.image_id), hi[1])
-                    else:
-                        # query spans a table boundary
-                        yield "(%s >= %d) AND (%s > %d)"%(objectify(p.table_id), lo[0], 
-                                                         objectify(p.image_id), lo[1])
-                        yield "(%s <= %d) AND (%s <= %d)"%(objectify(p.table_id), hi[0], 
-                                                          objectify(p.image_id), hi[1])
-            return list(splitter())
-        else:
-            return (["(%s <= %d)"%(objectify(p.image_id), key_thresholds[0][0])] + 
-                    ["(%s > %d) AND (%s <= %d)"
-                     %(objectify(p.image_id), lo[0], objectify(p.image_id), hi[0])
-                     for lo, hi in zip(key_thresholds[:-1], key_thresholds[1:])])
-                                                            
-    # I'm pretty sure this would be even faster if we were to run two
-    # or more parallel threads and split the work between them.
-    def do_by_steps(class_query, tables, filter_name, result_clauses):
+    def do_by_steps(class_query, tables, filter_name, result_clauses, cb=cb):
         if filter_name is not None:
             filter_clause = str(p._filters[filter_name])
             filter_clause += ' AND ' + ' AND '.join(
@@ -176,42 +423,67 @@ def PerImageCounts(weaklearners, filter_name=None, cb=None):
                  for im_col, ob_col in zip(image_key_columns(p.image_table), 
                                            image_key_columns(p.object_table))])
             tables += ', ' + ', '.join(p._filters[filter_name].get_tables())
-        if cb:
-            result =  []
-            wheres = where_clauses()
-            num_clauses = len(wheres)
-            
-            for idx, wc in enumerate(wheres):
-                if filter_name is None:
-                    where_clause = wc
-                else:
-                    where_clause = '%s AND %s'%(wc, filter_clause)
-                    
-                result += [db.execute('SELECT %s, %s as class, %s FROM %s '
-                                      'WHERE %s GROUP BY %s, class'
-                                      %(UniqueImageClause(p.object_table), 
-                                        class_query, result_clauses, tables, 
-                                        where_clause, 
-                                        UniqueImageClause(p.object_table)),
-                                      silent=(idx > 10))]
-                cb(min(1, idx/float(num_clauses)))
-            return sum(result, [])
-        else:
+        queries = []
+        for wc in _where_clauses(filter_name):
             if filter_name is None:
-                return db.execute('SELECT %s, %s as class, %s FROM %s GROUP BY %s, class'%
-                                  (imkeys, class_query, result_clauses, tables, imkeys))
+                where_clause = wc
             else:
-                tables += ', ' + ', '.join(filter.get_tables())
-                return db.execute('SELECT %s, %s as class, %s FROM %s WHERE %s GROUP BY %s, class'%
-                                  (imkeys, class_query, result_clauses, tables, filter_clause, imkeys))
+                where_clause = '%s AND %s'%(wc, filter_clause)
+            queries += ['SELECT %s, class, %s FROM (%s) AS classes '
+                        'GROUP BY %s, class'
+                        %(UniqueImageClause(), result_clauses,
+                          class_query(tables, where_clause),
+                          UniqueImageClause())]
+        # The image key ranges are scored in parallel on several connections
+        workers = db.GetParallelQueryCount()
+        logging.info('Scoring %d ranges of images on %d connections.'%(len(queries), workers))
+        result = []
+        ranges = db.execute_parallel(queries, workers, silent=True)
+        try:
+            for n, (i, res) in enumerate(ranges):
+                result += res
+                if cb:
+                    cb(min(1, (n + 1) / float(len(queries))))
+        finally:
+            # cancels the remaining queries if cb raised an exception
+            ranges.close()
+        return result
     
     if p.area_scoring_column is None:
         result_clauses = 'COUNT(*)'
     else:
-        result_clauses = 'COUNT(*), SUM(%s)'%(objectify(p.area_scoring_column))
+        result_clauses = 'COUNT(*), SUM(area)'
 
-    class_query = translate(weaklearners)
-    results = do_by_steps(class_query, p.object_table, filter_name, result_clauses)
+    if p.score_table:
+        # updating the score table and scoring share the progress range
+        update_cb = cb and (lambda frac: cb(frac / 2.0))
+        score_cb = cb
+        if update_score_table(weaklearners, update_cb) and cb:
+            score_cb = lambda frac: cb(0.5 + frac / 2.0)
+        def class_query(tables, where_clause):
+            return score_table_class_query(len(weaklearners[0][2]), tables, where_clause,
+                                           p.area_scoring_column)
+        results = do_by_steps(class_query, p.object_table, filter_name, result_clauses,
+                              score_cb)
+    elif has_classifier_function():
+        class_expr = translate(weaklearners)
+        def class_query(tables, where_clause):
+            area = ''
+            if p.area_scoring_column is not None:
+                area = ', %s AS area'%(_objectify(p.area_scoring_column))
+            return 'SELECT %s, %s AS class%s FROM %s WHERE %s'%(
+                ', '.join(['%s AS %s'%(col, key) for col, key in
+                           zip(image_key_columns(p.object_table), image_key_columns())]),
+                class_expr, area, tables, where_clause)
+        results = do_by_steps(class_query, p.object_table, filter_name, result_clauses)
+    else:
+        model = create_stump_table(weaklearners)
+        def class_query(tables, where_clause):
+            return stump_class_query(model, tables, where_clause, p.area_scoring_column)
+        try:
+            results = do_by_steps(class_query, p.object_table, filter_name, result_clauses)
+        finally:
+            db.execute('DROP TABLE IF EXISTS %s'%(temp_stump_table))
 
     # convert to dictionary
     counts = {}
@@ -368,10 +368,6 @@ class NormalizationUI(wx.Frame, CPATool):
         wants_norm_factor = self.norm_factor_checkbox.IsChecked()
         output_table = self.output_table.Value
         FIRST_MEAS_INDEX = len(imkey_cols + (wellkey_cols or tuple()))
-        if p.db_type == 'mysql':
-            BATCH_SIZE = 100
-        else:
-            BATCH_SIZE = 1
         if input_table == p.object_table: 
             FIRST_MEAS_INDEX += 1
         if wellkey_cols:
@@ -490,11 +486,10 @@ class NormalizationUI(wx.Frame, CPATool):
         if wants_norm_factor:
             col_defs += ', '+ ', '.join(['%s_NmF %s'%(col, db.GetColumnTypeString(input_table, col))
                                          for col in meas_cols]) 
-        for col in meas_cols:
-            if wants_norm_meas:
-                norm_table_cols += ['%s_NmM'%(col)]
-            if wants_norm_factor:
-                norm_table_cols += ['%s_NmF'%(col)]
+        if wants_norm_meas:
+            norm_table_cols += ['%s_NmM'%(col) for col in meas_cols]
+        if wants_norm_factor:
+            norm_table_cols += ['%s_NmF'%(col) for col in meas_cols]
         db.execute('CREATE TABLE %s (%s)'%(output_table, col_defs))
         
         dlg = wx.ProgressDialog('Writing to "%s"'%(output_table),
@@ -503,29 +498,18 @@ class NormalizationUI(wx.Frame, CPATool):
                                parent=self,
                                style = wx.PD_CAN_ABORT|wx.PD_APP_MODAL|wx.PD_ELAPSED_TIME|wx.PD_ESTIMATED_TIME|wx.PD_REMAINING_TIME)
             
-        cmd = 'INSERT INTO %s VALUES '%(output_table)
-        cmdi = cmd
-        for i, (val, factor) in enumerate(zip(output_columns, output_factors)):
-            cmdi += '(' + ','.join(['"%s"']*len(norm_table_cols)) + ')'
-            if wants_norm_meas and wants_norm_factor:
-                cmdi = cmdi%tuple(list(input_data[i, :FIRST_MEAS_INDEX]) + 
-                                  ['NULL' if (np.isnan(x) or np.isinf(x)) else x for x in val] + 
-                                  ['NULL' if (np.isnan(x) or np.isinf(x)) else x for x in factor])
-            elif wants_norm_meas:
-                cmdi = cmdi%tuple(list(input_data[i, :FIRST_MEAS_INDEX]) + 
-                                  ['NULL' if (np.isnan(x) or np.isinf(x)) else x for x in val])
-            elif wants_norm_factor:
-                cmdi = cmdi%tuple(list(input_data[i, :FIRST_MEAS_INDEX]) + 
-                                  ['NULL' if (np.isnan(x) or np.isinf(x)) else x for x in factor])
-            if (i+1) % BATCH_SIZE == 0 or i==len(output_columns)-1:
-                db.execute(str(cmdi))
-                cmdi = cmd
-                # update status dialog
-                (keep_going, skip) = dlg.Update(i)
-                if not keep_going:
-                    break
-            else:
-                cmdi += ',\n'
+        out_data = [input_data[:, :FIRST_MEAS_INDEX]]
+        if wants_norm_meas:
+            out_data += [output_columns]
+        if wants_norm_factor:
+            out_data += [output_factors]
+        out_data = np.hstack(out_data)
+        
+        def update(nrows):
+            # update status dialog
+            keep_going, skip = dlg.Update(nrows)
+            return keep_going
+        db.bulk_insert(output_table, norm_table_cols, out_data, callback=update)
         dlg.Destroy()
         db.Commit()
         
@@ -0,0 +1,214 @@
+'''
+Cache of the object coordinates of recently viewed images.
+
+The coordinates of all the objects in an image are read with one query and
+indexed with a uniform grid, so that the image viewer can find the object
+nearest a click, or the objects in a rectangle, and draw selection and class
+markers without a database query for each object.
+
+Example:
+>>> coords = ObjectCoordsCache.getInstance()
+>>> coords.GetObjectNear((1,), 120, 340)
+(1, 17)
+'''
+from __future__ import with_statement
+import threading
+from collections import OrderedDict
+import numpy as np
+from dbconnect import DBConnect
+from properties import Properties
+from singleton import Singleton
+
+p = Properties.getInstance()
+db = DBConnect.getInstance()
+
+OBJECTS_PER_CELL = 4      # average number of objects per grid cell
+
+
+class ImageObjects(object):
+    '''
+    The IDs and x, y coordinates of the objects in one image, with a grid
+    index for nearest-object and rectangle lookups. Objects with NULL
+    coordinates can be looked up by key but are never found by position.
+    '''
+    def __init__(self, imKey, obIDs, xs, ys):
+        order = np.argsort(obIDs)
+        self.imKey = tuple(imKey)
+        self.obIDs = np.asarray(obIDs, dtype=np.int64)[order]
+        self.xs = np.asarray(xs, dtype=float)[order]
+        self.ys = np.asarray(ys, dtype=float)[order]
+        self._build_grid()
+
+    def __len__(self):
+        return len(self.obIDs)
+
+    def _build_grid(self):
+        located = np.flatnonzero(np.isfinite(self.xs) & np.isfinite(self.ys))
+        if len(located) == 0:
+            self.cells = self.cell_starts = np.zeros(0, dtype=int)
+            self.ncols = self.nrows = 0
+            return
+        x, y = self.xs[located], self.ys[located]
+        self.x0, self.y0 = x.min(), y.min()
+        width = max(x.max() - self.x0, 1.0)
+        height = max(y.max() - self.y0, 1.0)
+        self.cell_size = max(np.sqrt(width * height * OBJECTS_PER_CELL / len(located)), 1.0)
+        self.ncols = int(width / self.cell_size) + 1
+        self.nrows = int(height / self.cell_size) + 1
+        cell = self._cell_of(x, y)
+        order = np.argsort(cell, kind='mergesort')
+        # self.cells holds object indices grouped by grid cell; the objects
+        # in cell c are self.cells[self.cell_starts[c] : self.cell_starts[c+1]]
+        self.cells = located[order]
+        self.cell_starts = np.searchsorted(cell[order], np.arange(self.ncols * self.nrows + 1))
+
+    def _col_row(self, x, y):
+        col = np.clip(((x - self.x0) / self.cell_size).astype(int), 0, self.ncols - 1)
+        row = np.clip(((y - self.y0) / self.cell_size).astype(int), 0, self.nrows - 1)
+        return col, row
+
+    def _cell_of(self, x, y):
+        col, row = self._col_row(x, y)
+        return row * self.ncols + col
+
+    def _objects_in_cells(self, col0, col1, row0, row1):
+        '''Returns the indices of the objects in the given (inclusive) range
+        of grid cells.'''
+        col0, row0 = max(col0, 0), max(row0, 0)
+        col1, row1 = min(col1, self.ncols - 1), min(row1, self.nrows - 1)
+        if col0 > col1 or row0 > row1:
+            return np.zeros(0, dtype=int)
+        return np.concatenate([self.cells[self.cell_starts[row * self.ncols + col0] :
+                                          self.cell_starts[row * self.ncols + col1 + 1]]
+                               for row in xrange(row0, row1 + 1)])
+
+    def _objects_in_ring(self, col, row, r):
+        '''Returns the indices of the objects in the cells exactly r cells
+        away from the given cell.'''
+        if r == 0:
+            return self._objects_in_cells(col, col, row, row)
+        return np.concatenate([self._objects_in_cells(col - r, col + r, row - r, row - r),
+                               self._objects_in_cells(col - r, col + r, row + r, row + r),
+                               self._objects_in_cells(col - r, col - r, row - r + 1, row + r - 1),
+                               self._objects_in_cells(col + r, col + r, row - r + 1, row + r - 1)])
+
+    def key(self, i):
+        return self.imKey + (int(self.obIDs[i]),)
+
+    def keys(self):
+        return [self.imKey + (obID,) for obID in self.obIDs.tolist()]
+
+    def index(self, obKey):
+        '''Returns the index of the object with the given key, or None.'''
+        i = np.searchsorted(self.obIDs, obKey[-1])
+        if i < len(self.obIDs) and self.obIDs[i] == obKey[-1]:
+            return i
+        return None
+
+    def coords(self, i):
+        '''Returns the (x, y) coordinates of object i, with None for NULLs.'''
+        x, y = self.xs[i], self.ys[i]
+        return (float(x) if np.isfinite(x) else None, float(y) if np.isfinite(y) else None)
+
+    def all_coords(self):
+        return [self.coords(i) for i in xrange(len(self.obIDs))]
+
+    def nearest(self, x, y):
+        '''Returns the index of the object nearest to x, y, or None.'''
+        if len(self.cells) == 0:
+            return None
+        col, row = self._col_row(np.array([x]), np.array([y]))
+        col, row = col[0], row[0]
+        best, best_dist = None, np.inf
+        # Search rings of cells around the cell of x, y. Objects in ring r
+        # are at least (r-1) cells away, so stop once the nearest object
+        # found is closer than that.
+        for r in xrange(max(self.ncols, self.nrows) + 1):
+            if best is not None and best_dist <= ((r - 1) * self.cell_size) ** 2:
+                break
+            ring = self._objects_in_ring(col, row, r)
+            if len(ring) == 0:
+                continue
+            dist = (self.xs[ring] - x) ** 2 + (self.ys[ring] - y) ** 2
+            i = np.argmin(dist)
+            if dist[i] < best_dist:
+                best, best_dist = ring[i], dist[i]
+        return best
+
+    def in_rect(self, x0, y0, x1, y1):
+        '''Returns the indices of the objects within the given rectangle.'''
+        if len(self.cells) == 0:
+            return np.zeros(0, dtype=int)
+        (c0, c1), (r0, r1) = self._col_row(np.array([min(x0, x1), max(x0, x1)]),
+                                           np.array([min(y0, y1), max(y0, y1)]))
+        candidates = self._objects_in_cells(c0, c1, r0, r1)
+        xs, ys = self.xs[candidates], self.ys[candidates]
+        inside = ((xs >= min(x0, x1)) & (xs <= max(x0, x1)) &
+                  (ys >= min(y0, y1)) & (ys <= max(y0, y1)))
+        return np.sort(candidates[inside])
+
+
+class ObjectCoordsCache(Singleton):
+    '''
+    Least recently used cache of the ImageObjects of recently viewed images.
+    '''
+    # number of images kept
+    MAX_IMAGES = 20
+
+    def __init__(self):
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_image(self, imKey):
+        '''Returns the ImageObjects of an image, reading it if needed.'''
+        imKey = tuple(imKey)
+        with self.lock:
+            if imKey in self.images:
+                self.images[imKey] = self.images.pop(imKey)
+                return self.images[imKey]
+        obIDs, xs, ys = db.GetObjectIDsAndCoordsFromImage(imKey)
+        image = ImageObjects(imKey, obIDs, xs, ys)
+        with self.lock:
+            self.images[imKey] = image
+            while len(self.images) > self.MAX_IMAGES:
+                self.images.popitem(last=False)
+        return image
+
+    def clear(self):
+        with self.lock:
+            self.images = OrderedDict()
+
+    def GetObjectNear(self, imKey, x, y):
+        ''' Returns obKey of the closest object to x, y in an image. '''
+        image = self.get_image(imKey)
+        i = image.nearest(x, y)
+        return None if i is None else image.key(i)
+
+    def GetObjectsInRect(self, imKey, x0, y0, x1, y1):
+        ''' Returns the obKeys of the objects in a rectangle of an image. '''
+        image = self.get_image(imKey)
+        return [image.key(i) for i in image.in_rect(x0, y0, x1, y1)]
+
+    def GetObjectCoords(self, obKey):
+        ''' Returns the specified object's x, y coordinates in an image. '''
+        return self.GetObjectsCoords([obKey])[0]
+
+    def GetObjectsCoords(self, obKeys):
+        ''' Returns a list of x, y coordinates for the given objects, or None
+        for objects that can't be found. '''
+        coords = []
+        for obKey in obKeys:
+            image = self.get_image(obKey[:-1])
+            i = image.index(obKey)
+            coords.append(None if i is None else image.coords(i))
+        return coords
+
+    def GetAllObjectCoordsFromImage(self, imKey):
+        ''' Returns a list of x, y coordinates for all objects in the given
+        image, in object ID order. '''
+        return self.get_image(imKey).all_coords()
+
+    def GetObjectsFromImage(self, imKey):
+        ''' Returns the keys of all objects in the given image, in object ID
+        order. '''
+        return self.get_image(imKey).keys()
@@ -5,7 +5,7 @@ import dbconnect
 import sqltools as sql
 import platemappanel as pmp
 from datamodel import DataModel
-from guiutils import TableComboBox, FilterComboBox, get_other_table_from_user
+from guiutils import TableComboBox, FilterComboBox, get_other_table_from_user, BackgroundQuery
 from wx.combo import OwnerDrawnComboBox as ComboBox
 import imagetools
 import properties
@@ -166,6 +166,8 @@ class PlateViewer(wx.Frame, CPATool):
         self.outlineMarked.Bind(wx.EVT_CHECKBOX, self.OnOutlineMarked)
         self.annotationShowVals.Bind(wx.EVT_CHECKBOX, self.OnShowAnotationValues)
         self.filterChoice.Bind(wx.EVT_COMBOBOX, self.OnSelectFilter)
+        # Well data is loaded in the background so the window stays responsive
+        self.well_data_query = BackgroundQuery(self)
         
         self.AddPlateMap()
         self.OnSelectMeasurement()
@@ -207,13 +209,16 @@ class PlateViewer(wx.Frame, CPATool):
 
         self.plateMapSizer.Add(singlePlateMapSizer, 1, wx.EXPAND|wx.ALIGN_CENTER)
 
-    def UpdatePlateMaps(self):
+    def UpdatePlateMaps(self, then=None):
+        '''
+        Loads the well data in the background and shows it when it arrives.
+        then -- a function to call once the plate maps are updated
+        '''
         measurement = self.measurementsChoice.Value
         table       = self.sourceChoice.Value
         aggMethod   = self.aggregationMethodsChoice.Value
         categorical = measurement not in get_numeric_columns_from_table(table)
         fltr        = self.filterChoice.Value
-        self.colorBar.ClearNotifyWindows()
 
         q = sql.QueryBuilder()
         well_key_cols = [sql.Column(p.image_table, col) for col in well_key_columns()]
@@ -250,13 +255,20 @@ class PlateViewer(wx.Frame, CPATool):
                 q.add_filter(p.gates[fltr].as_filter())
             else:
                 raise Exception('Could not find filter "%s" in gates or filters'%(fltr))
-        wellkeys_and_values = db.execute(str(q))
-        wellkeys_and_values = np.array(wellkeys_and_values, dtype=object)
+        # Well aggregates are expensive on big tables, so reuse them if the
+        # query cache is on
+        self.well_data_query.submit(
+            lambda (res, colnames): self._show_well_data(res, colnames, table, 
+                                        measurement, categorical, fltr, then),
+            str(q), 'execute_cached', return_colnames=True)
+
+    def _show_well_data(self, res, colnames, table, measurement, categorical, 
+                        fltr, then=None):
+        self.colorBar.ClearNotifyWindows()
+        wellkeys_and_values = np.array(res, dtype=object).reshape((len(res), len(colnames)))
 
         # Replace measurement None's with nan
-        for row in wellkeys_and_values:
-            if row[-1] is None:
-                row[-1] = np.nan
+        wellkeys_and_values[np.equal(wellkeys_and_values[:,-1], None), -1] = np.nan
 
         data = []
         key_lists = []
@@ -327,6 +339,8 @@ class PlateViewer(wx.Frame, CPATool):
                 plateMap.SetData(d, data_range=self.colorBar.GetLocalExtents(), 
                                  clip_interval=self.colorBar.GetLocalInterval(), 
                                  clip_mode=self.colorBar.GetClipMode())
+        if then is not None:
+            then()
 
     def UpdateMeasurementChoice(self, evt=None):
         '''
@@ -599,8 +613,7 @@ class PlateViewer(wx.Frame, CPATool):
         
     def OnSelectFilter(self, evt):
         self.filterChoice.on_select(evt)
-        self.UpdatePlateMaps()
-        self.colorBar.ResetInterval()
+        self.UpdatePlateMaps(then=self.colorBar.ResetInterval)
         
     def save_settings(self):
         '''save_settings is called when saving a workspace to file.
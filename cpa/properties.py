@@ -29,6 +29,10 @@ string_vars = ['db_type',
                'db_name', 
                'db_user', 
                'db_passwd',
+               'db_pool_size',
+               'db_parallel_queries',
+               'scoring_engine',
+               'sqlite_median_sample_size',
                'image_table', 
                'object_table',
                'image_csv_file', 
@@ -47,8 +51,17 @@ string_vars = ['db_type',
                'area_scoring_column',
                'training_set',
                'class_table',
+               'score_table',
                'plate_type',
                'check_tables',
+               'create_indexes',
+               'query_cache',
+               'query_cache_dir',
+               'query_cache_size',
+               'datamodel_snapshot',
+               'slow_query_threshold',
+               'slow_query_log',
+               'slow_query_explain',
                'db_sql_file',
                'db_sqlite_file',
                'use_larger_image_scale', 
@@ -78,6 +91,10 @@ optional_vars = ['db_port',
                  'db_name', 
                  'db_user', 
                  'db_passwd',
+                 'db_pool_size',
+                 'db_parallel_queries',
+                 'scoring_engine',
+                 'sqlite_median_sample_size',
                  'table_id', 
                  'image_url_prepend', 
                  'image_csv_file',
@@ -89,6 +106,7 @@ optional_vars = ['db_port',
                  'area_scoring_column', 
                  'training_set',
                  'class_table',
+                 'score_table',
                  'image_buffer_size', 
                  'tile_buffer_size',
                  'plate_id', 
@@ -97,6 +115,14 @@ optional_vars = ['db_port',
                  'classifier_ignore_substrings', 'classifier_ignore_columns',
                  'object_name',
                  'check_tables',
+                 'create_indexes',
+                 'query_cache',
+                 'query_cache_dir',
+                 'query_cache_size',
+                 'datamodel_snapshot',
+                 'slow_query_threshold',
+                 'slow_query_log',
+                 'slow_query_explain',
                  'db_sql_file',
                  'db_sqlite_file',
                  'object_table', 
@@ -511,6 +537,29 @@ class Properties(Singleton):
                 if self.field_defined(field):
                     logging.warn('PROPERTIES WARNING (%s): Field not required with db_type=mysql.'%(field))
         
+        if self.field_defined('db_pool_size'):
+            try:
+                assert int(self.db_pool_size) > 0
+            except (ValueError, AssertionError):
+                raise Exception('PROPERTIES ERROR (db_pool_size): Value must be a positive integer.')
+
+        if self.field_defined('db_parallel_queries'):
+            try:
+                assert int(self.db_parallel_queries) > 0
+            except (ValueError, AssertionError):
+                raise Exception('PROPERTIES ERROR (db_parallel_queries): Value must be a positive integer.')
+
+        if self.field_defined('scoring_engine'):
+            if self.scoring_engine.lower() not in ['database', 'numpy']:
+                raise Exception('PROPERTIES ERROR (scoring_engine): Value must be "database" or "numpy".')
+            self.scoring_engine = self.scoring_engine.lower()
+
+        if self.field_defined('sqlite_median_sample_size'):
+            try:
+                assert int(self.sqlite_median_sample_size) > 0
+            except (ValueError, AssertionError):
+                raise Exception('PROPERTIES ERROR (sqlite_median_sample_size): Value must be a positive integer.')
+
         if self.field_defined('area_scoring_column'):
             logging.info('PROPERTIES: Area scoring will be used.')
                 
@@ -584,6 +633,11 @@ class Properties(Singleton):
             assert self.class_table != self.image_table, 'PROPERTIES ERROR (class_table): class_table cannot be the same as image_table!'
             assert self.class_table != self.object_table, 'PROPERTIES ERROR (class_table): class_table cannot be the same as object_table!'
             logging.info('PROPERTIES: Per-Object classes will be written to table "%s"'%(self.class_table))
+
+        if self.field_defined('score_table'):
+            for table in ['image_table', 'object_table', 'class_table']:
+                assert self.score_table != getattr(self, table), 'PROPERTIES ERROR (score_table): score_table cannot be the same as %s!'%(table)
+            logging.info('PROPERTIES: Per-Object class scores will be kept in table "%s"'%(self.score_table))
             
         if not self.field_defined('plate_id'):
             logging.warn('PROPERTIES WARNING (plate_id): Field is required for plate map viewer.')
@@ -627,6 +681,50 @@ class Properties(Singleton):
         else:
             logging.warn('PROPERTIES WARNING (check_tables): Field value "%s" is invalid. Replacing with "yes".'%(self.check_tables))
             self.check_tables = 'yes'
+
+        if not self.field_defined('create_indexes') or self.create_indexes.lower() in ['false', 'no', 'off', 'f', 'n']:
+            self.create_indexes = 'no'
+        elif self.create_indexes.lower() in ['true', 'yes', 'on', 't', 'y']:
+            self.create_indexes = 'yes'
+        else:
+            logging.warn('PROPERTIES WARNING (create_indexes): Field value "%s" is invalid. Replacing with "no".'%(self.create_indexes))
+            self.create_indexes = 'no'
+
+        if not self.field_defined('query_cache') or self.query_cache.lower() in ['false', 'no', 'off', 'f', 'n']:
+            self.query_cache = 'no'
+        elif self.query_cache.lower() in ['true', 'yes', 'on', 't', 'y']:
+            self.query_cache = 'yes'
+        else:
+            logging.warn('PROPERTIES WARNING (query_cache): Field value "%s" is invalid. Replacing with "no".'%(self.query_cache))
+            self.query_cache = 'no'
+        
+        if self.field_defined('query_cache_size'):
+            try:
+                assert float(self.query_cache_size) > 0
+            except (ValueError, AssertionError):
+                raise Exception('PROPERTIES ERROR (query_cache_size): Value must be a positive number.')
+
+        if not self.field_defined('datamodel_snapshot') or self.datamodel_snapshot.lower() in ['false', 'no', 'off', 'f', 'n']:
+            self.datamodel_snapshot = 'no'
+        elif self.datamodel_snapshot.lower() in ['true', 'yes', 'on', 't', 'y']:
+            self.datamodel_snapshot = 'yes'
+        else:
+            logging.warn('PROPERTIES WARNING (datamodel_snapshot): Field value "%s" is invalid. Replacing with "no".'%(self.datamodel_snapshot))
+            self.datamodel_snapshot = 'no'
+
+        if self.field_defined('slow_query_threshold'):
+            try:
+                assert float(self.slow_query_threshold) >= 0
+            except (ValueError, AssertionError):
+                raise Exception('PROPERTIES ERROR (slow_query_threshold): Value must be a number of seconds.')
+
+        if not self.field_defined('slow_query_explain') or self.slow_query_explain.lower() in ['false', 'no', 'off', 'f', 'n']:
+            self.slow_query_explain = 'no'
+        elif self.slow_query_explain.lower() in ['true', 'yes', 'on', 't', 'y']:
+            self.slow_query_explain = 'yes'
+        else:
+            logging.warn('PROPERTIES WARNING (slow_query_explain): Field value "%s" is invalid. Replacing with "no".'%(self.slow_query_explain))
+            self.slow_query_explain = 'no'
             
         if self.use_larger_image_scale in [True, False]:
             pass
@@ -0,0 +1,240 @@
+'''
+Two-tier cache of query results used by DBConnect.execute_cached.
+
+Results are held in an in-memory LRU and, optionally, in compressed .npz
+files in a cache directory that is trimmed to a maximum size by dropping the
+least recently used files. Entries are looked up by a key that DBConnect
+derives from the query text and the modification times of the tables it
+reads (see DBConnect.execute_cached), and each entry remembers those tables
+so writers can invalidate them.
+'''
+from __future__ import with_statement
+import os
+import logging
+import threading
+import hashlib
+import decimal
+from collections import OrderedDict
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# numpy < 1.5 has no savez_compressed; uncompressed files still load the same
+_savez = getattr(np, 'savez_compressed', np.savez)
+
+def encode_column(values):
+    '''
+    Returns (kind, data, nulls) for a column of python values, where data is
+    a numpy array and nulls is a boolean mask of the NULL (None) values, or
+    None if the column can't be stored without changing the value types.
+    '''
+    nulls = np.array([v is None for v in values], dtype=bool)
+    present = [v for v in values if v is not None]
+    types = set([type(v) for v in present])
+    fill = {'i': 0, 'f': 0.0, 's': '', 'u': u'', 'd': ''}
+    if types <= set([int, long]) and (len(present) == 0 or
+            (min(present) >= -2**63 and max(present) < 2**63)):
+        kind, dtype = 'i', np.int64
+    elif types == set([float]):
+        kind, dtype = 'f', np.float64
+    elif types == set([str]):
+        kind, dtype = 's', str
+    elif types == set([unicode]):
+        kind, dtype = 'u', unicode
+    elif types == set([decimal.Decimal]):
+        kind, dtype = 'd', str
+        values = [v is not None and str(v) or None for v in values]
+    else:
+        return None
+    data = np.array([fill[kind] if v is None else v for v in values], dtype=dtype)
+    return kind, data, nulls
+
+def decode_column(kind, data, nulls):
+    '''Inverse of encode_column. Returns a list of python values.'''
+    if kind == 'd':
+        values = [decimal.Decimal(v) for v in data.tolist()]
+    else:
+        values = data.tolist()
+    for i in np.flatnonzero(nulls):
+        values[i] = None
+    return values
+
+
+class QueryCache(object):
+    '''
+    Cache of query results (lists of row tuples) and their column names.
+    cache_dir -- directory for the on-disk tier, or None for memory only
+    max_disk_bytes -- the on-disk tier is trimmed to this size
+    max_entries -- number of results kept in memory
+    '''
+    def __init__(self, cache_dir=None, max_disk_bytes=500*2**20, max_entries=64):
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.max_entries = max_entries
+        self.entries = OrderedDict()    # key -> (tables, colnames, rows)
+        self.disk_tables = None         # filename -> tables, read when needed
+        self.lock = threading.RLock()
+        self.hits = self.disk_hits = self.misses = 0
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _filename(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key).hexdigest() + '.npz')
+
+    def get(self, key):
+        '''Returns (colnames, rows) for the key, or None if it isn't cached.'''
+        with self.lock:
+            if key in self.entries:
+                tables, colnames, rows = self.entries.pop(key)
+                self.entries[key] = (tables, colnames, rows)
+                self.hits += 1
+                return colnames, rows
+        entry = self._read(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        self._remember(key, *entry)
+        return entry[1], entry[2]
+
+    def put(self, key, tables, colnames, rows):
+        '''Stores the result of a query that reads the given tables.'''
+        self._remember(key, tables, colnames, rows)
+        if self.cache_dir:
+            self._write(key, tables, colnames, rows)
+
+    def invalidate(self, tables=None):
+        '''Drops all cached results that read any of the given tables, or
+        everything if tables is None.'''
+        tables = tables and set([t.lower() for t in tables])
+        with self.lock:
+            for key, entry in self.entries.items():
+                if tables is None or tables.intersection(entry[0]):
+                    del self.entries[key]
+        if not self.cache_dir:
+            return
+        with self.lock:
+            for filename, file_tables in self._get_disk_tables().items():
+                if tables is None or tables.intersection(file_tables):
+                    self._remove(filename)
+
+    def get_stats(self):
+        with self.lock:
+            return {'entries' : len(self.entries),
+                    'hits' : self.hits,
+                    'disk_hits' : self.disk_hits,
+                    'misses' : self.misses,
+                    'disk_bytes' : sum([os.path.getsize(f) for f in self._disk_files()])}
+
+    def _remember(self, key, tables, colnames, rows):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (set([t.lower() for t in tables]), colnames, rows)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _disk_files(self):
+        if not self.cache_dir or not os.path.isdir(self.cache_dir):
+            return []
+        return [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir)
+                if f.endswith('.npz')]
+
+    def _get_disk_tables(self):
+        '''Returns a dict mapping each cache file to the tables its query read.'''
+        if self.disk_tables is None:
+            self.disk_tables = {}
+            for filename in self._disk_files():
+                try:
+                    f = np.load(filename)
+                    try:
+                        self.disk_tables[filename] = set(f['tables'].tolist())
+                    finally:
+                        f.close()
+                except Exception, e:
+                    logger.debug('Could not read cache file %s: %s'%(filename, e))
+                    self._remove(filename)
+        return self.disk_tables
+
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        if self.disk_tables is not None:
+            self.disk_tables.pop(filename, None)
+
+    def _write(self, key, tables, colnames, rows):
+        columns = zip(*rows) if len(rows) > 0 else [[] for c in colnames]
+        arrays = {'key' : np.array([key]),
+                  'tables' : np.array([t.lower() for t in tables] or [''], dtype=str),
+                  'colnames' : np.array(colnames or [''], dtype=str),
+                  'ncols' : np.array([len(colnames)]),
+                  'nrows' : np.array([len(rows)])}
+        for i, col in enumerate(columns):
+            encoded = encode_column(col)
+            if encoded is None:
+                # mixed or unusual types: keep it in memory only
+                return
+            kind, data, nulls = encoded
+            arrays['kind%d'%(i)] = np.array([kind])
+            arrays['data%d'%(i)] = data
+            arrays['nulls%d'%(i)] = nulls
+        filename = self._filename(key)
+        tmpname = '%s.%d.tmp'%(filename, os.getpid())
+        try:
+            f = open(tmpname, 'wb')
+            try:
+                _savez(f, **arrays)
+            finally:
+                f.close()
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmpname, filename)
+            with self.lock:
+                if self.disk_tables is not None:
+                    self.disk_tables[filename] = set([t.lower() for t in tables])
+        except Exception, e:
+            logger.debug('Could not write query cache file %s: %s'%(filename, e))
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            return
+        self._trim()
+
+    def _read(self, key):
+        if not self.cache_dir:
+            return None
+        filename = self._filename(key)
+        if not os.path.exists(filename):
+            return None
+        try:
+            f = np.load(filename)
+            try:
+                if f['key'][0] != key:
+                    return None
+                ncols = int(f['ncols'][0])
+                nrows = int(f['nrows'][0])
+                tables = [t for t in f['tables'].tolist() if t]
+                colnames = f['colnames'].tolist()[:ncols]
+                columns = [decode_column(f['kind%d'%(i)][0], f['data%d'%(i)], f['nulls%d'%(i)])
+                           for i in range(ncols)]
+            finally:
+                f.close()
+        except Exception, e:
+            logger.debug('Could not read query cache file %s: %s'%(filename, e))
+            return None
+        # mark as recently used for trimming
+        os.utime(filename, None)
+        rows = zip(*columns) if ncols > 0 else [()] * nrows
+        return tables, colnames, rows
+
+    def _trim(self):
+        '''Removes the least recently used files until the cache directory is
+        no bigger than max_disk_bytes.'''
+        files = [(os.path.getmtime(f), os.path.getsize(f), f) for f in self._disk_files()]
+        total = sum([size for t, size, f in files])
+        for t, size, filename in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            with self.lock:
+                self._remove(filename)
+            total -= size
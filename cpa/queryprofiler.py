@@ -0,0 +1,216 @@
+'''
+Records timing information for the queries run through DBConnect.execute.
+
+Each query is recorded with its wall time, number of rows returned, an
+estimate of the bytes returned and the CPA module (tool) that issued it. The
+most recent records are kept in a ring buffer, and totals are kept for each
+query "shape" (the query with its literal values blanked out) so repeated
+queries that differ only in their keys add up.
+
+Queries slower than the slow_query_threshold property are written to the
+"cpa.slowqueries" logger, and to the file named by slow_query_log if one is
+given, optionally along with the database's query plan.
+
+Example:
+>>> print DBConnect.getInstance().get_query_profile_report()
+'''
+from __future__ import with_statement
+import os
+import re
+import sys
+import logging
+import threading
+from collections import deque
+
+slow_logger = logging.getLogger('cpa.slowqueries')
+
+_STRING_LITERAL = re.compile(r'''('([^'\\]|\\.|'')*'|"([^"\\]|\\.|"")*")''')
+_NUMBER_LITERAL = re.compile(r'(?<![\w.])-?\d+(\.\d*)?([eE][-+]?\d+)?')
+_IN_LIST = re.compile(r'\(\s*\?(\s*,\s*\?)*\s*\)')
+_OR = re.compile(r'\s+OR\s+', re.IGNORECASE)
+MAX_SHAPE_LENGTH = 1000
+
+def query_shape(query):
+    '''
+    Returns the query with string and number literals replaced by ?, lists
+    of values collapsed, and whitespace normalized, so queries that differ
+    only in the values they use have the same shape.
+    '''
+    shape = _STRING_LITERAL.sub('?', query)
+    shape = _NUMBER_LITERAL.sub('?', shape)
+    shape = ' '.join(shape.split())
+    shape = _IN_LIST.sub('(?, ...)', shape)
+    # collapse long runs of identical OR terms, eg: from GetWhereClauseForObjects
+    terms = _OR.split(shape)
+    if len(terms) > 2:
+        collapsed = [terms[0]]
+        for term in terms[1:]:
+            if term == collapsed[-1]:
+                if collapsed[-2:-1] != ['...']:
+                    collapsed.insert(-1, '...')
+            else:
+                collapsed.append(term)
+        shape = ' OR '.join(collapsed)
+    if len(shape) > MAX_SHAPE_LENGTH:
+        shape = shape[:MAX_SHAPE_LENGTH] + '...'
+    return shape
+
+def estimate_bytes(rows):
+    '''Estimates the size of a query result from its first row.'''
+    if not rows:
+        return 0
+    size = 0
+    for v in rows[0]:
+        if isinstance(v, basestring):
+            size += len(v)
+        else:
+            size += 8
+    return size * len(rows)
+
+def calling_tool():
+    '''Returns the name of the first module on the stack outside of the
+    database layer, ie: the tool that asked for the query.'''
+    internal = ('dbconnect', 'queryprofiler', 'querycache', 'threading')
+    frame = sys._getframe(1)
+    while frame is not None:
+        name = os.path.splitext(os.path.basename(frame.f_code.co_filename))[0]
+        if name not in internal:
+            return name
+        frame = frame.f_back
+    return 'unknown'
+
+
+class QueryRecord(object):
+    '''A single profiled query.'''
+    __slots__ = ['query', 'shape', 'start', 'elapsed', 'rows', 'bytes', 'tool',
+                 'connection', 'plan']
+
+    def __init__(self, query, shape, start, elapsed, rows, nbytes, tool, connection):
+        self.query = query
+        self.shape = shape
+        self.start = start
+        self.elapsed = elapsed
+        self.rows = rows
+        self.bytes = nbytes
+        self.tool = tool
+        self.connection = connection
+        self.plan = None
+
+
+class ShapeStats(object):
+    '''Totals for all the queries of one shape.'''
+    def __init__(self, shape):
+        self.shape = shape
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.tools = set()
+
+    def add(self, record):
+        self.count += 1
+        self.total_time += record.elapsed
+        self.max_time = max(self.max_time, record.elapsed)
+        self.rows += record.rows or 0
+        self.bytes += record.bytes or 0
+        self.tools.add(record.tool)
+
+    def as_dict(self):
+        return {'shape' : self.shape,
+                'count' : self.count,
+                'total_time' : self.total_time,
+                'mean_time' : self.total_time / max(self.count, 1),
+                'max_time' : self.max_time,
+                'rows' : self.rows,
+                'bytes' : self.bytes,
+                'tools' : sorted(self.tools)}
+
+
+class QueryProfiler(object):
+    '''
+    capacity -- the number of recent queries to keep
+    slow_threshold -- queries that take at least this many seconds are
+                      logged to the "cpa.slowqueries" logger (None for never)
+    '''
+    def __init__(self, capacity=1000, slow_threshold=None):
+        self.recent = deque(maxlen=capacity)
+        self.shapes = {}
+        self.slow_threshold = slow_threshold
+        self.lock = threading.Lock()
+
+    def record(self, query, start, elapsed, rows=None, connection=None, explain=None,
+               nrows=None, nbytes=None):
+        '''
+        Records a query that started at time start and took elapsed seconds.
+        rows -- the list of rows returned, if they were fetched
+        connection -- the ID of the connection that ran the query
+        explain -- function that returns the query plan, called if the query
+                   was slow
+        nrows, nbytes -- the number of rows and bytes returned, for results
+                         that were fetched a block at a time instead of as
+                         a list of rows
+        Returns the QueryRecord.
+        '''
+        if rows is not None:
+            nrows = len(rows) or None
+            nbytes = estimate_bytes(rows)
+        r = QueryRecord(query, query_shape(query), start, elapsed, nrows,
+                        nbytes or 0, calling_tool(), connection)
+        with self.lock:
+            self.recent.append(r)
+            if r.shape not in self.shapes:
+                self.shapes[r.shape] = ShapeStats(r.shape)
+            self.shapes[r.shape].add(r)
+        if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+            self.log_slow_query(r, explain)
+        return r
+
+    def log_slow_query(self, r, explain=None):
+        if explain is not None:
+            try:
+                r.plan = explain(r.query)
+            except Exception, e:
+                r.plan = 'Could not get query plan: %s'%(e)
+        msg = 'Slow query (%.3fs, %s rows, from %s): %s'%(
+                r.elapsed, r.rows if r.rows is not None else '?', r.tool, r.query)
+        if r.plan:
+            msg += '\nQuery plan:\n' + r.plan
+        slow_logger.warn(msg)
+
+    def get_recent(self, n=None):
+        '''Returns the n most recent query records, newest first.'''
+        with self.lock:
+            recent = list(self.recent)
+        recent.reverse()
+        return recent[:n] if n else recent
+
+    def get_shape_stats(self, top=None, sort_by='total_time'):
+        '''Returns a list of dicts of totals per query shape (see
+        ShapeStats.as_dict), sorted by the given key in descending order.'''
+        with self.lock:
+            stats = [s.as_dict() for s in self.shapes.values()]
+        stats.sort(key=lambda s: s[sort_by], reverse=True)
+        return stats[:top] if top else stats
+
+    def reset(self):
+        with self.lock:
+            self.recent.clear()
+            self.shapes = {}
+
+    def report(self, top=20):
+        '''Returns a text report of the query shapes that took the most
+        time.'''
+        stats = self.get_shape_stats()
+        total = sum([s['total_time'] for s in stats])
+        lines = ['%d queries of %d shapes took %.3fs in total.'%(
+                    sum([s['count'] for s in stats]), len(stats), total), '']
+        lines += ['%8s %6s %8s %8s %10s %10s  %s'%('total(s)', '%', 'count',
+                  'mean(s)', 'rows', 'KB', 'tools / query')]
+        for s in stats[:top]:
+            lines += ['%8.3f %6.1f %8d %8.4f %10d %10d  %s'%(
+                        s['total_time'], 100. * s['total_time'] / (total or 1),
+                        s['count'], s['mean_time'], s['rows'], s['bytes'] / 1024,
+                        ', '.join(s['tools'])),
+                      '%s%s'%(' ' * 56, s['shape'][:200]), '']
+        return '\n'.join(lines)
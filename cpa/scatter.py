@@ -155,6 +155,8 @@ class ScatterControlPanel(wx.Panel):
         wx.EVT_COMBOBOX(self.y_table_choice, -1, self.on_y_table_selected)
         self.gate_choice.addobserver(self.on_gate_selected)
         wx.EVT_BUTTON(self.update_chart_btn, -1, self.update_figpanel)
+        # Points are loaded in the background so the window stays responsive
+        self.points_query = ui.BackgroundQuery(self, self.update_chart_btn)
 
         self.SetSizer(sizer)
         self.Show(1)
@@ -234,32 +236,39 @@ class ScatterControlPanel(wx.Panel):
                 or (self.y_column.table != p.image_table and db.adjacent(p.object_table, self.y_column.table))
                 )
         
-    def update_figpanel(self, evt=None):
+    def update_figpanel(self, evt=None, then=None):
+        '''
+        Loads the points in the background and plots them when they arrive.
+        then -- a function to call once the points are plotted
+        '''
+        if evt is not None and self.points_query.running():
+            # The update button reads "Cancel" while points are loading
+            self.points_query.cancel()
+            return
         self.gate_choice.set_gatable_columns([self.x_column, self.y_column])
-        keys_and_points = self._load_points()
         col_types = self.get_selected_column_types()
-                
-        # Convert keys and points into a np array
-        # NOTE: We must set dtype "object" on creation or values like 0.34567e-9
-        #       may be truncated to 0.34567e (error) or 0.345 (no error) when
-        #       the array contains strings.
-        kps = np.array(keys_and_points, dtype='object')
-        # Strip out keys
         if self._plotting_per_object_data():
-            key_indices = list(xrange(len(object_key_columns())))
+            nkeys = len(object_key_columns())
         else:
-            key_indices = list(xrange(len(image_key_columns())))
-        keys = kps[:,key_indices].astype(int)
+            nkeys = len(image_key_columns())
+        self.points_query.submit(
+            lambda keys_and_points: self._plot_points(keys_and_points, nkeys, 
+                                                      col_types, then),
+            self._points_query(), 'execute_to_arrays')
+
+    def _plot_points(self, keys_and_points, nkeys, col_types, then=None):
+        # Strip out keys
+        keys = np.column_stack(keys_and_points[:nkeys]).astype(int)
         # Strip out x coords
         if col_types[0] in [float, int, long]:
-            xpoints = kps[:,-2].astype('float32')
+            xpoints = keys_and_points[-2].astype('float32')
         else:
-            xpoints = kps[:,-2]
+            xpoints = keys_and_points[-2]
         # Strip out y coords
         if col_types[1] in [float, int, long]:
-            ypoints = kps[:,-1].astype('float32')
+            ypoints = keys_and_points[-1].astype('float32')
         else:
-            ypoints = kps[:,-1]
+            ypoints = keys_and_points[-1]
 
         # plot the points
         self.figpanel.set_points(xpoints, ypoints)
@@ -271,8 +280,10 @@ class ScatterControlPanel(wx.Panel):
         self.update_gate_helper()
         self.figpanel.redraw()
         self.figpanel.draw()
+        if then is not None:
+            then()
         
-    def _load_points(self):
+    def _points_query(self):
         q = sql.QueryBuilder()
         select = []
         #
@@ -290,7 +301,7 @@ class ScatterControlPanel(wx.Panel):
             q.add_filter(self.filter)
         q.add_where(sql.Expression(self.x_column, 'IS NOT NULL'))
         q.add_where(sql.Expression(self.y_column, 'IS NOT NULL'))
-        return db.execute(str(q))
+        return str(q)
     
     def get_selected_column_types(self):
         ''' Returns a tuple containing the x and y column types. '''
@@ -342,16 +353,17 @@ class ScatterControlPanel(wx.Panel):
             self.y_scale_choice.SetStringSelection(settings['y-scale'])
         if 'filter' in settings:
             self.filter_choice.SetStringSelection(settings['filter'])
-        self.update_figpanel()
-        if 'x-lim' in settings:
-            self.figpanel.subplot.set_xlim(eval(settings['x-lim']))
-        if 'y-lim' in settings:
-            self.figpanel.subplot.set_ylim(eval(settings['y-lim']))
-        if 'gate' in settings:
-            self.gate_choice.SetStringSelection(settings['gate'])
-            self.figpanel.gate_helper.set_displayed_gate(
-                p.gates[settings['gate']], self.x_column, self.y_column)
-        self.figpanel.draw()
+        def set_view():
+            if 'x-lim' in settings:
+                self.figpanel.subplot.set_xlim(eval(settings['x-lim']))
+            if 'y-lim' in settings:
+                self.figpanel.subplot.set_ylim(eval(settings['y-lim']))
+            if 'gate' in settings:
+                self.gate_choice.SetStringSelection(settings['gate'])
+                self.figpanel.gate_helper.set_displayed_gate(
+                    p.gates[settings['gate']], self.x_column, self.y_column)
+            self.figpanel.draw()
+        self.update_figpanel(then=set_view)
 
 
 class ScatterPanel(FigureCanvasWxAgg):
@@ -483,10 +495,9 @@ class ScatterPanel(FigureCanvasWxAgg):
         if len(show_keys[0]) == len(image_key_columns()):
             import datamodel
             dm = datamodel.DataModel.getInstance()
-            obkeys = []
-            for key in show_keys:
-                obkeys += dm.GetObjectsFromImage(key)
-            show_keys = obkeys
+            obids = dm.GetObjectIDsFromImages(show_keys)
+            show_keys = [imkey + (int(obid),) for imkey in obids 
+                         for obid in obids[imkey]]
 
         if len(show_keys) > 100:
             te = wx.TextEntryDialog(self, 'You have selected %s %s. How many '
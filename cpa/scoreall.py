@@ -236,6 +236,7 @@ if __name__ == "__main__":
 
     score(p, ts, nRules, filter_name, group, show_results=True,
           results_table=results_table, overwrite=False)
+    logging.info('Database query profile:\n%s'%(DBConnect.getInstance().get_query_profile_report(10)))
     
     app.MainLoop()
     
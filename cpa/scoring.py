@@ -0,0 +1,177 @@
+'''
+Scoring of the objects in the database with NumPy rather than SQL.
+
+The classifier's feature columns are read from the object table in large
+blocks, ordered by image, and each block is classified with the model's
+vectorised predict function. Per-image class counts (and area sums, if
+area_scoring_column is set) are accumulated with np.bincount. This works for
+any classifier that can predict the classes of an array of feature values,
+and the cost of a boosting model doesn't grow in SQL with its number of
+rules.
+
+Example:
+>>> columns, predict = stump_predictor(weaklearners)
+>>> keysAndCounts = PerImageCounts(columns, predict, len(weaklearners[0][2]))
+'''
+from __future__ import with_statement
+import numpy as np
+from dbconnect import DBConnect, KeySet, image_key_columns, object_key_columns, \
+     object_key_defs
+from datamodel import DataModel
+from properties import Properties
+from stumpmodel import StumpModel
+
+p = Properties.getInstance()
+db = DBConnect.getInstance()
+
+# Number of objects read and classified at a time
+CHUNK_ROWS = 100000
+
+
+def stump_predictor(weaklearners):
+    '''
+    Returns (columns, predict) for a boosting model, where predict maps an
+    array of the values of columns (one row per object) to 0-based class
+    numbers. As in SQL, a NULL feature counts as not above the threshold.
+    '''
+    model = StumpModel(weaklearners)
+    return model.columns, model.predict
+
+
+def ScoreObjects(columns, predict, imkeys=None, chunk_rows=CHUNK_ROWS):
+    '''
+    Classifies the objects in the object table a block at a time, in image
+    key order.
+    columns -- the feature columns that predict takes
+    predict -- a function mapping an array of the values of columns (NULLs
+               are NaN) to an array of 0-based class numbers
+    imkeys -- (optional) only score the objects in these images
+    Yields (keys, classes, areas) for each block: the object key columns,
+    the 0-based class of each object and the values of area_scoring_column
+    (or None).
+    '''
+    key_cols = list(object_key_columns(p.object_table))
+    select = key_cols + ['%s.%s'%(p.object_table, col) for col in columns]
+    if p.area_scoring_column is not None:
+        select += ['%s.%s'%(p.object_table, p.area_scoring_column)]
+    nkeys = len(key_cols)
+    with KeySet(imkeys or []) as keys:
+        where = ''
+        if imkeys is not None:
+            where = 'WHERE ' + keys.where_clause(p.object_table)
+        query = 'SELECT %s FROM %s %s ORDER BY %s'%(
+            ', '.join(select), p.object_table, where, ', '.join(key_cols))
+        blocks = db.iter_execute_to_arrays(query, chunk_rows=chunk_rows)
+        try:
+            for block in blocks:
+                values = np.column_stack([col.astype(float)
+                                          for col in block[nkeys:nkeys + len(columns)]])
+                areas = None
+                if p.area_scoring_column is not None:
+                    areas = np.nan_to_num(block[-1].astype(float))
+                yield block[:nkeys], np.asarray(predict(values), dtype=int), areas
+        finally:
+            # the rest of the result must be read before the key table can
+            # be dropped
+            blocks.close()
+
+
+def _image_rows(keys, index):
+    '''Returns the row in index of the image of each object, or -1. The
+    objects are in image key order, so the image key is only looked up once
+    for each run of objects in the same image.'''
+    im_keys = keys[:len(image_key_columns())]
+    n = len(im_keys[0])
+    change = np.ones(n, dtype=bool)
+    for col in im_keys:
+        change[1:] |= col[1:] != col[:-1]
+    starts = np.flatnonzero(change)
+    run_keys = zip(*[col[starts].tolist() for col in im_keys])
+    run_rows = [index.get(key, -1) for key in run_keys]
+    return np.repeat(run_rows, np.diff(np.append(starts, n)))
+
+
+def PerImageCounts(columns, predict, nclasses, filter_name=None, cb=None,
+                   chunk_rows=CHUNK_ROWS):
+    '''
+    Scores all the objects (in the filter) with predict, which returns the
+    0-based classes of an array of the values of columns (see ScoreObjects).
+    cb: callback function to update with the fraction complete. It may
+        raise an exception to stop scoring.
+    RETURNS: A list of lists of imKeys and respective object counts for each
+        class, as multiclasssql.PerImageCounts does.
+    '''
+    dm = DataModel.getInstance()
+    keys_and_counts = dm.GetImageKeysAndObjectCounts(filter_name)
+    imkeys = [tuple(imkey) for imkey, count in keys_and_counts]
+    index = dict([(imkey, i) for i, imkey in enumerate(imkeys)])
+    total = float(sum([count for imkey, count in keys_and_counts]) or 1)
+    counts = np.zeros(len(imkeys) * nclasses, dtype=np.int64)
+    areas = np.zeros(len(imkeys) * nclasses)
+
+    done = 0
+    objects = ScoreObjects(columns, predict, imkeys if filter_name else None,
+                           chunk_rows)
+    try:
+        for keys, classes, area in objects:
+            rows = _image_rows(keys, index)
+            known = rows >= 0
+            bins = rows[known] * nclasses + classes[known]
+            counts += np.bincount(bins, minlength=len(counts))
+            if area is not None:
+                areas += np.bincount(bins, weights=area[known], minlength=len(areas))
+            done += len(classes)
+            if cb:
+                cb(min(1, done / total))
+    finally:
+        # stops reading the objects if cb raised an exception
+        objects.close()
+
+    counts = counts.reshape(len(imkeys), nclasses).tolist()
+    if p.area_scoring_column is None:
+        return [list(imkey) + row for imkey, row in zip(imkeys, counts)]
+    areas = areas.reshape(len(imkeys), nclasses).tolist()
+    return [list(imkey) + row + area for imkey, row, area in zip(imkeys, counts, areas)]
+
+
+def _image_batches(chunk_rows):
+    '''Yields lists of image keys with about chunk_rows objects in all.'''
+    batch, n = [], 0
+    for imkey, count in DataModel.getInstance().GetImageKeysAndObjectCounts():
+        batch.append(tuple(imkey))
+        n += count
+        if n >= chunk_rows:
+            yield batch
+            batch, n = [], 0
+    if batch:
+        yield batch
+
+
+def CreatePerObjectClassTable(columns, predict, classnames, chunk_rows=CHUNK_ROWS):
+    '''
+    Saves the object keys and the classes predict gives them (see
+    ScoreObjects) to p.class_table, replacing the table if it exists.
+    classnames -- the name of each class, by 0-based class number
+    '''
+    if p.class_table is None:
+        raise ValueError('"class_table" in properties file is not set.')
+
+    key_cols = list(object_key_columns())
+    class_col_defs = object_key_defs() + ', class VARCHAR (%d)'%(max([len(c) for c in classnames])+1) + ', class_number INT'
+
+    # Drop must be explicitly asked for Classifier.ScoreAll
+    db.execute('DROP TABLE IF EXISTS %s'%(p.class_table))
+    db.execute('CREATE TABLE %s (%s)'%(p.class_table, class_col_defs))
+    db.execute('CREATE INDEX idx_%s ON %s (%s)'%(p.class_table, p.class_table, ', '.join(key_cols)))
+
+    classnames = np.array(classnames, dtype=object)
+    # The objects are scored a batch of images at a time, since the
+    # connection can't insert rows while it's reading a result.
+    for imkeys in _image_batches(chunk_rows):
+        rows = []
+        for keys, classes, areas in ScoreObjects(columns, predict, imkeys, chunk_rows):
+            rows += zip(*([col.tolist() for col in keys] +
+                          [classnames[classes].tolist(), (classes + 1).tolist()]))
+        db.bulk_insert(p.class_table, key_cols + ['class', 'class_number'], rows)
+    db.Commit()
+    db.invalidate_query_cache([p.class_table])
@@ -3,6 +3,7 @@ import tilecollection
 from imagetile import ImageTile
 from imagetilesizer import ImageTileSizer
 from imagecontrolpanel import ImageControlPanel
+from objectcoords import ObjectCoordsCache
 from properties import Properties
 import imagetools
 import cPickle
@@ -163,7 +164,7 @@ class SortBin(wx.ScrolledWindow):
                 else:
                     imViewer = imagetools.ShowImage(key[:-1], self.chMap[:], parent=self)
 
-                imViewer.imagePanel.SelectPoint(db.GetObjectCoords(key))
+                imViewer.imagePanel.SelectPoint(ObjectCoordsCache.getInstance().GetObjectCoords(key))
         elif choice == 1:
             self.SelectAll()
         elif choice == 2:
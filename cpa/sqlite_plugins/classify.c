@@ -0,0 +1,147 @@
+/* classify.c - SQLite loadable extension for scoring boosted stumps */
+
+// This is the SQLite counterpart of mysql_plugins/classify.c. Compile it to
+// a shared library next to this file, eg:
+//   Linux:   gcc -O2 -fPIC -shared classify.c -o classify.so
+//   Mac:     gcc -O2 -fPIC -dynamiclib classify.c -o classify.dylib
+//   Windows: cl /O2 classify.c -link -dll -out:classify.dll
+// and DBConnect will load it into each SQLite connection if the python
+// sqlite3 module allows loading extensions.
+//
+// It defines the SQL function
+//   stump_classifier(model, feature_1, ..., feature_n)
+// where model is a string holding
+//   "num_stumps num_classes thresholds... a_weights... b_weights..."
+// (the weights ordered by stump, then class) as written by
+// multiclasssql.translate. The model is parsed once per statement and the
+// 1-based index of the best scoring class is returned, exactly as
+// SqliteClassifier.classify does. NULL features never exceed a threshold.
+
+#include <stdlib.h>
+#include <string.h>
+#include "sqlite3ext.h"
+SQLITE_EXTENSION_INIT1
+
+#if defined(WIN32) || defined(MS_WINDOWS) || defined(_WIN32)
+#define EXPORT __declspec(dllexport)
+#else
+#define EXPORT
+#endif
+
+typedef struct {
+  int num_stumps;
+  int num_classes;
+  double *thresholds;  // [num_stumps]
+  double *a;           // [num_stumps][num_classes] weights if feature > threshold
+  double *b;           // [num_stumps][num_classes] weights otherwise
+  double *scores;      // [num_classes] scratch space
+} stump_model;
+
+static void free_model(void *ptr)
+{
+  sqlite3_free(ptr);
+}
+
+static stump_model *parse_model(const char *text)
+{
+  stump_model *model;
+  int num_stumps, num_classes, n, i;
+  char *end;
+  double *values;
+
+  num_stumps = (int) strtol(text, &end, 10);
+  num_classes = (int) strtol(end, &end, 10);
+  if ((num_stumps <= 0) || (num_classes <= 0))
+    return NULL;
+
+  // allocate the model and all of its arrays in one block
+  n = num_stumps * (1 + 2 * num_classes) + num_classes;
+  model = (stump_model *) sqlite3_malloc(sizeof(stump_model) + n * sizeof(double));
+  if (! model)
+    return NULL;
+  values = (double *) (model + 1);
+  for (i = 0; i < n - num_classes; i++) {
+    char *start = end;
+    values[i] = strtod(start, &end);
+    if (end == start) {
+      sqlite3_free(model);
+      return NULL;
+    }
+  }
+  model->num_stumps = num_stumps;
+  model->num_classes = num_classes;
+  model->thresholds = values;
+  model->a = values + num_stumps;
+  model->b = model->a + num_stumps * num_classes;
+  model->scores = model->b + num_stumps * num_classes;
+  return model;
+}
+
+static void stump_classifier(sqlite3_context *context, int argc, sqlite3_value **argv)
+{
+  stump_model *model;
+  int i, k, best_class, owned = 0;
+  double *w;
+
+  model = (stump_model *) sqlite3_get_auxdata(context, 0);
+  if (! model) {
+    if ((argc < 1) || (sqlite3_value_type(argv[0]) != SQLITE_TEXT)) {
+      sqlite3_result_error(context, "The first argument to stump_classifier() must be the model string.", -1);
+      return;
+    }
+    model = parse_model((const char *) sqlite3_value_text(argv[0]));
+    if (! model) {
+      sqlite3_result_error(context, "Could not parse the stump_classifier() model string.", -1);
+      return;
+    }
+    // Cache the parsed model for the rest of the statement. SQLite frees it
+    // straight away if the model argument isn't a constant, in which case
+    // it is parsed again for this row and freed below.
+    sqlite3_set_auxdata(context, 0, model, free_model);
+    model = (stump_model *) sqlite3_get_auxdata(context, 0);
+    if (! model) {
+      model = parse_model((const char *) sqlite3_value_text(argv[0]));
+      if (! model) {
+        sqlite3_result_error_nomem(context);
+        return;
+      }
+      owned = 1;
+    }
+  }
+
+  if (argc - 1 != model->num_stumps) {
+    sqlite3_result_error(context, "The number of features passed to stump_classifier() must match the model.", -1);
+    if (owned)
+      sqlite3_free(model);
+    return;
+  }
+
+  memset(model->scores, 0, model->num_classes * sizeof(double));
+  for (i = 0; i < model->num_stumps; i++) {
+    sqlite3_value *feature = argv[i + 1];
+    if ((sqlite3_value_type(feature) != SQLITE_NULL) &&
+        (sqlite3_value_double(feature) > model->thresholds[i]))
+      w = model->a + i * model->num_classes;
+    else
+      w = model->b + i * model->num_classes;
+    for (k = 0; k < model->num_classes; k++)
+      model->scores[k] += w[k];
+  }
+
+  // ties go to the first class, like numpy's argmax
+  best_class = 0;
+  for (k = 1; k < model->num_classes; k++)
+    if (model->scores[k] > model->scores[best_class])
+      best_class = k;
+
+  if (owned)
+    sqlite3_free(model);
+  sqlite3_result_int(context, best_class + 1);
+}
+
+EXPORT int sqlite3_extension_init(sqlite3 *db, char **err, const sqlite3_api_routines *api)
+{
+  SQLITE_EXTENSION_INIT2(api);
+  return sqlite3_create_function(db, "stump_classifier", -1, SQLITE_UTF8, NULL,
+                                 stump_classifier, NULL, NULL);
+}
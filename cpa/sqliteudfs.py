@@ -0,0 +1,190 @@
+'''
+User defined functions that DBConnect registers on SQLite connections to
+stand in for MySQL's MEDIAN, STDDEV, REGEXP, LOG10 and LOG2, plus quantile
+aggregates.
+
+The aggregates are written to keep memory bounded on whole-experiment
+tables: STDDEV is computed in a single pass (Welford's method), MEDIAN and
+QUANTILE keep their values in a compact NumPy buffer and select the result
+with np.partition (or np.sort before numpy 1.8), and APPROX_MEDIAN and APPROX_QUANTILE hold at most a
+fixed-size uniform sample of each group.
+'''
+import math
+import re
+import numpy as np
+
+# Default number of values kept per group by the approximate aggregates. The
+# rank error of the result is on the order of 1/sqrt(APPROX_SAMPLE_SIZE).
+APPROX_SAMPLE_SIZE = 10000
+
+def _to_float(val):
+    '''returns val as a float, or None for NULL and NaN'''
+    if val is None:
+        return None
+    try:
+        val = float(val)
+    except (TypeError, ValueError):
+        return None
+    if np.isnan(val):
+        return None
+    return val
+
+def _select_quantile(values, q):
+    '''returns the q-quantile of a 1D array, interpolating linearly between
+    the two nearest ranks (as np.percentile does) without sorting it, if
+    numpy has np.partition (1.8 and later).'''
+    n = len(values)
+    if n == 0:
+        return None
+    q = min(max(float(q), 0.0), 1.0)
+    pos = q * (n - 1)
+    lo = int(np.floor(pos))
+    hi = min(lo + 1, n - 1)
+    if hasattr(np, 'partition'):
+        part = np.partition(values, [lo, hi])
+    else:
+        part = np.sort(values)
+    return float(part[lo] + (part[hi] - part[lo]) * (pos - lo))
+
+
+class StdDev:
+    '''Population standard deviation, computed in one pass.'''
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def step(self, val):
+        val = _to_float(val)
+        if val is None:
+            return
+        self.n += 1
+        delta = val - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (val - self.mean)
+
+    def finalize(self):
+        if self.n == 0:
+            return None
+        return float(np.sqrt(self.m2 / self.n))
+
+
+class Quantile:
+    '''Exact quantile. Values are kept in a growing float64 buffer (8 bytes
+    per value rather than a python float in a list) and the result is found
+    by selection rather than a full sort.'''
+    def __init__(self):
+        self.values = np.empty(1024)
+        self.n = 0
+        self.q = None
+
+    def add(self, val):
+        if self.n == len(self.values):
+            self.values = np.resize(self.values, 2 * len(self.values))
+        self.values[self.n] = val
+        self.n += 1
+
+    def step(self, val, q):
+        if self.q is None:
+            self.q = q
+        val = _to_float(val)
+        if val is not None:
+            self.add(val)
+
+    def finalize(self):
+        if self.q is None:
+            return None
+        return _select_quantile(self.values[:self.n], self.q)
+
+
+class Median(Quantile):
+    '''Exact median.'''
+    def step(self, val):
+        Quantile.step(self, val, 0.5)
+
+
+class ApproxQuantile(Quantile):
+    '''Approximate quantile over a uniform random sample of at most
+    APPROX_SAMPLE_SIZE values of the group (reservoir sampling), so memory
+    use doesn't grow with the size of the group. Groups no bigger than the
+    sample give exact results.'''
+    sample_size = APPROX_SAMPLE_SIZE
+
+    def __init__(self):
+        Quantile.__init__(self)
+        self.seen = 0
+        self.random = np.random.RandomState(0)
+
+    def add(self, val):
+        self.seen += 1
+        if self.n < self.sample_size:
+            Quantile.add(self, val)
+        else:
+            i = self.random.randint(self.seen)
+            if i < self.sample_size:
+                self.values[i] = val
+
+
+class ApproxMedian(ApproxQuantile):
+    '''Approximate median (see ApproxQuantile).'''
+    def step(self, val):
+        ApproxQuantile.step(self, val, 0.5)
+
+
+_regexp_cache = {}
+_REGEXP_CACHE_SIZE = 100
+
+def regexp(expr, item):
+    '''X REGEXP Y: whether the string X matches the pattern Y. Patterns are
+    compiled once and cached.'''
+    if expr is None or item is None:
+        return None
+    try:
+        reg = _regexp_cache[expr]
+    except KeyError:
+        if len(_regexp_cache) >= _REGEXP_CACHE_SIZE:
+            _regexp_cache.clear()
+        reg = _regexp_cache[expr] = re.compile(expr)
+    return reg.match(str(item)) is not None
+
+
+def _log(base):
+    '''returns a SQL function for the logarithm to the given base, which is
+    NULL for NULL and non-positive values, as in MySQL'''
+    def log(val):
+        val = _to_float(val)
+        if val is None or val <= 0:
+            return None
+        return math.log(val, base)
+    return log
+
+def _has_function(conn, name):
+    '''whether SQLite has the built-in function name (SQLite 3.35 and later
+    are usually compiled with the math functions)'''
+    try:
+        conn.execute('SELECT %s(1)'%(name))
+        return True
+    except Exception:
+        return False
+
+
+def register(conn, median_sample_size=None):
+    '''
+    Registers the functions on a sqlite3 connection.
+    median_sample_size -- if given, MEDIAN is computed approximately from a
+                          sample of at most this many values per group
+    '''
+    if median_sample_size:
+        class BoundedMedian(ApproxMedian):
+            sample_size = median_sample_size
+        conn.create_aggregate('median', 1, BoundedMedian)
+    else:
+        conn.create_aggregate('median', 1, Median)
+    conn.create_aggregate('quantile', 2, Quantile)
+    conn.create_aggregate('approx_median', 1, ApproxMedian)
+    conn.create_aggregate('approx_quantile', 2, ApproxQuantile)
+    conn.create_aggregate('stddev', 1, StdDev)
+    conn.create_function('REGEXP', 2, regexp)
+    for name, base in (('LOG10', 10.0), ('LOG2', 2.0)):
+        if not _has_function(conn, name):
+            conn.create_function(name, 1, _log(base))
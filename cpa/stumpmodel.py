@@ -0,0 +1,134 @@
+'''
+Boosted stump models compiled for scoring many objects at once.
+
+A Fast Gentle Boosting model is a list of weak learners (stumps)
+(column, threshold, a, b, margin), and an object's score for each class is
+the sum over the stumps of a if the object's value of column is above the
+threshold, and b otherwise. Evaluating the stumps one at a time costs one
+pass over the objects per rule.
+
+StumpModel groups the stumps by column and sorts their thresholds. For a
+value v of a column, the stumps whose thresholds are below v are exactly the
+first j = searchsorted(thresholds, v) of them, so the column's total
+contribution is a lookup table indexed by j: the cumulative sum of a over the
+first j stumps plus the sum of b over the rest. Scoring a block of objects
+then takes one searchsorted and one table lookup per column used by the
+model, however many rules there are.
+
+Example:
+>>> model = StumpModel(weaklearners)
+>>> values = db.execute_to_arrays('SELECT %s FROM ...'%(', '.join(model.columns)))
+>>> classes = model.predict(np.column_stack(values))
+>>> model == loads(model.dumps())
+True
+'''
+import struct
+import numpy as np
+
+# Start of the binary form of a model, followed by the format version
+MAGIC = 'CPAStump'
+VERSION = 1
+
+
+class StumpModel(object):
+    '''
+    A boosting model compiled into a threshold table and a score lookup
+    table for each column it uses.
+    '''
+    def __init__(self, weaklearners=None):
+        '''
+        weaklearners -- a list of (column, threshold, a, b, ...) stumps, as in
+                        FastGentleBoosting.model
+        '''
+        # the columns used, in sorted order, and for each one the sorted
+        # thresholds and the (len(thresholds) + 1) x nclasses lookup table
+        self.columns = []
+        self.thresholds = []
+        self.tables = []
+        self.nclasses = 0
+        if weaklearners:
+            self._compile(weaklearners)
+
+    def _compile(self, weaklearners):
+        self.nclasses = len(weaklearners[0][2])
+        self.columns = sorted(set([wl[0] for wl in weaklearners]))
+        for col in self.columns:
+            stumps = [wl for wl in weaklearners if wl[0] == col]
+            thresholds = np.array([wl[1] for wl in stumps], dtype=float)
+            a = np.array([wl[2] for wl in stumps], dtype=float)
+            b = np.array([wl[3] for wl in stumps], dtype=float)
+            order = np.argsort(thresholds, kind='mergesort')
+            thresholds, a, b = thresholds[order], a[order], b[order]
+            # table[j] = sum(a[:j]) + sum(b[j:])
+            zero = np.zeros((1, self.nclasses))
+            cum_a = np.vstack([zero, np.cumsum(a, axis=0)])
+            cum_b = np.vstack([zero, np.cumsum(b, axis=0)])
+            self.thresholds.append(thresholds)
+            self.tables.append(cum_a + cum_b[-1] - cum_b)
+
+    def __len__(self):
+        '''The number of stumps in the model.'''
+        return sum([len(t) for t in self.thresholds])
+
+    def __eq__(self, other):
+        return (isinstance(other, StumpModel) and
+                self.columns == other.columns and
+                self.nclasses == other.nclasses and
+                all([np.array_equal(t1, t2) for t1, t2 in zip(self.thresholds, other.thresholds)]) and
+                all([np.array_equal(t1, t2) for t1, t2 in zip(self.tables, other.tables)]))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def scores(self, values):
+        '''
+        Returns the class scores (one row per object) of an array of the
+        values of self.columns, one row per object. As in SQL, a NULL (NaN)
+        value counts as not above any threshold.
+        '''
+        values = np.asarray(values, dtype=float)
+        scores = np.zeros((len(values), self.nclasses))
+        for i, (thresholds, table) in enumerate(zip(self.thresholds, self.tables)):
+            col = values[:, i]
+            j = np.searchsorted(thresholds, col, 'left')
+            j[np.isnan(col)] = 0
+            scores += table[j]
+        return scores
+
+    def predict(self, values):
+        '''
+        Returns the 0-based class of each object (row) of an array of the
+        values of self.columns. Ties go to the lowest class number.
+        '''
+        return np.argmax(self.scores(values), axis=1)
+
+    def dumps(self):
+        '''Returns the model in a compact binary form (see loads).'''
+        parts = [struct.pack('<8sIII', MAGIC, VERSION, self.nclasses, len(self.columns))]
+        for col, thresholds, table in zip(self.columns, self.thresholds, self.tables):
+            name = col.encode('utf-8')
+            parts += [struct.pack('<II', len(name), len(thresholds)), name,
+                      thresholds.astype('<f8').tostring(),
+                      table.astype('<f8').tostring()]
+        return ''.join(parts)
+
+
+def loads(data):
+    '''Returns the StumpModel that StumpModel.dumps returned data for.'''
+    magic, version, nclasses, ncolumns = struct.unpack_from('<8sIII', data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError, 'Not a compiled stump model.'
+    model = StumpModel()
+    model.nclasses = nclasses
+    pos = struct.calcsize('<8sIII')
+    for i in xrange(ncolumns):
+        namelen, nthresholds = struct.unpack_from('<II', data, pos)
+        pos += struct.calcsize('<II')
+        model.columns.append(data[pos:pos + namelen].decode('utf-8'))
+        pos += namelen
+        model.thresholds.append(np.frombuffer(data, '<f8', nthresholds, pos).astype(float))
+        pos += 8 * nthresholds
+        model.tables.append(np.frombuffer(data, '<f8', (nthresholds + 1) * nclasses, pos)
+                            .astype(float).reshape(nthresholds + 1, nclasses))
+        pos += 8 * (nthresholds + 1) * nclasses
+    return model
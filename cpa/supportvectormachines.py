@@ -10,6 +10,7 @@ import dbconnect
 import dimensredux as dr
 import logging
 import numpy as np
+import scoring
 import wx
 from datamodel import DataModel
 from properties import Properties
@@ -163,19 +164,9 @@ class SupportVectorMachines(object):
         if p.class_table is None:
             raise ValueError('"class_table" in properties file is not set.')
 
-        index_cols = dbconnect.UniqueObjectClause()
-        class_cols = dbconnect.UniqueObjectClause() + ', class, class_number'
-        class_col_defs = dbconnect.object_key_defs() + ', class VARCHAR (%d)'%(max([len(c.label) for c in self.classBins])+1) + ', class_number INT'
-
-        # Drop must be explicitly asked for Classifier.ScoreAll
         db = dbconnect.DBConnect.getInstance()
-        db.execute('DROP TABLE IF EXISTS %s'%(p.class_table))
-        db.execute('CREATE TABLE %s (%s)'%(p.class_table, class_col_defs))
-        db.execute('CREATE INDEX idx_%s ON %s (%s)'%(p.class_table, p.class_table, index_cols))
-        for clNum, clName in enumerate(self.perClassObjects.keys()):
-            for obj in self.perClassObjects[clName]:
-                query = ''.join(['INSERT INTO ',p.class_table,' (',class_cols,') VALUES (',str(obj[0]),', ',str(obj[1]),', "',clName,'", ',str(clNum+1),')'])
-                db.execute(query)
+        scoring.CreatePerObjectClassTable(db.GetColnamesForClassifier(), self.Predict,
+                                          [bin.label for bin in self.classBins])
 
         if p.db_type.lower() == 'mysql':
             query = ''.join(['ALTER TABLE ',p.class_table,' ORDER BY ',p.image_id,' ASC, ',p.object_id,' ASC'])
@@ -193,14 +184,16 @@ class SupportVectorMachines(object):
         if isinstance(keys, str):
             object_data[0] = db.GetCellDataForClassifier(keys)
         elif keys != []:
-            if len(keys) == len(dbconnect.image_key_columns()):
-                # Retrieve instance of the data model and retrieve objects in the requested image
+            if len(keys[0]) == len(dbconnect.image_key_columns()):
+                # Retrieve instance of the data model and retrieve objects in the requested images
                 dm = DataModel.getInstance()
-                obKeys = dm.GetObjectsFromImage(keys[0])
+                obIDs = dm.GetObjectIDsFromImages(keys)
+                obKeys = [tuple(imKey) + (int(obID),) for imKey in obIDs 
+                          for obID in obIDs[imKey]]
             else:
                 obKeys = keys
-            for key in obKeys:
-                object_data[key] = db.GetCellDataForClassifier(key)
+            obKeys = [tuple(key) for key in obKeys]
+            object_data = dict(zip(obKeys, db.GetCellDataBatch(obKeys, db.GetColnamesForClassifier())))
 
         sorted_keys = sorted(object_data.keys())
         values_array = np.array([object_data[key] for key in sorted_keys])
@@ -282,55 +275,16 @@ class SupportVectorMachines(object):
         return bestC, bestGamma
 
     def PerImageCounts(self, filter_name=None, cb=None):
-        # Clear the current perClassObjects storage
-        for bin in self.classBins:
-            self.perClassObjects[bin.label] = []
-
-        # Retrieve a data model instance
-        dm = DataModel.getInstance()
-
-        # Retrieve image keys and initialize variables
-        imageKeys = dm.GetAllImageKeys(filter_name)
-        imageAmount = float(len(imageKeys))
-        perImageData = []
-
-        # Process all images
-        for k_index, imKey in enumerate(imageKeys):
-            try:
-                # Retrieve the keys of the objects in the current image
-                obKeys = dm.GetObjectsFromImage(imKey)
-            except:
-                raise 'No such image: %s' % (imKey,)
-                return
-
-            # Calculate the amount of hits for each of the classes in the current image
-            classHits = {}
-            objectCount = [imKey[0]]
-            if obKeys:
-                classObjects = self.FilterObjectsFromClassN(keys = [imKey])
-                for clNum, bin in enumerate(self.classBins):
-                    # Get the objects from the image which belong to the selected class
-                    classHits[bin.label] = classObjects[float(clNum+1)]
-
-                    # Store the total object count of this class for the current image
-                    nrHits = len(classHits[bin.label])
-                    objectCount.append(nrHits)
-
-                    # Store the objects for the current class and image grouped
-                    # by class if any are found for this class in the selected image
-                    if nrHits > 0:
-                        self.perClassObjects[bin.label] += classHits[bin.label]
-            else:
-                # If there are objects in the image, add zeros for all bins
-                [objectCount.append(0) for bin in self.classBins]
-
-            # Store the results for the current image and update the callback
-            # function if available
-            perImageData.append(objectCount)
-            if cb:
-                cb(min(1, k_index/imageAmount))
+        # Score all the objects a block at a time outside the database
+        columns = dbconnect.DBConnect.getInstance().GetColnamesForClassifier()
+        return scoring.PerImageCounts(columns, self.Predict, len(self.classBins),
+                                      filter_name, cb)
 
-        return perImageData
+    def Predict(self, values):
+        '''
+    	Returns the 0-based classes of an array of object feature values.
+    	'''
+        return self.model.predict(self.ScaleData(np.nan_to_num(values))).astype(int)
 
     def SaveModel(self, model_file_name, bin_labels):       
         import cPickle
@@ -0,0 +1,67 @@
+import unittest
+import numpy as np
+import boxstats
+from boxstats import BoxStats
+
+def mpl_stats(values, whis=1.5):
+    '''box plot statistics computed the way matplotlib's boxplot does'''
+    q1, med, q3 = np.percentile(values, [25, 50, 75])
+    inside = values[(values >= q1 - whis * (q3 - q1)) & (values <= q3 + whis * (q3 - q1))]
+    fliers = values[(values < inside.min()) | (values > inside.max())]
+    return q1, med, q3, inside.min(), inside.max(), np.sort(fliers)
+
+class TestBoxStats(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.values = rng.standard_cauchy(30000)
+        self.values[::100] = np.nan
+        self.plates = rng.randint(0, 3, 30000)
+        self.wells = np.array(['A01', 'B02'], dtype=object)[rng.randint(0, 2, 30000)]
+
+    def check(self, stats, values, approx=False):
+        values = values[~np.isnan(values)]
+        q1, med, q3, whislo, whishi, fliers = mpl_stats(values)
+        assert stats['n'] == len(values)
+        if approx:
+            assert abs(np.mean(values < stats['med']) - 0.5) < 0.05
+            assert abs(np.mean(values < stats['q1']) - 0.25) < 0.05
+        else:
+            self.assertAlmostEqual(stats['q1'], q1)
+            self.assertAlmostEqual(stats['med'], med)
+            self.assertAlmostEqual(stats['q3'], q3)
+            assert (stats['whislo'], stats['whishi']) == (whislo, whishi)
+            np.testing.assert_array_equal(stats['fliers'], fliers)
+
+    def test_grouped(self):
+        box = BoxStats()
+        for i in range(0, 30000, 7000):
+            box.add(self.values[i:i+7000], [self.plates[i:i+7000], self.wells[i:i+7000]])
+        stats = box.stats()
+        assert sorted(stats.keys()) == [(p, w) for p in range(3) for w in ('A01', 'B02')]
+        assert box.nans == 300
+        for (plate, well), s in stats.items():
+            self.check(s, self.values[(self.plates == plate) & (self.wells == well)])
+
+    def test_sketch(self):
+        box = BoxStats(max_exact=5000, sketch_size=2000)
+        for i in range(0, 30000, 7000):
+            box.add(self.values[i:i+7000])
+        self.check(box.stats()[()], self.values, approx=True)
+
+    def test_without_partition(self):
+        # numpy < 1.8 has no np.partition
+        expected = BoxStats(max_exact=5000, sketch_size=2000)
+        expected.add(self.values)
+        boxstats._HAS_PARTITION = False
+        try:
+            box = BoxStats(max_exact=5000, sketch_size=2000)
+            box.add(self.values)
+            stats = box.stats()[()]
+        finally:
+            boxstats._HAS_PARTITION = True
+        for key, value in expected.stats()[()].items():
+            np.testing.assert_array_equal(stats[key], value)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
+from __future__ import with_statement
 import unittest
 from dbconnect import *
 from datamodel import DataModel
@@ -22,6 +23,24 @@ class TestDBConnect(unittest.TestCase):
         self.db = DBConnect.getInstance()
         self.db.Disconnect()
         self.p.LoadFile('../../CPAnalyst_test_data/export_to_db_test.properties')
+
+    def setup_sqlite_tmp(self):
+        '''Points the properties at a new SQLite database in a temporary
+        directory, which is removed after the test. Returns the directory.'''
+        import tempfile, shutil
+        self.p  = Properties.getInstance()
+        self.db = DBConnect.getInstance()
+        self.db.Disconnect()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(self.db.Disconnect)
+        self.p.db_type = 'sqlite'
+        self.p.db_sqlite_file = os.path.join(tmpdir, 'test.db')
+        self.p.db_sql_file = None
+        self.p.image_table, self.p.object_table = 'per_image', 'per_object'
+        self.p.table_id, self.p.image_id, self.p.object_id = None, 'ImageNumber', 'ObjectNumber'
+        self.db.connect(empty_sqlite_db=True)
+        return tmpdir
         
         
     #
@@ -62,6 +81,20 @@ class TestDBConnect(unittest.TestCase):
         assert GetWhereClauseForImages([(1,), (2,)]) == 'ImageNumber IN (1,2)'
         self.setup_sqlite()
         assert GetWhereClauseForImages([(0,1), (0,2)]) == '(TableNumber=0 AND ImageNumber IN (1,2))'
+
+    def test_KeySet(self):
+        self.setup_sqlite()
+        obkeys = self.db.execute('SELECT %s FROM %s'%(UniqueObjectClause(), p.object_table))[:5000]
+        count = 'SELECT COUNT(*) FROM %s WHERE %%s'%(p.object_table)
+        with KeySet(obkeys[:10]) as keys:
+            assert keys.table is None
+            assert self.db.execute(count%(keys.where_clause()))[0][0] == 10
+        with KeySet(obkeys) as keys:
+            # too long to inline
+            assert self.db.execute(count%(keys.where_clause()))[0][0] == len(set(obkeys))
+            assert keys.table is not None
+        with KeySet([]) as keys:
+            assert self.db.execute(count%(keys.where_clause()))[0][0] == 0
     
     def test_UniqueObjectClause(self):
         self.setup_mysql()
@@ -112,7 +145,21 @@ class TestDBConnect(unittest.TestCase):
         assert len(self.db.cursors)==0
         assert len(self.db.connectionInfo)==0
 
-        
+    def test_connection_pool(self):
+        import threading
+        self.setup_sqlite()
+        self.db.GetAllImageKeys()
+        for i in range(5):
+            t = threading.Thread(target=self.db.GetAllImageKeys, name='worker')
+            t.start()
+            t.join()
+        stats = self.db.get_pool_stats()
+        # connections held by exited threads are reused
+        assert stats['created'] == 2
+        assert stats['checkouts'] == 6
+        self.db.Disconnect()
+        assert self.db.get_pool_stats() == {}
+
     def test_Commit(self):
         self.setup_mysql()
         self.db.connect()
@@ -133,6 +180,130 @@ class TestDBConnect(unittest.TestCase):
         self.setup_sqlite()
         self.db.execute('SELECT %s FROM %s'%(self.p.image_id,self.p.image_table))
 
+    def test_execute_to_arrays(self):
+        self.setup_mysql()
+        query = 'SELECT %s, %s FROM %s'%(self.p.image_id, self.p.cell_x_loc, self.p.object_table)
+        ids, xs = self.db.execute_to_arrays(query, chunk_rows=1000)
+        assert ids.dtype == np.int64 and xs.dtype == np.float64
+        assert len(ids) == len(self.db.execute(query))
+
+        self.setup_sqlite()
+        query = 'SELECT %s, %s FROM %s'%(self.p.image_id, self.p.cell_x_loc, self.p.object_table)
+        res = self.db.execute_to_arrays(query, chunk_rows=1000, structured=True)
+        assert res.dtype.names == (self.p.image_id, self.p.cell_x_loc)
+        assert len(res) == len(self.db.execute(query))
+
+    def test_GetCellDataBatch(self):
+        self.setup_mysql()
+        keys = [(1,94), (2,1), (1,94), (1,999999)]
+        data = self.db.GetCellDataBatch(keys)
+        for key, row in zip(keys[:3], data):
+            np.testing.assert_array_almost_equal(row, self.db.GetCellData(key))
+        assert np.all(np.isnan(data[3]))
+        
+        self.setup_sqlite()
+        keys = [(0,1,94), (0,2,1)]
+        cols = self.db.GetColnamesForClassifier()
+        data = self.db.GetCellDataBatch(keys, cols)
+        for key, row in zip(keys, data):
+            np.testing.assert_array_almost_equal(row, self.db.GetCellDataForClassifier(key))
+
+    def test_GetCellDataBatch_nulls(self):
+        self.setup_sqlite_tmp()
+        self.db.execute('CREATE TABLE per_object (ImageNumber INT, ObjectNumber INT, '
+                        'Count INT, Area FLOAT, Label VARCHAR(5))')
+        self.db.bulk_insert('per_object', ['ImageNumber', 'ObjectNumber', 'Count', 'Area', 'Label'],
+                            [(1, 1, 5, 1.5, 'a'), (1, 2, None, None, None), (2, 1, 'x', 2.5, 'b')])
+        data = self.db.GetCellDataBatch([(1, 1), (1, 2), (2, 1), (3, 3)], ['Count', 'Area', 'Label'])
+        np.testing.assert_array_equal(data, [[5, 1.5, 0], [np.nan] * 3, [0, 2.5, 0], [np.nan] * 3])
+        data = self.db.GetCellDataBatch([(1, 2), (1, 1)], ['Count'])
+        np.testing.assert_array_equal(data, [[np.nan], [5]])
+
+    def test_histogram(self):
+        self.setup_sqlite()
+        x = self.p.cell_x_loc
+        xs, = self.db.execute_to_arrays('SELECT %s FROM %s'%(x, self.p.object_table))
+        xs = xs[~np.isnan(xs)]
+        hist, edges = self.db.histogram(x, 'SELECT %s FROM %s'%(x, self.p.object_table), 30)
+        expected = np.histogram(xs, 30)
+        np.testing.assert_array_equal(hist, expected[0])
+        np.testing.assert_array_almost_equal(edges, expected[1])
+        hist, edges = self.db.histogram(x, self.p.object_table, 8, scale='log2',
+                                        where='%s > 10'%(x))
+        expected = np.histogram(np.log2(xs[xs > 10]), 8)
+        np.testing.assert_array_equal(hist, expected[0])
+        np.testing.assert_array_almost_equal(edges, 2 ** expected[1])
+
+    def test_histogram2d(self):
+        self.setup_sqlite()
+        x, y = self.p.cell_x_loc, self.p.cell_y_loc
+        xs, ys = self.db.execute_to_arrays('SELECT %s, %s FROM %s'%(x, y, self.p.object_table))
+        keep = ~(np.isnan(xs) | np.isnan(ys))
+        hist, xedges, yedges = self.db.histogram2d(x, y, self.p.object_table, 20, 10)
+        expected = np.histogram2d(xs[keep], ys[keep], [20, 10])
+        np.testing.assert_array_equal(hist, expected[0])
+        np.testing.assert_array_almost_equal(xedges, expected[1])
+        keep &= (xs > 0) & (xs <= 100)
+        hist, xedges, yedges = self.db.histogram2d(x, y, 'SELECT * FROM %s'%(self.p.object_table),
+                                                   5, 5, range=[[1, 100], [0, 1000]],
+                                                   xscale='log', where='%s <= 100'%(x))
+        expected = np.histogram2d(np.log10(xs[keep]), ys[keep], [5, 5], range=[[0, 2], [0, 1000]])
+        np.testing.assert_array_equal(hist, expected[0])
+        np.testing.assert_array_almost_equal(xedges, 10 ** expected[1])
+
+    def test_Objects_iter_batches(self):
+        self.setup_sqlite()
+        objects = Objects().project(list(object_key_columns()) + [self.p.cell_x_loc])
+        blocks = list(objects.iter_batches(1000))
+        assert all([len(b) <= 1000 for b in blocks])
+        assert np.all(np.concatenate(blocks) == objects.to_array())
+        sample = objects.sample(100)
+        assert len(sample) == min(100, objects.count())
+        assert len(set(map(tuple, sample[list(object_key_columns())].tolist()))) == len(sample)
+
+    def test_submit(self):
+        self.setup_sqlite()
+        future = self.db.submit('SELECT COUNT(*) FROM %s'%(p.image_table))
+        assert future.result(60) == self.db.execute('SELECT COUNT(*) FROM %s'%(p.image_table))
+        future = self.db.submit('SELECT COUNT(*) FROM %s a, %s b, %s c'%((p.object_table,)*3))
+        future.cancel()
+        self.assertRaises(DBQueryCancelledException, future.result, 60)
+        # the worker's connection is still usable
+        assert self.db.submit('SELECT 1').result(60) == [(1,)]
+
+    def test_execute_parallel(self):
+        self.setup_sqlite()
+        queries = ['SELECT %s, COUNT(*) FROM %s WHERE %s %% 4 = %d GROUP BY %s'
+                   %(p.image_id, p.object_table, p.image_id, i, p.image_id) for i in range(4)]
+        results = dict(self.db.execute_parallel(queries, 3))
+        assert sorted(results.keys()) == range(4)
+        for i, query in enumerate(queries):
+            assert sorted(results[i]) == sorted(self.db.execute(query))
+        ranges = self.db.execute_parallel(['SELECT COUNT(*) FROM %s a, %s b, %s c'
+                                           %((p.object_table,)*3)] * 4, 2)
+        ranges.close()
+
+    def test_EnsureIndexes(self):
+        self.setup_sqlite()
+        recommended = self.db.GetRecommendedIndexes()
+        assert (p.object_table, tuple(object_key_columns())) in recommended
+        self.db.EnsureIndexes(create=True)
+        assert self.db.EnsureIndexes() == []
+        assert tuple([c.lower() for c in object_key_columns()]) in self.db.GetIndexedColumns(p.object_table)
+
+    def test_datamodel_snapshot(self):
+        self.setup_sqlite()
+        p.datamodel_snapshot = 'yes'
+        dm = DataModel.getInstance()
+        dm.PopulateModel(delete_model=True)
+        data, revGroupMaps = dict(dm.data), dm.revGroupMaps
+        state, stale = dm.load_snapshot()
+        assert not stale
+        dm.DeleteModel()
+        dm._set_state(*state)
+        assert dm.data == data and dm.revGroupMaps == revGroupMaps
+        assert dm.cumSums[-1] == dm.obCount == sum(data.values())
+
     def test_GetObjectIDAtIndex(self):
         self.setup_mysql()
         obKey = self.db.GetObjectIDAtIndex(imKey=(1,), index=94)
@@ -142,6 +313,12 @@ class TestDBConnect(unittest.TestCase):
         obKey = self.db.GetObjectIDAtIndex(imKey=(0,1), index=94)
         assert obKey==(0,1,94)
 
+    def test_GetObjectIDsFromImages(self):
+        self.setup_mysql()
+        ids = self.db.GetObjectIDsFromImages([(1,), (2,)])
+        assert ids[(1,)][93] == self.db.GetObjectIDAtIndex((1,), 94)[-1]
+        assert len(ids[(2,)]) == DataModel.getInstance().GetObjectCountFromImage((2,))
+
     def test_GetPerImageObjectCounts(self):
         self.setup_mysql()
         self.db.GetPerImageObjectCounts()
@@ -275,6 +452,65 @@ class TestDBConnect(unittest.TestCase):
         res =  self.db.execute('select * from __test_table')
         assert res==[('A01', 1, 1.0), ('A02', 1, 2.0), ('A03', 1, None), ('A04', 1, None), ('A04', 1, None), ('A04', 1, 100.0), ('A04', 1, 200.0)]
     
+
+    def test_parse_csv_ranges(self):
+        import csv, tempfile
+        rows = [('1', 'a\nb', '2'), ('3', 'c,d', '"e"'), ('5', 'f\r\ng', '6')] * 5
+        for lineterminator in ['\n', '\r\n', '\r']:
+            fd, filename = tempfile.mkstemp(suffix='.csv')
+            f = os.fdopen(fd, 'wb')
+            csv.writer(f, lineterminator=lineterminator, quoting=csv.QUOTE_ALL).writerows(rows)
+            f.close()
+            try:
+                offsets = csv_record_offsets(filename, 4) + [os.path.getsize(filename)]
+                assert len(offsets) > 3
+                res = []
+                for start, end in zip(offsets[:-1], offsets[1:]):
+                    res += parse_csv_range((filename, start, end, [str] * 3))[0]
+                assert res == rows
+            finally:
+                os.remove(filename)
+
+    def test_create_sqlite_db_from_csvs(self):
+        import dbconnect
+        tmpdir = self.setup_sqlite_tmp()
+        self.p.image_csv_file = os.path.join(tmpdir, 'image.csv')
+        self.p.object_csv_file = os.path.join(tmpdir, 'object.csv')
+        f = open(self.p.image_csv_file, 'w')
+        f.write('ImageNumber,Well,Intensity\n1,A01,1\n2,A02,2\n\n\n\n\n3,A03,3.5\n4,B01,\n')
+        f.close()
+        f = open(self.p.object_csv_file, 'w')
+        f.write('ImageNumber,ObjectNumber,Area\n1,1,10\n1,2,11\n\n\n\n\n2,1,abc\n')
+        f.close()
+        sample_rows, batch_rows = dbconnect.CSV_SAMPLE_ROWS, dbconnect.CSV_BATCH_ROWS
+        dbconnect.CSV_SAMPLE_ROWS, dbconnect.CSV_BATCH_ROWS = 2, 2
+        try:
+            self.db.CreateSQLiteDB()
+            # types are inferred from the first 2 rows, but later values are kept
+            assert self.db.GetColumnTypeStrings('per_image') == ['INT', 'VARCHAR(3)', 'INT']
+            assert self.db.execute('SELECT * FROM per_image ORDER BY ImageNumber') == [
+                (1, 'A01', 1), (2, 'A02', 2), (3, 'A03', 3.5), (4, 'B01', None)]
+            assert self.db.execute('SELECT * FROM per_object ORDER BY ImageNumber, ObjectNumber') == [
+                (1, 1, 10), (1, 2, 11), (2, 1, 'abc')]
+        finally:
+            dbconnect.CSV_SAMPLE_ROWS, dbconnect.CSV_BATCH_ROWS = sample_rows, batch_rows
+
+    def test_bulk_insert(self):
+        self.setup_sqlite()
+        data = np.array([[1, 1.], [2, np.nan], [3, np.inf], [4, 4.]])
+        self.db.CreateTableFromData(data[:0], ['k', 'v'], '__test_table', 
+                                    temporary=True, coltypes=['INT', 'FLOAT'])
+        nrows = self.db.bulk_insert('__test_table', ['k', 'v'], data, batch_size=3)
+        assert nrows == 4
+        res = self.db.execute('select * from __test_table')
+        assert res == [(1, 1.0), (2, None), (3, None), (4, 4.0)]
+
+    def test_insert_values(self):
+        import dbconnect
+        data = np.array([['A01', 1.5, 'nan'], ['inf', np.nan, 'x'], [None, np.float32(np.inf), 2]],
+                        dtype=object)
+        assert dbconnect._insert_values(data) == [('A01', 1.5, 'nan'), ('inf', None, 'x'), 
+                                                  (None, None, 2)]
         
 if __name__ == '__main__':
     unittest.main()        
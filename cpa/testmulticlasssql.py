@@ -0,0 +1,215 @@
+import unittest
+import os
+import shutil
+import sqlite3
+import tempfile
+import numpy as np
+import multiclasssql
+from multiclasssql import _key_ranges
+from dbconnect import DBConnect
+from datamodel import DataModel
+from properties import Properties
+from stumpmodel import StumpModel
+
+class TestKeyRanges(unittest.TestCase):
+    def setUp(self):
+        # 2 tables of 130 images with 3 objects each
+        self.imkeys = [(t, i) for t in range(2) for i in range(1, 131)]
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE obj (TableNumber INT, ImageNumber INT, ObjectNumber INT)')
+        self.conn.executemany('INSERT INTO obj VALUES (?, ?, ?)',
+                              [key + (o,) for key in self.imkeys for o in range(1, 4)])
+
+    def count(self, where_clause):
+        return self.conn.execute('SELECT COUNT(*) FROM obj WHERE %s'%(where_clause)).fetchone()[0]
+
+    def test_disjoint(self):
+        clauses = _key_ranges(self.imkeys, ['TableNumber', 'ImageNumber'], 50)
+        assert len(clauses) == 6
+        assert sum([self.count(wc) for wc in clauses]) == 3 * len(self.imkeys)
+        assert [self.count(wc) for wc in clauses][:5] == [150] * 5
+        # rows whose images aren't in the image keys are in the last range
+        self.conn.execute('INSERT INTO obj VALUES (2, 1, 1)')
+        self.conn.execute('INSERT INTO obj VALUES (-1, 1, 1)')
+        assert sum([self.count(wc) for wc in clauses]) == 3 * len(self.imkeys) + 2
+
+    def test_one_key_column(self):
+        clauses = _key_ranges([(i,) for i in range(1, 131)], ['ImageNumber'], 50)
+        assert len(clauses) == 3
+        assert sum([self.count(wc) for wc in clauses]) == 3 * len(self.imkeys)
+
+    def test_few_images(self):
+        for imkeys in [[], [(0, 1)], [(0, 1), (1, 1)]]:
+            assert _key_ranges(imkeys, ['TableNumber', 'ImageNumber'], 50) == ['(1=1)']
+        assert _key_ranges(self.imkeys[:3], ['TableNumber', 'ImageNumber'], 1) == [
+            '(TableNumber < 0 OR (TableNumber = 0 AND ImageNumber <= 1))',
+            '(TableNumber > 0 OR (TableNumber = 0 AND ImageNumber > 1)) AND '
+            '(TableNumber < 0 OR (TableNumber = 0 AND ImageNumber <= 2))',
+            '(TableNumber > 0 OR (TableNumber = 0 AND ImageNumber > 2))']
+
+
+class SQLiteTestCase(unittest.TestCase):
+    '''Points the properties at an SQLite database in a temporary directory
+    with an object table of nimages images with 0 to 9 objects each. Feature
+    values are integers, so many fall exactly on thresholds, and some are
+    NULL.'''
+    nimages = 20
+
+    def setUp(self):
+        self.p  = Properties.getInstance()
+        self.db = DBConnect.getInstance()
+        self.db.Disconnect()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(self.db.Disconnect)
+        self.p.db_type = 'sqlite'
+        self.p.db_sqlite_file = os.path.join(tmpdir, 'test.db')
+        self.p.db_sql_file = None
+        self.p.image_table, self.p.object_table = 'per_image', 'per_object'
+        self.p.table_id, self.p.image_id, self.p.object_id = None, 'ImageNumber', 'ObjectNumber'
+        self.p.area_scoring_column = None
+        self.db.connect(empty_sqlite_db=True)
+
+        self.rng = np.random.RandomState(0)
+        self.db.execute('CREATE TABLE per_image (ImageNumber INT)')
+        self.db.bulk_insert('per_image', ['ImageNumber'], [(i,) for i in range(1, self.nimages + 1)])
+        self.db.execute('CREATE TABLE per_object (ImageNumber INT, ObjectNumber INT, '
+                        'Area FLOAT, Intensity FLOAT, Shape FLOAT)')
+        objects = [(i, o) + tuple(self.rng.randint(-6, 6, 3).astype(float))
+                   for i in range(1, self.nimages + 1) for o in range(1, self.rng.randint(0, 10) + 1)]
+        self.values = np.array([obj[2:] for obj in objects])
+        self.values[::5, 0] = np.nan
+        self.values[::7, 2] = np.nan
+        self.db.bulk_insert('per_object', ['ImageNumber', 'ObjectNumber', 'Area',
+                                           'Intensity', 'Shape'],
+                            [obj[:2] + tuple(v) for obj, v in zip(objects, self.values)])
+        self.db.Commit()
+
+    def weaklearners(self, n, nclasses=3):
+        return [(['Area', 'Intensity', 'Shape'][self.rng.randint(3)],
+                 float(self.rng.randint(-5, 5)),
+                 list(self.rng.normal(size=nclasses)), list(self.rng.normal(size=nclasses)), None)
+                for i in range(n)]
+
+    def expected_classes(self, weaklearners):
+        '''the 1-based class of each object, scored by StumpModel'''
+        model = StumpModel(weaklearners)
+        columns = ['Area', 'Intensity', 'Shape']
+        values = self.values[:, [columns.index(col) for col in model.columns]]
+        return (model.predict(values) + 1).tolist()
+
+    def object_classes(self, query):
+        return [row[-1] for row in sorted(self.db.execute(query))]
+
+
+class TestStumpTable(SQLiteTestCase):
+    def stump_classes(self, weaklearners):
+        model = multiclasssql.create_stump_table(weaklearners)
+        return self.object_classes(multiclasssql.stump_class_query(model, 'per_object', '1=1'))
+
+    def translate_classes(self, weaklearners):
+        return self.object_classes('SELECT ImageNumber, ObjectNumber, %s FROM per_object'
+                                   %(multiclasssql.translate(weaklearners)))
+
+    def test_nulls(self):
+        weaklearners = self.weaklearners(5)
+        expected = self.expected_classes(weaklearners)
+        assert len(set(expected)) == 3
+        assert self.stump_classes(weaklearners) == expected
+        assert self.translate_classes(weaklearners) == expected
+
+    def test_ties(self):
+        # classes 1 and 2 always have the same score, so class 2 is never chosen
+        weaklearners = [(col, thresh, [a[0], a[0], a[2]], [b[0], b[0], b[2]], margin)
+                        for col, thresh, a, b, margin in self.weaklearners(5)]
+        expected = self.expected_classes(weaklearners)
+        assert 2 not in expected and 1 in expected
+        assert self.stump_classes(weaklearners) == expected
+        assert self.translate_classes(weaklearners) == expected
+
+    def test_one_class(self):
+        weaklearners = self.weaklearners(5, nclasses=1)
+        assert self.stump_classes(weaklearners) == [1] * len(self.values)
+
+
+class TestScoreTable(SQLiteTestCase):
+    # enough images for several ranges (see _where_clauses)
+    nimages = 150
+
+    def setUp(self):
+        SQLiteTestCase.setUp(self)
+        self.p.score_table = 'scores'
+        self.p._groups, self.p._filters = {}, {}
+        self.addCleanup(setattr, self.p, 'score_table', None)
+        DataModel.getInstance().PopulateModel(delete_model=True)
+        self.addCleanup(DataModel.getInstance().DeleteModel)
+        self.learners = self.weaklearners(8)
+
+    def score_classes(self, weaklearners, cb=None):
+        multiclasssql.update_score_table(weaklearners, cb)
+        return self.object_classes(multiclasssql.score_table_class_query(
+            len(weaklearners[0][2]), 'per_object', '1=1'))
+
+    def updates(self):
+        '''the number of updates since the scores were last computed'''
+        return self.db.execute('SELECT MAX(updates) FROM scores_learners')[0][0]
+
+    def test_updates(self):
+        for n, updates in [(5, 0), (8, 1), (6, 2), (6, 2), (3, 3)]:
+            assert self.score_classes(self.learners[:n]) == self.expected_classes(self.learners[:n])
+            assert self.updates() == updates
+        scores = sorted(self.db.execute('SELECT * FROM scores'))
+        # computing the scores again gives the same values
+        self.db.execute('DROP TABLE scores_learners')
+        assert self.score_classes(self.learners[:3]) == self.expected_classes(self.learners[:3])
+        assert self.updates() == 0
+        np.testing.assert_array_almost_equal(sorted(self.db.execute('SELECT * FROM scores')), scores)
+
+    def test_max_updates(self):
+        self.score_classes(self.learners[:4])
+        self.addCleanup(setattr, multiclasssql, 'MAX_SCORE_TABLE_UPDATES',
+                        multiclasssql.MAX_SCORE_TABLE_UPDATES)
+        multiclasssql.MAX_SCORE_TABLE_UPDATES = 2
+        for n, updates in [(5, 1), (6, 2), (7, 0), (8, 1)]:
+            assert self.score_classes(self.learners[:n]) == self.expected_classes(self.learners[:n])
+            assert self.updates() == updates
+
+    def test_object_table_changes(self):
+        self.score_classes(self.learners[:4])
+        self.db.execute('INSERT INTO per_object VALUES (%d, 100, 1, 2, 3)'%(self.nimages))
+        self.values = np.vstack([self.values, [1, 2, 3]])
+        assert self.score_classes(self.learners[:5]) == self.expected_classes(self.learners[:5])
+        assert self.updates() == 0
+        # a score table that is missing objects is computed again
+        self.db.execute('DELETE FROM scores WHERE ImageNumber = 2')
+        assert multiclasssql.update_score_table(self.learners[:5])
+        assert self.updates() == 0
+        assert self.score_classes(self.learners[:5]) == self.expected_classes(self.learners[:5])
+
+    def test_cancel(self):
+        self.score_classes(self.learners[:4])
+        tables = ['scores', 'scores_learners']
+        before = [sorted(self.db.execute('SELECT * FROM %s'%(t))) for t in tables]
+        calls = []
+        def cb(frac):
+            calls.append(frac)
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+        for learners in [self.learners[:6], self.learners[1:6]]:
+            del calls[:]
+            self.assertRaises(KeyboardInterrupt, multiclasssql.update_score_table, learners, cb)
+            assert calls[-1] < 1
+            assert [sorted(self.db.execute('SELECT * FROM %s'%(t))) for t in tables] == before
+            for table in ['scores_new', '_stump']:
+                assert not self.db.table_exists(table)
+
+    def test_progress(self):
+        for learners in [self.learners[:4], self.learners[:4], self.learners[:6]]:
+            calls = []
+            multiclasssql.PerImageCounts(learners, cb=calls.append)
+            assert calls == sorted(calls) and calls[-1] == 1
+            assert len(set(calls)) == len(calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
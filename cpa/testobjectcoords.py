@@ -0,0 +1,31 @@
+import unittest
+import numpy as np
+from objectcoords import ImageObjects
+
+class TestImageObjects(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.xs = rng.rand(2000) * 1000
+        self.ys = rng.rand(2000) * 800
+        self.xs[5] = np.nan
+        self.image = ImageObjects((3,), np.arange(2000, 0, -1), self.xs[::-1], self.ys[::-1])
+
+    def test_nearest(self):
+        rng = np.random.RandomState(1)
+        dist2 = lambda x, y: np.where(np.isnan(self.xs), np.inf, (self.xs-x)**2 + (self.ys-y)**2)
+        for x, y in zip(rng.rand(500) * 1200 - 100, rng.rand(500) * 1000 - 100):
+            assert self.image.key(self.image.nearest(x, y)) == (3, np.argmin(dist2(x, y)) + 1)
+
+    def test_in_rect(self):
+        expected = np.flatnonzero((self.xs >= 100) & (self.xs <= 300) &
+                                  (self.ys >= 200) & (self.ys <= 250)) + 1
+        assert [self.image.key(i)[-1] for i in self.image.in_rect(300, 250, 100, 200)] == list(expected)
+
+    def test_coords(self):
+        assert self.image.coords(self.image.index((3, 1))) == (self.xs[0], self.ys[0])
+        assert self.image.coords(self.image.index((3, 6)))[0] is None
+        assert self.image.index((3, 2001)) is None
+
+
+if __name__ == '__main__':
+    unittest.main()
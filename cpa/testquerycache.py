@@ -0,0 +1,52 @@
+import unittest
+import decimal
+import shutil
+import tempfile
+from querycache import QueryCache
+
+class TestQueryCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.rows = [(1, 'A01', 2.5, decimal.Decimal('3.25'), None),
+                     (2L, 'B02', None, decimal.Decimal('1'), None)]
+        self.colnames = ['ImageNumber', 'well', 'x', 'sum', 'y']
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_memory_and_disk(self):
+        cache = QueryCache(self.dir)
+        assert cache.get('q1') is None
+        cache.put('q1', ['per_image'], self.colnames, self.rows)
+        assert cache.get('q1') == (self.colnames, self.rows)
+        # a new cache (eg: a later session) reads the results from disk
+        cache = QueryCache(self.dir)
+        colnames, rows = cache.get('q1')
+        assert colnames == self.colnames and rows == self.rows
+        assert [type(v) for v in rows[0]] == [int, str, float, decimal.Decimal, type(None)]
+        assert cache.get_stats()['disk_hits'] == 1
+
+    def test_invalidate(self):
+        cache = QueryCache(self.dir)
+        cache.put('q1', ['per_image'], self.colnames, self.rows)
+        cache.put('q2', ['per_object'], self.colnames, self.rows)
+        cache.invalidate(['PER_IMAGE'])
+        assert cache.get('q1') is None
+        assert cache.get('q2') is not None
+        assert QueryCache(self.dir).get('q1') is None
+
+    def test_lru(self):
+        cache = QueryCache(None, max_entries=2)
+        for key in ['q1', 'q2', 'q3']:
+            cache.put(key, ['t'], ['a'], [(1,)])
+        assert cache.get('q1') is None
+        assert cache.get('q3') == (['a'], [(1,)])
+
+    def test_disk_size_limit(self):
+        cache = QueryCache(self.dir, max_disk_bytes=1)
+        cache.put('q1', ['t'], ['a'], [(i,) for i in range(100)])
+        assert cache.get_stats()['disk_bytes'] == 0
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+from queryprofiler import QueryProfiler, query_shape
+
+class TestQueryProfiler(unittest.TestCase):
+    def test_query_shape(self):
+        assert (query_shape("SELECT x FROM t WHERE well='A01' AND id IN (1, 2,3) AND  y > -3.5e-3") ==
+                "SELECT x FROM t WHERE well=? AND id IN (?, ...) AND y > ?")
+        assert query_shape('SELECT a2 FROM t2 WHERE ImageNumber=10') == query_shape('SELECT a2 FROM t2 WHERE ImageNumber=7')
+        q = 'SELECT a FROM t WHERE %s'
+        assert (query_shape(q%(' OR '.join(['(i=%d AND o=%d)'%(i, i) for i in range(100)]))) == 
+                query_shape(q%(' OR '.join(['(i=%d AND o=%d)'%(i, i) for i in range(5)]))))
+
+    def test_record(self):
+        profiler = QueryProfiler(capacity=3)
+        for i in range(5):
+            profiler.record('SELECT * FROM t WHERE id=%d'%(i), 0, 0.5, rows=[(1, 'ab')])
+        profiler.record('SELECT COUNT(*) FROM t', 0, 3.0, rows=[(1,)])
+        assert [r.query for r in profiler.get_recent(2)] == ['SELECT COUNT(*) FROM t', 'SELECT * FROM t WHERE id=4']
+        assert len(profiler.get_recent()) == 3
+        stats = profiler.get_shape_stats()
+        assert stats[0]['shape'] == 'SELECT COUNT(*) FROM t'
+        assert stats[1]['count'] == 5 and stats[1]['total_time'] == 2.5 and stats[1]['rows'] == 5
+        assert stats[1]['bytes'] == 50 and stats[1]['tools'] == ['testqueryprofiler']
+        assert 'SELECT COUNT(*) FROM t' in profiler.report()
+        profiler.reset()
+        assert profiler.get_shape_stats() == []
+
+    def test_record_counts(self):
+        profiler = QueryProfiler()
+        r = profiler.record('SELECT a FROM t', 0, 1.5, nrows=200000, nbytes=1600000)
+        assert r.rows == 200000 and r.bytes == 1600000
+        stats = profiler.get_shape_stats()
+        assert stats[0]['rows'] == 200000 and stats[0]['bytes'] == 1600000
+
+    def test_slow_query(self):
+        profiler = QueryProfiler(slow_threshold=1.0)
+        r = profiler.record('SELECT 1', 0, 0.1, explain=lambda q: 'plan')
+        assert r.plan is None
+        r = profiler.record('SELECT 1', 0, 2.0, explain=lambda q: 'plan')
+        assert r.plan == 'plan'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+import multiclasssql
+from dbconnect import DBConnect
+from datamodel import DataModel
+from properties import Properties
+from sqltools import Filter
+try:
+    import supportvectormachines
+except ImportError:
+    # it needs wx
+    supportvectormachines = None
+
+CLASSNAMES = ['pos', 'neg', 'other']
+
+class ThresholdModel(object):
+    '''stands in for a trained SVM: class 1 if the first scaled feature is
+    above 0.5, otherwise class 0'''
+    def predict(self, values):
+        return (values[:, 0] > 0.5).astype(float)
+
+class TestNumpyScoring(unittest.TestCase):
+    '''Checks that the numpy scoring engine (scoring.py) gives the same
+    results as scoring in the database.'''
+    def setUp(self):
+        self.p  = Properties.getInstance()
+        self.db = DBConnect.getInstance()
+        self.db.Disconnect()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(self.db.Disconnect)
+        self.p.db_type = 'sqlite'
+        self.p.db_sqlite_file = os.path.join(tmpdir, 'test.db')
+        self.p.db_sql_file = None
+        self.p.image_table, self.p.object_table = 'per_image', 'per_object'
+        self.p.table_id, self.p.image_id, self.p.object_id = None, 'ImageNumber', 'ObjectNumber'
+        self.p.class_table = 'per_object_class'
+        self.p.score_table = None
+        self.p.area_scoring_column = 'Area'
+        self.p._filters = {'plate1': Filter(('per_image', 'Plate'), '= 1')}
+        self.p._groups = {}
+        self.addCleanup(self.reset_properties)
+        self.db.connect(empty_sqlite_db=True)
+
+        rng = np.random.RandomState(0)
+        self.db.execute('CREATE TABLE per_image (ImageNumber INT, Plate INT)')
+        self.db.bulk_insert('per_image', ['ImageNumber', 'Plate'],
+                            [(i, i % 2) for i in range(1, 41)])
+        self.db.execute('CREATE TABLE per_object (ImageNumber INT, ObjectNumber INT, '
+                        'Area FLOAT, Intensity FLOAT, Shape FLOAT)')
+        # integer values so that many fall exactly on thresholds
+        objects = [(i, o) + tuple(rng.randint(-6, 6, 3).astype(float))
+                   for i in range(1, 41) for o in range(1, rng.randint(0, 10) + 1)]
+        objects = [obj[:3] + (np.nan,) + obj[4:] if n % 7 == 0 else obj
+                   for n, obj in enumerate(objects)]
+        self.db.bulk_insert('per_object', ['ImageNumber', 'ObjectNumber', 'Area',
+                                           'Intensity', 'Shape'], objects)
+        self.db.Commit()
+        DataModel.getInstance().PopulateModel(delete_model=True)
+
+        self.weaklearners = [(['Area', 'Intensity', 'Shape'][rng.randint(3)],
+                              float(rng.randint(-5, 5)),
+                              list(rng.normal(size=3)), list(rng.normal(size=3)), None)
+                             for i in range(20)]
+
+    def reset_properties(self):
+        self.p.scoring_engine = None
+        self.p.area_scoring_column = None
+        self.p.class_table = None
+        self.p._filters = {}
+        DataModel.getInstance().DeleteModel()
+
+    def per_image_counts(self, engine, filter_name):
+        self.p.scoring_engine = engine
+        return sorted(multiclasssql.PerImageCounts(self.weaklearners, filter_name))
+
+    def class_table(self, engine):
+        self.p.scoring_engine = engine
+        multiclasssql.create_perobject_class_table(CLASSNAMES, self.weaklearners)
+        return self.db.execute('SELECT ImageNumber, ObjectNumber, class, class_number '
+                               'FROM per_object_class ORDER BY ImageNumber, ObjectNumber')
+
+    def test_per_image_counts(self):
+        for filter_name in [None, 'plate1']:
+            expected = self.per_image_counts('database', filter_name)
+            result = self.per_image_counts('numpy', filter_name)
+            assert len(result) == (40 if filter_name is None else 20)
+            assert [row[:4] for row in result] == [row[:4] for row in expected]
+            np.testing.assert_array_almost_equal(np.array(result)[:, 4:],
+                                                 np.array(expected)[:, 4:])
+
+    def test_class_table(self):
+        expected = self.class_table('database')
+        result = self.class_table('numpy')
+        assert len(result) == self.db.execute('SELECT COUNT(*) FROM per_object')[0][0]
+        assert result == expected
+
+    def test_svm_predict(self):
+        if supportvectormachines is None:
+            self.skipTest('supportvectormachines needs wx')
+        self.db.GetColnamesForClassifier(force=True)
+        svm = supportvectormachines.SupportVectorMachines()
+        svm.classBins = CLASSNAMES[:2]
+        svm.model = ThresholdModel()
+        # Area is scaled from [-6, 6] to [0, 1], and NULLs count as 0
+        svm.feat_min, svm.feat_max = [-6.0] * 3, [6.0] * 3
+        self.p.area_scoring_column = None
+        result = sorted(svm.PerImageCounts('plate1'))
+        above = 'COALESCE(Area, 0) > 0'
+        expected = self.db.execute('SELECT per_image.ImageNumber, '
+                                   'COUNT(ObjectNumber) - SUM(%s), SUM(%s) '
+                                   'FROM per_image LEFT JOIN per_object '
+                                   'ON per_image.ImageNumber = per_object.ImageNumber '
+                                   'WHERE Plate = 1 GROUP BY per_image.ImageNumber'%(above, above))
+        assert result == [[i, n0, n1 or 0] for i, n0, n1 in expected]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+import os
+import shutil
+import sqlite3
+import tempfile
+import numpy as np
+from dbconnect import DBConnect, SqliteClassifier, stump_model_string
+
+SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'sqlite_plugins', 'classify.c')
+
+def build_extension(output_dir):
+    '''Compiles sqlite_plugins/classify.c into output_dir and returns the
+    path of the library without its suffix, or None if it can't be built.'''
+    from distutils.ccompiler import new_compiler
+    from distutils.errors import DistutilsError, CCompilerError
+    from distutils.sysconfig import customize_compiler
+    compiler = new_compiler()
+    try:
+        customize_compiler(compiler)
+        objects = compiler.compile([SOURCE], output_dir=output_dir)
+        path = os.path.join(output_dir, 'classify')
+        compiler.link_shared_object(objects, path + compiler.shared_lib_extension)
+    except (DistutilsError, CCompilerError):
+        return None
+    return path
+
+class TestSQLiteClassifierExtension(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        if not hasattr(self.conn, 'enable_load_extension'):
+            self.skipTest("python's sqlite3 can't load extensions")
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        path = build_extension(self.tmpdir)
+        if path is None:
+            self.skipTest('classify.c could not be compiled')
+        assert DBConnect.getInstance()._load_sqlite_extension(self.conn, path)
+
+    def test_stump_classifier(self):
+        rng = np.random.RandomState(0)
+        num_stumps, num_classes = 20, 3
+        thresholds = rng.randn(num_stumps)
+        a = rng.randn(num_stumps, num_classes)
+        b = rng.randn(num_stumps, num_classes)
+        features = rng.randn(1000, num_stumps)
+        features[::7, 3] = np.nan
+        features[::5] = thresholds   # exactly on the threshold
+        cols = ['f%d'%(i) for i in range(num_stumps)]
+        self.conn.execute('CREATE TABLE t (%s)'%(', '.join(cols)))
+        self.conn.executemany('INSERT INTO t VALUES (%s)'%(','.join('?' * num_stumps)),
+                              [[None if np.isnan(x) else x for x in row] for row in features])
+        res = self.conn.execute("SELECT stump_classifier('%s', %s) FROM t"%(
+                                stump_model_string(thresholds, a, b), ', '.join(cols))).fetchall()
+
+        classifier = SqliteClassifier()
+        classifier.setup_classifier(thresholds, a, b)
+        self.conn.create_function('classifier', -1, classifier.classify)
+        expected = self.conn.execute('SELECT classifier(%s) FROM t'%(', '.join(cols))).fetchall()
+        assert res == expected
+
+
+if __name__ == '__main__':
+    unittest.main()
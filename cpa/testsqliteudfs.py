@@ -0,0 +1,60 @@
+import unittest
+import sqlite3
+import numpy as np
+import sqliteudfs
+
+class TestSQLiteUDFs(unittest.TestCase):
+    def setUp(self):
+        self.values = np.random.RandomState(1).randn(5001)
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE t (g, v)')
+        self.conn.executemany('INSERT INTO t VALUES (?, ?)',
+                              [(i % 2, float(v)) for i, v in enumerate(self.values)])
+        self.conn.execute('INSERT INTO t VALUES (0, NULL)')
+        sqliteudfs.register(self.conn)
+
+    def query(self, expr):
+        return self.conn.execute('SELECT g, %s FROM t GROUP BY g ORDER BY g'%(expr)).fetchall()
+
+    def test_median(self):
+        for g, median in self.query('median(v)'):
+            self.assertAlmostEqual(median, np.median(self.values[g::2]))
+
+    def test_quantile(self):
+        for g, q in self.query('quantile(v, 0.9)'):
+            self.assertAlmostEqual(q, np.percentile(self.values[g::2], 90))
+
+    def test_stddev(self):
+        for g, std in self.query('stddev(v)'):
+            self.assertAlmostEqual(std, np.std(self.values[g::2]))
+
+    def test_approx_median(self):
+        sqliteudfs.register(self.conn, median_sample_size=500)
+        for g, median in self.query('median(v)'):
+            # the rank of the estimate should be near the middle
+            rank = np.mean(self.values[g::2] < median)
+            assert abs(rank - 0.5) < 0.1
+        for g, median in self.query('approx_median(v)'):
+            # groups smaller than the sample are exact
+            self.assertAlmostEqual(median, np.median(self.values[g::2]))
+
+    def test_empty(self):
+        res = self.conn.execute('SELECT median(v), stddev(v), approx_quantile(v, 0.1) '
+                                'FROM t WHERE v IS NULL').fetchall()
+        assert res == [(None, None, None)]
+
+    def test_regexp(self):
+        self.conn.execute('CREATE TABLE s (name)')
+        self.conn.executemany('INSERT INTO s VALUES (?)', [('MAP1',), ('map2',), ('xMAP',), (None,)])
+        res = self.conn.execute("SELECT name FROM s WHERE name REGEXP 'MAP.*'").fetchall()
+        assert res == [('MAP1',)]
+
+    def test_log(self):
+        self.assertEqual(self.conn.execute('SELECT LOG10(100), LOG2(8), LOG10(0), LOG2(NULL)').fetchall(),
+                         [(2.0, 3.0, None, None)])
+        self.assertAlmostEqual(sqliteudfs._log(10.0)(1000), 3.0)
+        self.assertEqual(sqliteudfs._log(2.0)(-1), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
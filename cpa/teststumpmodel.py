@@ -0,0 +1,41 @@
+import unittest
+import numpy as np
+from stumpmodel import StumpModel, loads
+
+def stump_scores(weaklearners, columns, values):
+    '''class scores computed one stump at a time'''
+    scores = np.zeros((len(values), len(weaklearners[0][2])))
+    for col, thresh, a, b, margin in weaklearners:
+        above = values[:, columns.index(col)] > thresh
+        scores += np.where(above[:, np.newaxis], a, b)
+    return scores
+
+class TestStumpModel(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.weaklearners = [(['Area', 'Intensity', 'Shape'][rng.randint(3)],
+                              float(rng.randint(-5, 5)),
+                              list(rng.normal(size=3)), list(rng.normal(size=3)), None)
+                             for i in range(50)]
+        # integer values so that many fall exactly on thresholds
+        self.values = rng.randint(-6, 6, (1000, 3)).astype(float)
+        self.values[::10, 1] = np.nan
+
+    def test_scores(self):
+        model = StumpModel(self.weaklearners)
+        assert model.columns == ['Area', 'Intensity', 'Shape']
+        assert len(model) == 50
+        expected = stump_scores(self.weaklearners, model.columns, self.values)
+        np.testing.assert_array_almost_equal(model.scores(self.values), expected)
+        np.testing.assert_array_equal(model.predict(self.values), expected.argmax(axis=1))
+
+    def test_dumps(self):
+        model = StumpModel(self.weaklearners)
+        data = model.dumps()
+        assert loads(data) == model
+        np.testing.assert_array_equal(loads(data).scores(self.values), model.scores(self.values))
+        self.assertRaises(ValueError, loads, 'x' * len(data))
+
+
+if __name__ == '__main__':
+    unittest.main()
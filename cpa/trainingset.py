@@ -48,24 +48,14 @@ class TrainingSet:
         self.labels = numpy.array(labels)
         self.classifier_labels = 2 * numpy.eye(len(labels), dtype=numpy.int) - 1
         
-        num_to_fetch = sum([len(k) for k in keyLists])
-        num_fetched = [0] # use a list to get static scoping
-
         # Populate the label_matrix, entries, and values
         for label, cl_label, keyList in zip(labels, self.classifier_labels, keyLists):
             self.label_matrix += ([cl_label] * len(keyList))
             self.entries += zip([label] * len(keyList), keyList)
 
-            if labels_only:
-                self.values += []
-            else:
-                def get_data(k):
-                    d = self.cache.get_object_data(k)
-                    if callback is not None:
-                        callback(num_fetched[0] / float(num_to_fetch))
-                    num_fetched[0] = num_fetched[0] + 1
-                    return d
-                self.values += [get_data(k) for k in keyList]
+        if not labels_only:
+            self.values = self.cache.get_objects_data(
+                [k for keyList in keyLists for k in keyList], callback)
 
         self.label_matrix = numpy.array(self.label_matrix)
         self.values = numpy.array(self.values, np.float64)
@@ -183,6 +173,9 @@ class TrainingSet:
 
 class CellCache(Singleton):
     ''' caching front end for holding cell data '''
+    # number of objects fetched from the database per query
+    FETCH_BATCH_SIZE = 5000
+    
     def __init__(self):
         self.data        = {}
         self.colnames    = db.GetColumnNames(p.object_table)
@@ -223,6 +216,30 @@ class CellCache(Singleton):
             self.data[key] = db.GetCellData(key)
         return self.data[key][self.col_indices]
 
+    def get_objects_data(self, keys, callback=None):
+        '''
+        Returns a 2D array of the classifier measurements for each of the 
+        given keys. Uncached objects are fetched from the database in batches
+        of FETCH_BATCH_SIZE keys, calling callback with the fraction of keys
+        fetched after each one. Rows for objects that couldn't be found are 
+        NaN.
+        '''
+        missing = list(set([k for k in keys if k not in self.data]))
+        for start in xrange(0, len(missing), self.FETCH_BATCH_SIZE):
+            batch = missing[start : start + self.FETCH_BATCH_SIZE]
+            for k, row in zip(batch, db.GetCellDataBatch(batch)):
+                if not numpy.all(numpy.isnan(row)):
+                    # NULLs have always been cached as 0 (see GetCellData)
+                    self.data[k] = numpy.where(numpy.isnan(row), 0.0, row)
+            if callback is not None:
+                callback((start + len(batch)) / float(len(missing)))
+        values = numpy.empty((len(keys), len(self.col_indices)))
+        values[:] = numpy.nan
+        for i, k in enumerate(keys):
+            if k in self.data:
+                values[i] = self.data[k][self.col_indices]
+        return values
+
     def clear_if_objects_modified(self):
         if not db.verify_objects_modify_date_earlier(self.last_update):
             self.data = {}
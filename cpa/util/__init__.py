@@ -43,11 +43,20 @@ def heatmap(datax, datay, resolutionx=200, resolutiony=200, logscale=False,
         goody = datay
     bins = [np.linspace(minx, maxx, resolutionx),
             np.linspace(miny, maxy, resolutiony)]
-    out = np.histogram2d(datax, datay, bins=bins)[0].transpose()
+    return heatmap_from_histogram(*np.histogram2d(datax, datay, bins=bins),
+                                  logscale=logscale)
+
+def heatmap_from_histogram(hist, xedges, yedges, logscale=False):
+    """
+    Like heatmap, but from a 2-D histogram that has already been computed,
+    eg: by DBConnect.histogram2d, which bins the data in the database.
+    >>> heat = heatmap_from_histogram(*db.histogram2d('DNA', 'pH3', 'per_object', 200, 200))
+    >>> pylab.imshow(heat[0], origin='lower', extent=heat[1])
+    """
+    out = np.array(hist, dtype=float).transpose()
     if logscale:
-        out=out.astype(float)
         out[out>0] = np.log(out[out>0]+1) / np.log(10.0)
-    return (out , [minx, maxx, miny, maxy])
+    return (out , [xedges[0], xedges[-1], yedges[0], yedges[-1]])
 
 def unpickle(file_or_filename, nobjects=None, new=True):
     """